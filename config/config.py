@@ -23,6 +23,22 @@ class Config:
         self.telegram_bot_token = os.getenv("TELEGRAM_BOT_TOKEN", "")
         # telegram bot api base url
         self.telegram_bot_api_base = os.getenv("TELEGRAM_BOT_API_BASE", "https://api.telegram.org/bot")
+        # 接收 update 的方式：polling（long polling）或 webhook
+        self.telegram_update_mode = os.getenv("TELEGRAM_UPDATE_MODE", "polling").lower()
+        # webhook 的公网地址，包括路径，eg: https://bot.example.com/telegram/webhook
+        self.telegram_webhook_url = os.getenv("TELEGRAM_WEBHOOK_URL", "")
+        # webhook 的 secret token，telegram 推送 update 时放在 X-Telegram-Bot-Api-Secret-Token 请求头中
+        self.telegram_webhook_secret = os.getenv("TELEGRAM_WEBHOOK_SECRET", "")
+        # webhook 服务监听的地址和端口
+        self.telegram_webhook_listen = os.getenv("TELEGRAM_WEBHOOK_LISTEN", "0.0.0.0")
+        self.telegram_webhook_port = int(os.getenv("TELEGRAM_WEBHOOK_PORT", 8080))
+        # telegram 同时推送 update 的最大连接数
+        self.telegram_webhook_max_connections = int(os.getenv("TELEGRAM_WEBHOOK_MAX_CONNECTIONS", 40))
+        # 等待处理的 update 最大数量，webhook 模式下超出时让 telegram 稍后重新推送
+        self.telegram_update_queue_size = int(os.getenv("TELEGRAM_UPDATE_QUEUE_SIZE", 256))
+        # 多个 bot 副本时只有 leader 合并提交备份、等待 wayback 快照，leader 锁的过期时间（秒），
+        # leader 异常退出后最多经过这么长时间由其他副本接手
+        self.leader_lock_ttl = int(os.getenv("LEADER_LOCK_TTL", 30))
         # telegram chat id
         self.developer_chat_id = int(os.getenv("DEVELOPER_CHAT_ID", ""))
 
@@ -46,13 +62,116 @@ class Config:
         # redis_conn 配置
         self.redis_host = os.getenv("REDIS_HOST", "127.0.0.1")
         self.redis_port = os.getenv("REDIS_PORT", 6379)
+        # redis 连接池的最大连接数，达到上限时等待空闲连接
+        self.redis_max_connections = int(os.getenv("REDIS_MAX_CONNECTIONS", 32))
+        # 连接空闲超过该秒数后，使用前先发送 PING 检查连接是否可用
+        self.redis_health_check_interval = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", 30))
+        # 读写超时时间（秒），需要大于 stream 阻塞读取的时间
+        self.redis_socket_timeout = float(os.getenv("REDIS_SOCKET_TIMEOUT", 15))
+        # 建立连接的超时时间（秒）
+        self.redis_socket_connect_timeout = float(os.getenv("REDIS_SOCKET_CONNECT_TIMEOUT", 5))
+        # /redis 结果作为 gzip 附件发送时的最大字节数（压缩后），超出部分截断
+        self.redis_result_max_bytes = int(os.getenv("REDIS_RESULT_MAX_BYTES", 10 * 1024 * 1024))
 
         # selenium 配置
         self.selenium_server = os.getenv("SELENIUM_SERVER", "http://127.0.0.1:4444/wd/hub")
+        # selenium session 池大小，与 selenium 服务的 SE_NODE_MAX_SESSIONS 保持一致
+        self.selenium_max_sessions = int(os.getenv("SE_NODE_MAX_SESSIONS", 4))
+        # 单个 session 最多复用次数，超过后销毁重建
+        self.selenium_session_max_uses = int(os.getenv("SELENIUM_SESSION_MAX_USES", 20))
+        # 等待空闲 session 的超时时间（秒）
+        self.selenium_lease_timeout = float(os.getenv("SELENIUM_LEASE_TIMEOUT", 120))
+        # 分级抓取配置：先使用 http 请求，正文不足时再使用 selenium 渲染
+        # http 请求超时时间（秒）
+        self.fetch_http_timeout = float(os.getenv("FETCH_HTTP_TIMEOUT", 10))
+        # http 抓取到的正文少于该字符数时使用 selenium 渲染
+        self.fetch_min_text_length = int(os.getenv("FETCH_MIN_TEXT_LENGTH", 500))
+        # 必须使用 selenium 渲染的域名，逗号分隔
+        self.js_only_hosts = [h.strip() for h in os.getenv("JS_ONLY_HOSTS", "mp.weixin.qq.com,x.com,twitter.com").split(',')
+                              if h.strip()]
+        # 备份时是否归档网页中的图片、样式表等资源，按内容 hash 存放在 {GITHUB_FILE_PREFIX}/assets 下并改为相对路径
+        self.backup_archive_assets = os.getenv("BACKUP_ARCHIVE_ASSETS", "false").lower() == "true"
+        # 并发下载资源的线程数
+        self.archive_asset_workers = int(os.getenv("ARCHIVE_ASSET_WORKERS", 8))
+        # 单个资源的最大字节数，超过的资源保留原始地址
+        self.archive_asset_max_bytes = int(os.getenv("ARCHIVE_ASSET_MAX_BYTES", 5 * 1024 * 1024))
+        # 下载单个资源的超时时间（秒）
+        self.archive_asset_timeout = float(os.getenv("ARCHIVE_ASSET_TIMEOUT", 15))
+        # 滚动加载网页的总时长上限（秒）
+        self.scroll_time_budget = float(os.getenv("SCROLL_TIME_BUDGET", 15))
+        # 每滚动一屏后，页面保持多久（毫秒）无变化视为加载完成
+        self.scroll_idle_ms = int(os.getenv("SCROLL_IDLE_MS", 300))
+
+        # url 阻塞任务线程池配置（selenium / wayback / GitHub 请求）
+        # 同时执行的任务数
+        self.url_executor_workers = int(os.getenv("URL_EXECUTOR_WORKERS", 4))
+        # 最多排队等待的任务数，超出直接拒绝
+        self.url_executor_queue_size = int(os.getenv("URL_EXECUTOR_QUEUE_SIZE", 16))
+        # 单个任务超时时间（秒）
+        self.url_executor_timeout = float(os.getenv("URL_EXECUTOR_TIMEOUT", 300))
+
+        # /backup 和 /summarize 批量任务队列配置
+        # 一条命令最多处理的 url 数
+        self.url_batch_max_urls = int(os.getenv("URL_BATCH_MAX_URLS", 20))
+        # 同时处理的 url 数
+        self.url_job_workers = int(os.getenv("URL_JOB_WORKERS", 4))
+        # 最多排队等待的 url 数，超出直接拒绝
+        self.url_job_queue_size = int(os.getenv("URL_JOB_QUEUE_SIZE", 50))
+        # 同时抓取网页的最大并发数
+        self.url_fetch_concurrency = int(os.getenv("URL_FETCH_CONCURRENCY", 3))
+        # 同时生成摘要的最大并发数
+        self.url_llm_concurrency = int(os.getenv("URL_LLM_CONCURRENCY", 2))
+        # url 任务的执行方式：local（在 bot 进程内执行）或 stream（发布到 redis stream，由 worker.py 进程执行）
+        self.url_job_backend = os.getenv("URL_JOB_BACKEND", "local").lower()
+        # stream 最多保留的条目数
+        self.url_job_stream_maxlen = int(os.getenv("URL_JOB_STREAM_MAXLEN", 10000))
+        # 任务被领取后超过该时间（秒）没有确认，视为 worker 已经退出，由其他 worker 重新领取
+        self.url_job_visibility_timeout = int(os.getenv("URL_JOB_VISIBILITY_TIMEOUT", 900))
+        # 任务最多执行次数，超出后移入死信 stream
+        self.url_job_max_attempts = int(os.getenv("URL_JOB_MAX_ATTEMPTS", 3))
+        # 每个 worker 进程同时执行的任务数
+        self.worker_concurrency = int(os.getenv("WORKER_CONCURRENCY", 4))
+        # worker 名称，同一时间运行的 worker 不能重名，默认为 主机名-进程号
+        self.worker_name = os.getenv("WORKER_NAME", "")
 
         # ai 配置
         self.ai_prompt = os.getenv("PROMPT", "🤖")
         self.ai_retry_times = int(os.getenv("RETRY_TIMES", 3))
+        # 重试的初始等待时间（秒），之后按指数增长
+        self.ai_retry_base_delay = float(os.getenv("AI_RETRY_BASE_DELAY", 1))
+        # 每个 AI 服务的最大连接数
+        self.ai_max_connections = int(os.getenv("AI_MAX_CONNECTIONS", 10))
+        # AI 请求超时时间（秒）
+        self.ai_timeout = float(os.getenv("AI_TIMEOUT", 120))
+        # 是否流式输出摘要，边生成边编辑 telegram 消息
+        self.summary_stream = os.getenv("SUMMARY_STREAM", "true").lower() == "true"
+        # 流式输出时两次编辑消息的最小间隔（秒），避免触发 telegram 的频率限制
+        self.summary_stream_interval = float(os.getenv("SUMMARY_STREAM_INTERVAL", 1.5))
+        # 长文本分块摘要：每块的最大 token 数
+        self.summary_chunk_tokens = int(os.getenv("SUMMARY_CHUNK_TOKENS", 3000))
+        # 长文本分块摘要：同时请求模型的最大并发数
+        self.summary_max_concurrency = int(os.getenv("SUMMARY_MAX_CONCURRENCY", 3))
+        # 长文本分块摘要：提炼每一块要点使用的 prompt
+        self.summary_map_prompt = os.getenv("SUMMARY_MAP_PROMPT",
+                                            "下面是一篇长文章的其中一部分，请提炼这部分的要点，保留关键的细节、数据和示例，不要添加额外的评论：")
+        # 摘要缓存过期时间（秒）
+        self.summary_cache_ttl = int(os.getenv("SUMMARY_CACHE_TTL", 60 * 60 * 24 * 7))
+        # 摘要缓存最大条数，超出后淘汰最久未访问的条目
+        self.summary_cache_max_size = int(os.getenv("SUMMARY_CACHE_MAX_SIZE", 1000))
+        # selenium 渲染结果缓存的过期时间（秒），/summarize 和 /backup 同一网页时共用一次渲染
+        self.page_cache_ttl = int(os.getenv("PAGE_CACHE_TTL", 60 * 10))
+        # selenium 渲染结果缓存占用的最大字节数（压缩后），超出后淘汰最早写入的条目
+        self.page_cache_max_bytes = int(os.getenv("PAGE_CACHE_MAX_BYTES", 50 * 1024 * 1024))
+        # 相同 url 的并发请求合并方式：local（单个 bot 进程内）或 redis（多个 bot 副本之间，基于 redis 锁）
+        self.singleflight_backend = os.getenv("SINGLEFLIGHT_BACKEND", "local").lower()
+        # redis 锁的过期时间（秒），应大于单次请求的最长耗时
+        self.singleflight_lock_ttl = int(os.getenv("SINGLEFLIGHT_LOCK_TTL", 600))
+        # 执行结果在 redis 中保存的时间（秒），供等待中的其他副本读取
+        self.singleflight_result_ttl = int(os.getenv("SINGLEFLIGHT_RESULT_TTL", 60))
+        # 等待其他副本的最长时间（秒），超时后自己执行
+        self.singleflight_wait_timeout = float(os.getenv("SINGLEFLIGHT_WAIT_TIMEOUT", 600))
+        # 等待其他副本时查询结果的间隔（秒）
+        self.singleflight_poll_interval = float(os.getenv("SINGLEFLIGHT_POLL_INTERVAL", 1))
 
         # open ai 配置
         self.openai_key = os.getenv("OPENAI_API_KEY", "")
@@ -63,6 +182,14 @@ class Config:
 
         # 智谱 ai 配置
         self.zhipuai_key = os.getenv("ZHIPUAI_KEY", "")
+        # 智谱 ai 模型
+        self.zhipuai_model = os.getenv("ZHIPUAI_MODEL", "chatglm_turbo")
+
+        # 多个 ai 服务同时配置时，首选服务超过 p95 耗时仍未返回则向次选服务发起对冲请求
+        # 对冲请求的最短等待时间（秒）
+        self.ai_hedge_min_delay = float(os.getenv("AI_HEDGE_MIN_DELAY", 5))
+        # 对冲请求的最长等待时间（秒），没有历史耗时数据时也使用该值
+        self.ai_hedge_max_delay = float(os.getenv("AI_HEDGE_MAX_DELAY", 60))
 
         # GitHub 配置
         self.github_token = os.getenv("GITHUB_TOKEN", "")
@@ -72,6 +199,41 @@ class Config:
         self.github_file_prefix = os.getenv("GITHUB_FILE_PREFIX", "docs").strip('/')
         # GitHub API 地址，用于反向代理，eg: https://ghproxy.com/https://api.github.com
         self.github_api_base = os.getenv("GITHUB_API_BASE", "https://api.github.com").rstrip('/')
+        # GitHub 请求超时时间（秒）
+        self.github_timeout = float(os.getenv("GITHUB_TIMEOUT", 30))
+        # GitHub GET 请求 ETag 缓存以及文件 sha 索引的最大条数
+        self.github_etag_cache_size = int(os.getenv("GITHUB_ETAG_CACHE_SIZE", 512))
+        # ETag 缓存的响应体总字节数上限，单个响应超过上限的 1/8（例如大文件的 contents）时不缓存
+        self.github_etag_cache_bytes = int(os.getenv("GITHUB_ETAG_CACHE_BYTES", 8 * 1024 * 1024))
+        # rate limit 剩余次数低于该值时开始放慢请求
+        self.github_rate_limit_reserve = int(os.getenv("GITHUB_RATE_LIMIT_RESERVE", 100))
+        # 等待 rate limit 的最长时间（秒），超过时直接报错
+        self.github_rate_limit_max_wait = float(os.getenv("GITHUB_RATE_LIMIT_MAX_WAIT", 60))
+        # 一次提交多个文件时并发上传 blob 的线程数
+        self.github_blob_workers = int(os.getenv("GITHUB_BLOB_WORKERS", 4))
+        # 提交时分支被其他提交更新导致冲突的重试次数
+        self.github_commit_retries = int(os.getenv("GITHUB_COMMIT_RETRIES", 3))
+        # 备份文件先写入 redis 队列，每隔多少秒合并为一个 commit 提交
+        self.backup_flush_interval = float(os.getenv("BACKUP_FLUSH_INTERVAL", 10))
+        # 队列中的文件达到该数量时立即提交，也是单个 commit 的最大文件数
+        self.backup_flush_max_files = int(os.getenv("BACKUP_FLUSH_MAX_FILES", 20))
+        # 同一批文件连续提交失败多少次后放弃
+        self.backup_flush_retries = int(os.getenv("BACKUP_FLUSH_RETRIES", 3))
+
+        # wayback Save Page Now 配置
+        self.wayback_base_url = os.getenv("WAYBACK_BASE_URL", "https://web.archive.org").rstrip('/')
+        # archive.org 账号的 S3 access key / secret key，不配置时匿名提交
+        self.wayback_access_key = os.getenv("WAYBACK_ACCESS_KEY", "")
+        self.wayback_secret_key = os.getenv("WAYBACK_SECRET_KEY", "")
+        # 单次请求超时时间（秒）
+        self.wayback_timeout = float(os.getenv("WAYBACK_TIMEOUT", 30))
+        # 轮询快照状态的初始间隔和最大间隔（秒）
+        self.wayback_poll_interval = float(os.getenv("WAYBACK_POLL_INTERVAL", 5))
+        self.wayback_max_poll_interval = float(os.getenv("WAYBACK_MAX_POLL_INTERVAL", 60))
+        # 等待快照完成的最长时间（秒）
+        self.wayback_poll_timeout = float(os.getenv("WAYBACK_POLL_TIMEOUT", 600))
+        # 同时发往 wayback 的最大请求数
+        self.wayback_max_concurrency = int(os.getenv("WAYBACK_MAX_CONCURRENCY", 3))
 
         # Cloudflare 配置
         self.cf_api_key = os.getenv("CF_API_KEY", "")
@@ -3,14 +3,29 @@ import random
 import time
 
 import redis
+import redis.asyncio
 
 from config.config import configInstance
 from handlers.constants import REDIS_ALL_OPENAI_KEY, TOKEN_EXPIRE
 
 
+def connection_kwargs(host, port, db) -> dict:
+    """同步和异步客户端共用的连接配置"""
+    return {'host': host, 'port': port, 'db': db, 'decode_responses': True,
+            'health_check_interval': configInstance.redis_health_check_interval,
+            'socket_timeout': configInstance.redis_socket_timeout,
+            'socket_connect_timeout': configInstance.redis_socket_connect_timeout,
+            'socket_keepalive': True}
+
+
 class RedisUtil:
+    """同步客户端，只用于脚本以及在线程池中执行的代码（例如 OpenaiKey 申请 key、page_cache），事件循环中（包括定时任务）使用 redis_async"""
+
     def __init__(self, host=configInstance.redis_host, port=configInstance.redis_port, db=0):
-        self.client = redis.StrictRedis(host=host, port=port, db=db, decode_responses=True)
+        pool = redis.BlockingConnectionPool(max_connections=configInstance.redis_max_connections,
+                                            timeout=configInstance.redis_socket_timeout,
+                                            **connection_kwargs(host, port, db))
+        self.client = redis.StrictRedis(connection_pool=pool)
 
     def setex(self, key, value, time=5 * 60):
         self.client.setex(key, time, value)
@@ -74,7 +89,108 @@ class RedisUtil:
         return self.client.zscore(REDIS_ALL_OPENAI_KEY, token)
 
 
+class AsyncRedisUtil:
+    """基于 redis.asyncio 的客户端，所有协程共用一个连接池，连接数达到上限时等待空闲连接
+
+    连接池在第一次使用时创建，保证绑定到 bot 运行的事件循环
+    """
+
+    def __init__(self, host=configInstance.redis_host, port=configInstance.redis_port, db=0):
+        self.host = host
+        self.port = port
+        self.db = db
+        self._client = None
+
+    @property
+    def client(self) -> redis.asyncio.Redis:
+        if self._client is None:
+            pool = redis.asyncio.BlockingConnectionPool(max_connections=configInstance.redis_max_connections,
+                                                        timeout=configInstance.redis_socket_timeout,
+                                                        **connection_kwargs(self.host, self.port, self.db))
+            self._client = redis.asyncio.Redis(connection_pool=pool)
+        return self._client
+
+    def pipeline(self, transaction: bool = False):
+        """批量发送命令，一次往返得到所有结果：async with redis_async.pipeline() as pipe: ... await pipe.execute()"""
+        return self.client.pipeline(transaction=transaction)
+
+    async def execute(self, *commands, transaction: bool = False) -> list:
+        """在一个 pipeline 中执行多条命令，每条命令为 (命令名, 参数...)，返回各命令的结果"""
+        async with self.pipeline(transaction=transaction) as pipe:
+            for name, *args in commands:
+                getattr(pipe, name)(*args)
+            return await pipe.execute()
+
+    async def setex(self, key, value, time=5 * 60):
+        return await self.client.setex(key, time, value)
+
+    async def get(self, key):
+        return await self.client.get(key)
+
+    async def delete(self, *key):
+        return await self.client.delete(*key)
+
+    async def keys(self, pattern='*'):
+        """用 SCAN 分批遍历，不像 KEYS 那样在大的 keyspace 上阻塞 redis"""
+        return list({key async for key in self.client.scan_iter(match=pattern, count=1000)})
+
+    async def sadd(self, key, value):
+        return await self.client.sadd(key, value)
+
+    async def srem(self, key, *values):
+        return await self.client.srem(key, *values)
+
+    async def smembers(self, key):
+        return await self.client.smembers(key)
+
+    async def srandmember(self, key):
+        return await self.client.srandmember(key)
+
+    async def exists(self, key):
+        return await self.client.exists(key)
+
+    # openkey
+    async def add_token(self, token, value=None):
+        now = time.time()
+        expire = TOKEN_EXPIRE
+        if value is not None:
+            expire -= int(now - value)
+        else:
+            value = now
+        _, added = await self.execute(('setex', token, expire, value),
+                                      ('zadd', REDIS_ALL_OPENAI_KEY, {token: int(value)}))
+        return added
+
+    async def remove_token(self, *token):
+        _, removed = await self.execute(('delete', *token), ('zrem', REDIS_ALL_OPENAI_KEY, *token))
+        return removed
+
+    async def get_random_token(self):
+        tokens = await self.get_all_tokens()
+        return random.choice(tokens)
+
+    async def get_all_tokens(self, start=None, end=None):
+        if end is None:
+            end = '+inf'
+        else:
+            end = int(end)
+        if start is None:
+            start = time.time() - TOKEN_EXPIRE
+        else:
+            start = int(start)
+        return await self.client.zrangebyscore(REDIS_ALL_OPENAI_KEY, start, end)
+
+    async def is_member(self, token):
+        return await self.client.zscore(REDIS_ALL_OPENAI_KEY, token)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose(close_connection_pool=True)
+            self._client = None
+
+
 redis_conn = RedisUtil()
+redis_async = AsyncRedisUtil()
 
 
 if __name__ == "__main__":
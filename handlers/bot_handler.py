@@ -28,8 +28,9 @@ async def help_command(update: Update, context: CallbackContext):
     help_text = """
 Here are the commands you can use:
 /start - Start the bot
-/summarize - Summarize a web url
-/backup - Backup a web url
+/summarize - Summarize web urls (or the links in the replied message), append "force" to skip the cache
+/stats - Show summary cache, url job queue, backup, page cache, GitHub and AI provider stats
+/backup - Backup web urls (or the links in the replied message), replies with the GitHub file / page links of the selenium snapshot and the Wayback Machine url; append "selenium" or "wayback" to run only one, "mobile" to render as mobile
 /hack - Hack a token
 /validate - Validate a token
 /cron_info - Show cron info
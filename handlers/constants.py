@@ -8,6 +8,31 @@ error_title = '‼️‼️*\[Error Notify\]*‼️‼️\n'
 cron_title = '⏱️⏱️*\[Cron Notify\]*⏱️⏱️\n'
 
 REDIS_ALL_OPENAI_KEY = 'all_openai_key'
+REDIS_SUMMARY_CACHE_PREFIX = 'summary_cache:'
+REDIS_SUMMARY_CACHE_URL_PREFIX = 'summary_cache_url:'
+REDIS_SUMMARY_CACHE_INDEX = 'summary_cache_index'
+REDIS_SUMMARY_CACHE_STATS = 'summary_cache_stats'
+REDIS_PAGE_CACHE_PREFIX = 'page_cache:'
+REDIS_PAGE_CACHE_INDEX = 'page_cache_index'
+REDIS_PAGE_CACHE_SIZES = 'page_cache_sizes'
+REDIS_PAGE_CACHE_BYTES = 'page_cache_bytes'
+REDIS_PAGE_CACHE_STATS = 'page_cache_stats'
+REDIS_SINGLEFLIGHT_LOCK_PREFIX = 'singleflight_lock:'
+REDIS_SINGLEFLIGHT_RESULT_PREFIX = 'singleflight_result:'
+REDIS_URL_JOB_STREAM = 'url_job_stream'
+REDIS_URL_JOB_GROUP = 'url_workers'
+REDIS_URL_JOB_DEAD = 'url_job_dead'
+REDIS_URL_JOB_RESULTS = 'url_job_results'
+REDIS_URL_JOB_RESULT_GROUP = 'bot'
+REDIS_BACKUP_QUEUE = 'backup_queue'
+REDIS_BACKUP_PROCESSING = 'backup_queue_processing'
+REDIS_BACKUP_ATTEMPTS = 'backup_queue_attempts'
+REDIS_BACKUP_REPLY_PREFIX = 'backup_reply:'
+REDIS_WAYBACK_PENDING = 'wayback_pending'
+REDIS_LEADER_LOCK = 'bot_leader_lock'
+REDIS_BACKUP_DIGEST_INDEX = 'backup_digest_index'
+REDIS_BACKUP_DIGEST_STATS = 'backup_digest_stats'
+REDIS_BACKUP_PATH_INDEX = 'backup_path_index'
 
 REDIS_MODE, WAIT_SINGLE_INPUT = range(2)
 ADD_TOKEN, REMOVE_TOKEN, SET_CACHE, REMOVE_CACHE, HACK_TOKEN = range(5)
@@ -23,6 +48,8 @@ CALLBACK_OPENKEY_ADDTOKEN = 'openKey_addToken'
 CALLBACK_OPENKEY_REMOVETOKEN = 'openKey_removeToken'
 CALLBACK_OPENKEY_SETCACHE = 'openKey_setCache'
 CALLBACK_OPENKEY_REMOVECACHE = 'openKey_removeCache'
+CALLBACK_REDIS_SCAN = 'redis_scan'
+CALLBACK_REDIS_PAGE = 'redis_page'
 
 
 COMMAND_START = 'start'
@@ -39,6 +66,7 @@ COMMAND_VALIDATE = 'validate'
 COMMAND_CRON_INFO = 'cron_info'
 COMMAND_CRON_UPDATE = 'cron_update'
 COMMAND_HELP = 'help'
+COMMAND_STATS = 'stats'
 
 
 CRON_REQUEST_OPENKEY = 'cron_request_openkey'
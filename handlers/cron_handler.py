@@ -1,3 +1,4 @@
+import asyncio
 import io
 import time
 
@@ -12,22 +13,26 @@ from telegram.helpers import escape_markdown
 
 from config import config
 from config.config import configInstance
-from db.redis_util import redis_conn
+from db.redis_util import redis_conn, redis_async
 from handlers.constants import *
 from openkey.openai_key import validate_openai_key, OpenaiKey
 from logger.logger_config import setup_logger
 
 logger = setup_logger('cron')
 
-# cron
+# cron，定时任务在 bot 的事件循环中执行，阻塞的网络请求需要放到线程池中执行
 custom_scheduler = AsyncIOScheduler()
 
 
+async def run_blocking(func, *args):
+    return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+
 async def cron_validate_openkey(application):
     logger.info('Cron job validate open key start. ')
     try:
-        expire_tokens = list_keys_from_cf(configInstance.cf_account_id,
-                                          configInstance.cf_namespace_id, configInstance.cf_api_key, 'sk')
+        expire_tokens = await run_blocking(list_keys_from_cf, configInstance.cf_account_id,
+                                           configInstance.cf_namespace_id, configInstance.cf_api_key, 'sk')
         logger.info(f'Expire tokens: {expire_tokens}')
     except Exception as e:
         logger.error('List expire tokens failed:', e)
@@ -40,13 +45,13 @@ async def cron_validate_openkey(application):
         if count > 20:
             break
         count += 1
-        token = redis_conn.get_random_token()
+        token = await redis_async.get_random_token()
         if token not in expire_tokens:
             break
 
     if token is not None:
         try:
-            validate_res = validate_openai_key(token)
+            validate_res = await run_blocking(validate_openai_key, token)
             if not validate_res:
                 expire_tokens.append(token)
         except Exception as e:
@@ -54,9 +59,9 @@ async def cron_validate_openkey(application):
     if len(expire_tokens) > 0:
         expire_str = '\n'.join(expire_tokens)
         msg = f'{cron_title}*{escape_markdown(expire_str, 2)}*\nis invalid and removed'
-        redis_conn.remove_token(*expire_tokens)
-        delete_keys_from_cf(expire_tokens, configInstance.cf_account_id,
-                            configInstance.cf_namespace_id, configInstance.cf_api_key)
+        await redis_async.remove_token(*expire_tokens)
+        await run_blocking(delete_keys_from_cf, expire_tokens, configInstance.cf_account_id,
+                           configInstance.cf_namespace_id, configInstance.cf_api_key)
         await application.bot.send_message(chat_id=DEVELOPER_CHAT_ID, text=msg, parse_mode=ParseMode.MARKDOWN_V2)
         logger.info(f'OpenKey: {expire_tokens} is invalid and removed.')
 
@@ -65,7 +70,8 @@ async def cron_request_openkey(application):
     logger.info('Cron job request open key start. ')
     openai_key = OpenaiKey()
     try:
-        tokens = openai_key.hack_openai_token(1)
+        # 申请过程中会等待邮件，redis 操作使用同步客户端，整体在线程池中执行
+        tokens = await run_blocking(openai_key.hack_openai_token, 1)
         msg = f'\nRequest new tokens: {tokens}'
     except Exception as e:
         logger.error(e)
@@ -79,7 +85,7 @@ async def cron_hack_openkey(application):
     logger.info('Cron job hack open key start. ')
     openai_key = OpenaiKey()
     try:
-        tokens = openai_key.hack_openai_token_via_plus_gmail(1)
+        tokens = await run_blocking(openai_key.hack_openai_token_via_plus_gmail, 1)
         msg = f'\nHack new tokens: {tokens}'
     except Exception as e:
         logger.error(e)
@@ -94,7 +100,7 @@ async def cron_sync_kv(application):
     now = time.time()
     start = now - TOKEN_EXPIRE
     end = now - TOKEN_REQ_INTERVAL * 2
-    tokens = redis_conn.get_all_tokens(start, end)
+    tokens = await redis_async.get_all_tokens(start, end)
     logger.info(f'Size of {REDIS_ALL_OPENAI_KEY} from {start} to {end}: {len(tokens)}')
     if not tokens:
         msg = f'No OpenKey in {REDIS_ALL_OPENAI_KEY}, res: {tokens}'
@@ -109,10 +115,8 @@ async def cron_sync_kv(application):
     # 将列表转为用逗号分隔的字符串
     concat = ','.join(normal_strings)
     try:
-        put_kv_to_cf(REDIS_ALL_OPENAI_KEY, concat,
-                     cf_api_key=configInstance.cf_api_key,
-                     account_id=configInstance.cf_account_id,
-                     namespace_id=configInstance.cf_namespace_id)
+        await run_blocking(put_kv_to_cf, REDIS_ALL_OPENAI_KEY, concat, configInstance.cf_account_id,
+                           configInstance.cf_namespace_id, configInstance.cf_api_key)
     except Exception as e:
         msg = f'Cron job [sync_kv] error! \nError: {e}'
         text = f'{cron_title}{escape_markdown(msg, 2)}'
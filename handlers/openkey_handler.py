@@ -1,3 +1,4 @@
+import asyncio
 import datetime
 
 from telegram import Update, InlineKeyboardButton, ForceReply, InlineKeyboardMarkup
@@ -5,7 +6,7 @@ from telegram.constants import ParseMode
 from telegram.ext import CallbackContext
 from telegram.helpers import escape_markdown
 
-from db.redis_util import redis_conn
+from db.redis_util import redis_async
 from handlers.constants import *
 from handlers.constants import DEVELOPER_CHAT_ID, operation_title, REDIS_ALL_OPENAI_KEY, ADD_TOKEN, REMOVE_TOKEN, \
     SET_CACHE, REMOVE_CACHE, HACK_TOKEN
@@ -17,21 +18,21 @@ logger = setup_logger(__name__)
 
 async def remove_a_openai_token(update: Update, context: CallbackContext) -> None:
     key = context.args[0]
-    res = redis_conn.remove_token(key)
+    res = await redis_async.remove_token(key)
     data = f"{operation_title}Remove token {escape_markdown(key, 2)}\nres:\n{escape_markdown(str(res) if res else 'No Message', 2)}"
     await update.message.reply_text(data, parse_mode=ParseMode.MARKDOWN_V2)
 
 
 async def add_a_openai_token(update: Update, context: CallbackContext) -> None:
     key = context.args[0]
-    res = redis_conn.add_token(key)
+    res = await redis_async.add_token(key)
     data = f"{operation_title}Add token {escape_markdown(key, 2)}\nres:\n{escape_markdown(str(res) if res else 'No Message', 2)}"
     await update.message.reply_text(data, parse_mode=ParseMode.MARKDOWN_V2)
 
 
 async def remove_a_cache(update: Update, context: CallbackContext) -> None:
     key = context.args[0]
-    res = redis_conn.delete(key)
+    res = await redis_async.delete(key)
     data = f"{operation_title}Remove cache {escape_markdown(key, 2)}\nres: {escape_markdown(str(res) if res else 'No Message', 2)}"
     await update.message.reply_text(data, parse_mode=ParseMode.MARKDOWN_V2)
 
@@ -40,8 +41,8 @@ async def set_a_cache(update: Update, context: CallbackContext) -> None:
     key = context.args[0]
     expire = context.args[1]
     value = context.args[2]
-    data = redis_conn.setex(key, value, expire)
-    data = f"{operation_title}Set cache {escape_markdown(key, 2)} with expire {escape_markdown(expire, 2)} and value {escape_markdown(value, 2)}\nres: {escape_markdown(str(res) if data else 'No Message', 2)}"
+    res = await redis_async.setex(key, value, expire)
+    data = f"{operation_title}Set cache {escape_markdown(key, 2)} with expire {escape_markdown(expire, 2)} and value {escape_markdown(value, 2)}\nres: {escape_markdown(str(res) if res else 'No Message', 2)}"
     await update.message.reply_text(data, parse_mode=ParseMode.MARKDOWN_V2)
 
 
@@ -94,7 +95,7 @@ async def openKey_random(update: Update, context: CallbackContext) -> None:
         [InlineKeyboardButton("⏪️Back", callback_data=CALLBACK_OPENKEY)]
     ]
     data = operation_title
-    res = redis_conn.get_random_token()
+    res = await redis_async.get_random_token()
     if data is None:
         data += 'No token found\\!'
     else:
@@ -107,7 +108,7 @@ async def openKey_listAllTokens(update: Update, context: CallbackContext):
     keyboard = [
         [InlineKeyboardButton("⏪️Back", callback_data=CALLBACK_OPENKEY)]
     ]
-    tokens_set = redis_conn.get_all_tokens()
+    tokens_set = await redis_async.get_all_tokens()
     tokens = list(tokens_set)
     await update.callback_query.edit_message_text(f'Totally {len(tokens)}, random 5 keys:\n{tokens[:5]}',
                                                   reply_markup=InlineKeyboardMarkup(keyboard))
@@ -117,7 +118,7 @@ async def openKey_listAllKeys(update: Update, context: CallbackContext):
     keyboard = [
         [InlineKeyboardButton("⏪️Back", callback_data=CALLBACK_OPENKEY)]
     ]
-    keys_set = redis_conn.keys()
+    keys_set = await redis_async.keys()
     statis = statistics(keys_set)
     origin_gmails = list(filter(lambda x: x.endswith('gmail.com') and '+' not in x, keys_set))
     origin_gmails_str = '\n'.join(origin_gmails)
@@ -167,7 +168,8 @@ async def openKey(update: Update, context: CallbackContext):
 async def hack_openkey(update: Update, context: CallbackContext):
     openai_key = OpenaiKey()
     try:
-        tokens = openai_key.hack_openai_token_via_plus_gmail(1)
+        # 申请过程中会等待邮件，放到线程池中执行，不阻塞事件循环
+        tokens = await asyncio.get_event_loop().run_in_executor(None, openai_key.hack_openai_token_via_plus_gmail, 1)
         msg = f'\nNew tokens: {tokens}'
     except Exception as e:
         logger.error(e)
@@ -178,10 +180,10 @@ async def hack_openkey(update: Update, context: CallbackContext):
 
 async def validate_openkey(update: Update, context: CallbackContext):
     token = context.args[0]
-    response = validate_openai_key_with_res(token)
+    response = await asyncio.get_event_loop().run_in_executor(None, validate_openai_key_with_res, token)
     res = response.text
     if 'Error' in res:
-        redis_conn.remove_token(token)
+        await redis_async.remove_token(token)
         logger.info(f'Remove invalid token: {token}')
     msg = f'{operation_title}{escape_markdown(res if res else "No response", 2)}'
     await update.message.reply_text(text=msg, parse_mode=ParseMode.MARKDOWN_V2)
@@ -196,21 +198,21 @@ async def handle_callback_input(update: Update, context: CallbackContext):
             if len(inputs) != 1:
                 await update.message.reply_text('Please reply with right format.')
                 return
-            res = redis_conn.add_token(inputs[0])
+            res = await redis_async.add_token(inputs[0])
             await update.message.reply_text(f'You add token: {inputs[0]}, res: {res}')
             context.user_data['handled'] = True
         elif action == REMOVE_TOKEN:
             if len(inputs) != 1:
                 await update.message.reply_text('Please reply with right format.')
                 return
-            res = redis_conn.remove_token(inputs[0])
+            res = await redis_async.remove_token(inputs[0])
             await update.message.reply_text(f'You remove token: {inputs[0]}, res: {res}')
             context.user_data['handled'] = True
         elif action == SET_CACHE:
             if len(inputs) != 3:
                 await update.message.reply_text('Please reply with right format.')
                 return
-            res = redis_conn.setex(inputs[0], inputs[2], inputs[1])
+            res = await redis_async.setex(inputs[0], inputs[2], inputs[1])
             await update.message.reply_text(
                 f'You set cache: {inputs[0]}, value: {inputs[2]}, expire in {inputs[1]}, res: {res}')
             context.user_data['handled'] = True
@@ -218,7 +220,7 @@ async def handle_callback_input(update: Update, context: CallbackContext):
             if len(inputs) != 1:
                 await update.message.reply_text('Please reply with right format.')
                 return
-            res = redis_conn.delete(inputs[0])
+            res = await redis_async.delete(inputs[0])
             await update.message.reply_text(f'You remove cache: {inputs[0]}, res: {res}')
             context.user_data['handled'] = True
         elif action == HACK_TOKEN:
@@ -226,7 +228,7 @@ async def handle_callback_input(update: Update, context: CallbackContext):
                 await update.message.reply_text('Please reply with right format.')
                 return
             openai_key = OpenaiKey()
-            res = openai_key.read_code_and_request_key(inputs[0])
+            res = await asyncio.get_event_loop().run_in_executor(None, openai_key.read_code_and_request_key, inputs[0])
             if isinstance(res, list):
                 res = '\n'.join(res)
             await update.message.reply_text(f'Get token from {inputs[0]}, res:\n{res}')
@@ -1,18 +1,49 @@
-from telegram import Update
-from telegram.constants import ParseMode
+import gzip
+import shlex
+import tempfile
+import uuid
+from typing import AsyncIterator, Iterable, List, Optional, Tuple
+
+from redis.exceptions import RedisError
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode, MessageLimit
 from telegram.ext import CallbackContext, ConversationHandler, ContextTypes
 from telegram.helpers import escape_markdown
 
-from db.redis_util import redis_conn
-from handlers.constants import REDIS_MODE
+from config.config import configInstance
+from db.redis_util import redis_async
+from handlers.constants import REDIS_MODE, CALLBACK_REDIS_SCAN, CALLBACK_REDIS_PAGE
 from handlers.constants import status_title, operation_title
 from logger.logger_config import setup_logger
 
 logger = setup_logger('redis')
 
+# 一次提交的脚本最多包含的命令数
+MAX_SCRIPT_COMMANDS = 100
+# scan 每页的条数，同时作为 SCAN 的 COUNT 参数
+SCAN_PAGE_SIZE = 50
+# 凑满一页最多执行的 SCAN 次数，MATCH 很稀疏时避免一页扫描太久
+SCAN_MAX_ROUNDS = 10
+# 每个 chat 保留的 scan 游标数，更早的 next 按钮失效
+MAX_SCAN_STATES = 20
+SCAN_COMMANDS = ('scan', 'hscan', 'sscan', 'zscan')
+# 结果超过该页数时改为发送 gzip 附件
+RESULT_MAX_PAGES = 10
+# 每个 chat 保留的分页结果数，更早结果的翻页按钮失效
+MAX_RESULT_STATES = 10
+# 单行结果的最大字符数，转义后仍能放进一页
+MAX_LINE_CHARS = 1500
+# 分批读取大集合时每次读取的条数
+RESULT_CHUNK = 1000
+# 附件在内存中缓冲的最大字节数，超出后写入临时文件
+SPOOL_MEMORY_BYTES = 1024 * 1024
+
 
 async def start_redis(update: Update, context: CallbackContext):
-    msg = status_title + escape_markdown('You are now in Redis mode. Use /closeredis to exit.', 2)
+    msg = status_title + escape_markdown('You are now in Redis mode. Use /closeredis to exit.\n'
+                                         'Send several lines to run them in one pipeline, wrap them in MULTI / EXEC '
+                                         'to run them as a transaction. Use scan / hscan / sscan / zscan '
+                                         '[key] [MATCH pattern] [COUNT n] [TYPE type] to page through keys.', 2)
     if update.callback_query:
         await context.bot.send_message(chat_id=update.effective_chat.id, text=msg, parse_mode=ParseMode.MARKDOWN_V2)
     else:
@@ -63,16 +94,20 @@ def remove_job_if_exists(name: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
 async def handleRedis(update: Update, context: CallbackContext) -> int:
     logger.info('Received command: ' + update.message.text)
     try:
-        command_line = update.message.text.split()
-        command = command_line[0]
-        args = command_line[1:]
-        result = getattr(redis_conn.client, command)(*args)
-        if result is None:
-            msg = operation_title + escape_markdown(f"[{' '.join(command_line)}]\nCommand executed with no result.", 2)
+        commands, transaction = parse_script(update.message.text)
+        if len(commands) == 1 and commands[0][0].lower() in SCAN_COMMANDS + ('keys',):
+            await start_scan(update, context, commands[0])
+        elif len(commands) == 1 and not transaction:
+            command_line = commands[0]
+            await reply_result(update, context, f"[{' '.join(command_line)}]\nCommand executed with result:",
+                               iter_command_result(command_line),
+                               empty_title=f"[{' '.join(command_line)}]\nCommand executed with no result.")
         else:
-            msg = operation_title + escape_markdown(
-                f"[{' '.join(command_line)}]\nCommand executed with result: {result}", 2)
-        await update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN_V2)
+            results = await run_script(commands, transaction)
+            lines = [f"{i + 1}. [{' '.join(command)}] {'error: ' if isinstance(result, Exception) else ''}{result}"
+                     for i, (command, result) in enumerate(zip(commands, results))]
+            title = 'Transaction' if transaction else 'Pipeline'
+            await reply_result(update, context, f"{title} of {len(commands)} commands executed:", iterate(lines))
         reset_timer(update, context)
     except Exception as e:
         msg = operation_title + f"Command execute with error: {escape_markdown(str(e), 2)}"
@@ -80,3 +115,345 @@ async def handleRedis(update: Update, context: CallbackContext) -> int:
     return REDIS_MODE
 
 
+def parse_script(text: str) -> Tuple[List[List[str]], bool]:
+    """把消息解析为命令列表，每行一条命令，参数可以用引号包含空格
+
+    第一行为 MULTI、最后一行为 EXEC 时作为事务执行
+    :return: (命令列表, 是否事务)
+    """
+    commands = [shlex.split(line) for line in text.splitlines() if line.strip()]
+    if not commands:
+        raise ValueError('Empty command')
+    transaction = commands[0][0].lower() == 'multi'
+    if transaction:
+        if commands[-1][0].lower() != 'exec' or len(commands) < 3:
+            raise ValueError('A transaction must start with MULTI and end with EXEC')
+        commands = commands[1:-1]
+    if len(commands) > MAX_SCRIPT_COMMANDS:
+        raise ValueError(f'At most {MAX_SCRIPT_COMMANDS} commands can be sent at once')
+    if len(commands) > 1 or transaction:
+        for command in commands:
+            name = command[0].lower()
+            if name in ('multi', 'exec', 'discard', 'watch', 'keys') or name in SCAN_COMMANDS:
+                raise ValueError(f'{command[0]} is not allowed in a script, send it as a single command')
+    return commands, transaction
+
+
+async def run_script(commands: List[List[str]], transaction: bool) -> list:
+    """在一个 pipeline（或 MULTI / EXEC 事务）中执行所有命令，只需要一次往返
+
+    执行时出错的命令不影响其他命令，错误作为该命令的结果返回；事务中有命令无法入队时整个事务不执行
+    """
+    async with redis_async.pipeline(transaction=transaction) as pipe:
+        for command in commands:
+            pipe.execute_command(*command)
+        return await pipe.execute(raise_on_error=False)
+
+
+def parse_scan(command_line: List[str]) -> dict:
+    """解析 scan 命令，游标可以省略；keys pattern 转换为 scan MATCH pattern，避免 KEYS 阻塞 redis"""
+    name = command_line[0].lower()
+    args = command_line[1:]
+    if name == 'keys':
+        if len(args) > 1:
+            raise ValueError('Usage: keys [pattern]')
+        return {'command': 'scan', 'key': None, 'cursor': 0,
+                'match': args[0] if args else None, 'count': SCAN_PAGE_SIZE, 'type': None}
+    scan = {'command': name, 'key': None, 'cursor': 0, 'match': None, 'count': SCAN_PAGE_SIZE, 'type': None}
+    if name != 'scan':
+        if not args:
+            raise ValueError(f'Usage: {name} key [cursor] [MATCH pattern] [COUNT n]')
+        scan['key'] = args.pop(0)
+    if args and args[0].isdigit():
+        scan['cursor'] = int(args.pop(0))
+    while args:
+        option = args.pop(0).lower()
+        if option not in ('match', 'count', 'type') or not args or (option == 'type' and name != 'scan'):
+            raise ValueError(f'Unknown option {option} for {name}')
+        value = args.pop(0)
+        scan[option] = int(value) if option == 'count' else value
+    return scan
+
+
+async def scan_page(scan: dict) -> Tuple[int, List[str]]:
+    """从 scan['cursor'] 开始执行 SCAN 系列命令，直到凑满一页或者遍历结束
+
+    :return: (下一页的游标，0 表示已经遍历结束, 这一页的条目)
+    """
+    client = redis_async.client
+    cursor = scan['cursor']
+    items = []
+    for _ in range(SCAN_MAX_ROUNDS):
+        if scan['command'] == 'scan':
+            cursor, keys = await client.scan(cursor, match=scan['match'], count=scan['count'], _type=scan['type'])
+            items.extend(keys)
+        elif scan['command'] == 'hscan':
+            cursor, fields = await client.hscan(scan['key'], cursor, match=scan['match'], count=scan['count'])
+            items.extend(f'{field}: {value}' for field, value in fields.items())
+        elif scan['command'] == 'sscan':
+            cursor, members = await client.sscan(scan['key'], cursor, match=scan['match'], count=scan['count'])
+            items.extend(members)
+        else:
+            cursor, members = await client.zscan(scan['key'], cursor, match=scan['match'], count=scan['count'])
+            items.extend(f'{member}: {score:g}' for member, score in members)
+        if cursor == 0 or len(items) >= scan['count']:
+            break
+    return cursor, items
+
+
+def save_scan(context: CallbackContext, scan: dict) -> str:
+    """保存游标，返回写入 next 按钮的 id（callback_data 最长 64 字节，不能直接放入命令）"""
+    scans = context.chat_data.setdefault('redis_scans', {})
+    while len(scans) >= MAX_SCAN_STATES:
+        scans.pop(next(iter(scans)))
+    scan_id = uuid.uuid4().hex[:12]
+    scans[scan_id] = scan
+    return scan_id
+
+
+def render_scan(scan: dict, cursor: int, items: List[str], note: Optional[str] = None) -> str:
+    target = f"{scan['command']} {scan['key'] or ''}".strip()
+    if scan['match']:
+        target += f" MATCH {scan['match']}"
+    header = f"[{target}] page {scan['page']}, {len(items)} items, " \
+             f"{'more available' if cursor else 'scan finished'}:"
+    msg = operation_title + escape_markdown((note + '\n' if note else '') + header, 2)
+    for item in items:
+        line = '\n' + escape_markdown(item, 2)
+        # 留出省略号的位置
+        if len(msg) + len(line) > MessageLimit.MAX_TEXT_LENGTH - 8:
+            msg += '\n' + escape_markdown('...', 2)
+            break
+        msg += line
+    return msg
+
+
+def scan_keyboard(scan_id: str, cursor: int) -> Optional[InlineKeyboardMarkup]:
+    if cursor == 0:
+        return None
+    return InlineKeyboardMarkup([[InlineKeyboardButton('Next page ▶️', callback_data=f'{CALLBACK_REDIS_SCAN}:{scan_id}')]])
+
+
+async def start_scan(update: Update, context: CallbackContext, command_line: List[str]) -> None:
+    scan = parse_scan(command_line)
+    scan['page'] = 1
+    note = None
+    if command_line[0].lower() == 'keys':
+        note = 'KEYS blocks redis on large keyspaces, paging with SCAN instead.'
+    cursor, items = await scan_page(scan)
+    scan_id = save_scan(context, {**scan, 'cursor': cursor})
+    await update.message.reply_text(render_scan(scan, cursor, items, note), parse_mode=ParseMode.MARKDOWN_V2,
+                                     reply_markup=scan_keyboard(scan_id, cursor))
+
+
+async def next_scan_page(update: Update, context: CallbackContext) -> int:
+    """next 按钮：从保存的游标继续 scan，在原消息中显示下一页"""
+    query = update.callback_query
+    scan_id = query.data.split(':', 1)[1]
+    scan = context.chat_data.get('redis_scans', {}).pop(scan_id, None)
+    if scan is None:
+        await query.answer('This scan has expired, please run it again.')
+        return REDIS_MODE
+    await query.answer()
+    try:
+        scan['page'] += 1
+        cursor, items = await scan_page(scan)
+    except RedisError as e:
+        await query.edit_message_text(operation_title + f"Command execute with error: {escape_markdown(str(e), 2)}",
+                                      parse_mode=ParseMode.MARKDOWN_V2)
+        return REDIS_MODE
+    scan_id = save_scan(context, {**scan, 'cursor': cursor})
+    await query.edit_message_text(render_scan(scan, cursor, items), parse_mode=ParseMode.MARKDOWN_V2,
+                                  reply_markup=scan_keyboard(scan_id, cursor))
+    reset_timer(update, context)
+    return REDIS_MODE
+
+
+def result_lines(result) -> Iterable[str]:
+    """把命令结果逐行展开：hash 每行一个 field，集合和列表每行一个元素，带分数的 zset 成员显示分数"""
+    if result is None:
+        return
+    if isinstance(result, dict):
+        for key, value in result.items():
+            yield f'{key}: {value}'
+    elif isinstance(result, (list, tuple, set)):
+        for item in result:
+            if isinstance(item, tuple) and len(item) == 2:
+                yield f'{item[0]}: {item[1]}'
+            else:
+                yield str(item)
+    else:
+        yield str(result)
+
+
+async def iterate(lines: Iterable[str]) -> AsyncIterator[str]:
+    for line in lines:
+        yield line
+
+
+async def iter_command_result(command_line: List[str]) -> AsyncIterator[str]:
+    """执行单条命令并逐行返回结果
+
+    smembers、hgetall 以及 lrange、zrange 按下标的查询分批读取，结果不需要一次全部放在内存中，
+    写入附件时达到字节上限后也不再继续读取
+    """
+    client = redis_async.client
+    name = command_line[0].lower()
+    args = command_line[1:]
+    if name == 'smembers' and len(args) == 1:
+        async for member in client.sscan_iter(args[0], count=RESULT_CHUNK):
+            yield member
+        return
+    if name == 'hgetall' and len(args) == 1:
+        async for field, value in client.hscan_iter(args[0], count=RESULT_CHUNK):
+            yield f'{field}: {value}'
+        return
+    withscores = name == 'zrange' and len(args) == 4 and args[3].lower() == 'withscores'
+    if name in ('lrange', 'zrange') and (len(args) == 3 or withscores) \
+            and all(arg.lstrip('-').isdigit() for arg in args[1:3]):
+        key = args[0]
+        length = await (client.llen(key) if name == 'lrange' else client.zcard(key))
+        # 按 redis 的规则把负数下标转换为正数
+        start, stop = (int(arg) + length if int(arg) < 0 else int(arg) for arg in args[1:3])
+        start = max(start, 0)
+        stop = min(stop, length - 1)
+        for chunk_start in range(start, stop + 1, RESULT_CHUNK):
+            chunk_stop = min(chunk_start + RESULT_CHUNK - 1, stop)
+            if name == 'lrange':
+                chunk = await client.lrange(key, chunk_start, chunk_stop)
+            else:
+                chunk = await client.zrange(key, chunk_start, chunk_stop, withscores=withscores)
+            for line in result_lines(chunk):
+                yield line
+        return
+    for line in result_lines(await client.execute_command(*command_line)):
+        yield line
+
+
+class GzipResultFile:
+    """逐行写入的 gzip 附件，内容先缓冲在内存中，超过 SPOOL_MEMORY_BYTES 后写入临时文件
+
+    压缩后的大小达到 max_bytes 时停止写入，附件末尾注明结果被截断
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.raw = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES)
+        self.gzip = gzip.GzipFile(fileobj=self.raw, mode='wb')
+        self.lines = 0
+        self.truncated = False
+
+    def write(self, line: str) -> bool:
+        """写入一行，达到大小上限时返回 False"""
+        if self.raw.tell() >= self.max_bytes:
+            self.truncated = True
+            self.gzip.write(f'... truncated after {self.lines} lines ({self.max_bytes} bytes)\n'.encode('utf-8'))
+            return False
+        self.gzip.write((line + '\n').encode('utf-8'))
+        self.lines += 1
+        return True
+
+    def finish(self):
+        self.gzip.close()
+        self.raw.seek(0)
+        return self.raw
+
+    def close(self):
+        self.gzip.close()
+        self.raw.close()
+
+
+async def reply_result(update: Update, context: CallbackContext, title: str, lines: AsyncIterator[str],
+                       empty_title: Optional[str] = None) -> None:
+    """回复命令结果：放得下时一条消息；较长时拆分为多页，用按钮翻页；
+    超过 RESULT_MAX_PAGES 页时逐行写入 gzip 附件发送
+    """
+    header = operation_title + escape_markdown(title, 2)
+    # 每页预留页码的位置
+    budget = MessageLimit.MAX_TEXT_LENGTH - len(header) - 32
+    pages = []
+    page = ''
+    # 已经分页的原始内容，改为附件时写入
+    buffered = []
+    attachment = None
+    count = 0
+    try:
+        async for line in lines:
+            count += 1
+            if len(line) > MAX_LINE_CHARS:
+                line = line[:MAX_LINE_CHARS] + '...'
+            if attachment is not None:
+                if not attachment.write(line):
+                    break
+                continue
+            escaped = '\n' + escape_markdown(line, 2)
+            if len(page) + len(escaped) > budget:
+                pages.append(page)
+                page = ''
+                if len(pages) >= RESULT_MAX_PAGES:
+                    attachment = GzipResultFile(configInstance.redis_result_max_bytes)
+                    for buffered_line in buffered:
+                        attachment.write(buffered_line)
+                    buffered = []
+                    pages = []
+                    if not attachment.write(line):
+                        break
+                    continue
+            page += escaped
+            buffered.append(line)
+
+        if attachment is not None:
+            caption = f"{title} {attachment.lines} lines" + (', truncated' if attachment.truncated else '')
+            await update.message.reply_document(document=attachment.finish(), filename='redis_result.txt.gz',
+                                                caption=caption[:MessageLimit.CAPTION_LENGTH])
+            return
+    finally:
+        # 提前结束时停止继续从 redis 读取
+        await lines.aclose()
+        if attachment is not None:
+            attachment.close()
+
+    if count == 0 and empty_title is not None:
+        await update.message.reply_text(operation_title + escape_markdown(empty_title, 2),
+                                        parse_mode=ParseMode.MARKDOWN_V2)
+        return
+    pages.append(page)
+    if len(pages) == 1:
+        await update.message.reply_text(header + pages[0], parse_mode=ParseMode.MARKDOWN_V2)
+        return
+    results = context.chat_data.setdefault('redis_results', {})
+    while len(results) >= MAX_RESULT_STATES:
+        results.pop(next(iter(results)))
+    result_id = uuid.uuid4().hex[:12]
+    results[result_id] = {'header': header, 'pages': pages}
+    await update.message.reply_text(render_result_page(results[result_id], 0), parse_mode=ParseMode.MARKDOWN_V2,
+                                    reply_markup=result_keyboard(result_id, 0, len(pages)))
+
+
+def render_result_page(result: dict, index: int) -> str:
+    return result['header'] + escape_markdown(f" (page {index + 1}/{len(result['pages'])})", 2) + result['pages'][index]
+
+
+def result_keyboard(result_id: str, index: int, total: int) -> InlineKeyboardMarkup:
+    buttons = []
+    if index > 0:
+        buttons.append(InlineKeyboardButton('◀️ Prev', callback_data=f'{CALLBACK_REDIS_PAGE}:{result_id}:{index - 1}'))
+    if index < total - 1:
+        buttons.append(InlineKeyboardButton('Next ▶️', callback_data=f'{CALLBACK_REDIS_PAGE}:{result_id}:{index + 1}'))
+    return InlineKeyboardMarkup([buttons])
+
+
+async def show_result_page(update: Update, context: CallbackContext) -> int:
+    """翻页按钮：在原消息中显示分页结果的另一页"""
+    query = update.callback_query
+    _, result_id, index = query.data.split(':')
+    result = context.chat_data.get('redis_results', {}).get(result_id)
+    if result is None:
+        await query.answer('This result has expired, please run the command again.')
+        return REDIS_MODE
+    await query.answer()
+    index = int(index)
+    await query.edit_message_text(render_result_page(result, index), parse_mode=ParseMode.MARKDOWN_V2,
+                                  reply_markup=result_keyboard(result_id, index, len(result['pages'])))
+    reset_timer(update, context)
+    return REDIS_MODE
@@ -1,8 +1,9 @@
-import datetime
+import asyncio
 import re
+import uuid
+from typing import Awaitable, Callable, List, Tuple
 
-import telegram.constants
-from telegram import Update
+from telegram import MessageEntity, Update
 from telegram.constants import ParseMode
 from telegram.ext import CallbackContext
 from telegram.helpers import escape_markdown
@@ -10,135 +11,302 @@ from telegram.helpers import escape_markdown
 from config.config import configInstance
 from handlers.constants import error_title, operation_title, COMMAND_SUMMARIZE, COMMAND_BACKUP
 from logger.logger_config import setup_logger
-from url.snapshot_with_selenium import get_text_by_selenium, get_url_info_by_selenium
-from url.snapshot_with_wayback import snapshot_with_wayback_api
-from url.utils import summarize_content_by_zhipuai, github_repo, summarize_content
-
-retry_times = configInstance.ai_retry_times
+from url.ai_router import summary_router
+from url.backup import BackupReply, backup_stages, collect_backup
+from url.job_queue import url_jobs, JobQueueFullError
+from url.leader import leader
+from url.page_cache import page_cache
+from url.reply import TELEGRAM_MESSAGE_LIMIT, StreamingReply, send_lines, render_progress, \
+    split_markdown
+from url.single_flight import single_flight
+from url.stream_queue import url_stream
+from url.summary import summarize_one
+from url.utils import backup_committer, backup_index, github_repo, summary_cache
 
 logger = setup_logger('url')
 
 
+def parse_urls(update: Update, context: CallbackContext) -> Tuple[List[str], List[str]]:
+    """从命令参数、消息以及被回复（转发）消息的链接中提取 url，按出现顺序去重
+
+    :return: (urls, 其余的命令参数)
+    """
+    urls = []
+    options = []
+    for arg in context.args:
+        if is_url(arg):
+            urls.append(arg)
+        else:
+            options.append(arg.lower())
+    messages = [update.message]
+    if update.message.reply_to_message is not None:
+        messages.append(update.message.reply_to_message)
+    entity_types = [MessageEntity.URL, MessageEntity.TEXT_LINK]
+    for message in messages:
+        entities = {**message.parse_entities(entity_types), **message.parse_caption_entities(entity_types)}
+        for entity, text in entities.items():
+            url = entity.url if entity.type == MessageEntity.TEXT_LINK else text
+            if not re.match(r'^https?://', url, re.IGNORECASE):
+                url = 'https://' + url
+            if is_url(url):
+                urls.append(url)
+    return list(dict.fromkeys(urls)), options
+
+
 async def summarize_url_text(update: Update, context: CallbackContext) -> None:
-    if len(context.args) == 0:
+    urls, options = parse_urls(update, context)
+    if len(urls) == 0:
         await update.message.reply_text(
             f"{error_title}{escape_markdown(f'Please input a url.eg: /{COMMAND_SUMMARIZE} https://www.google.com', 2)}",
             parse_mode=ParseMode.MARKDOWN_V2)
         return
-    url = context.args[0]
-    if not is_url(url):
-        msg = f'{error_title}{escape_markdown("Please input a valid url.", 2)}'
-        await update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN_V2)
+    # force 跳过摘要缓存，重新生成
+    force = 'force' in options
+
+    if configInstance.url_job_backend == 'stream':
+        await publish_url_jobs(update, COMMAND_SUMMARIZE, urls, options)
         return
-    url_content_text = None
 
-    logger.info(f"Begin to summarize {url}")
+    if len(urls) > 1:
+        async def summarize_job(url: str, status: Callable[[str], Awaitable[None]]):
+            summary, cached = await summarize_one(url, force, status)
+            await reply_summary(update, url, summary, cached=cached)
+            return '摘要生成成功' + (' (cached)' if cached else '')
+
+        await run_batch(update, COMMAND_SUMMARIZE, urls, summarize_job)
+        return
+
+    url = urls[0]
+    # 流式模式下在开始抓取时回复一条占位消息，后续进度和摘要都编辑到这条消息中
+    streamer = None
+
+    async def status(text: str):
+        nonlocal streamer
+        if not configInstance.summary_stream:
+            return
+        msg = f"{operation_title}{escape_markdown(url, 2)} {escape_markdown(text, 2)}"
+        if streamer is None:
+            message = await update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN_V2)
+            streamer = StreamingReply(message, configInstance.summary_stream_interval)
+        else:
+            await streamer.edit(msg + '\n\n' + escape_markdown('⏳', 2), force=True)
+
+    async def on_update(text: str):
+        header = f"{operation_title}{escape_markdown(url, 2)} {escape_markdown('摘要生成中...', 2)}\n\n"
+        await streamer.update(header, text)
+
     try:
-        url_content_text = get_text_by_selenium(url)
+        summary, cached = await url_jobs.submit(
+            lambda: summarize_one(url, force, status, on_update if configInstance.summary_stream else None))
     except Exception as e:
-        logger.error(f"😿 文章->{url} selenium 抓取失败! Error: {str(e)}")
-        await update.message.reply_text(
-            f'{operation_title}{escape_markdown(url, 2)} 摘要生成失败!\n\nSave snapshot failed, error: {escape_markdown(str(e), 2)}',
-            parse_mode=ParseMode.MARKDOWN_V2)
-    if url_content_text is None or url_content_text == '':
-        msg = f'{operation_title}{escape_markdown("Selenium failed to get the content of the url.", 2)}'
-        logger.error(f"😿 文章->{url} selenium 抓取失败! 返回结果为 None 或 空字符串")
-        await update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN_V2)
-
-    prompt = configInstance.ai_prompt + "\n" + url_content_text
-    for i in range(retry_times):
-        try:
-            response = summarize_content(prompt, model_name=configInstance.openai_model)
-            logger.info(f"🐱 文章->{url} 摘要第 {i + 1} 次生成成功! Cost: {str(response.usage)}")
-            msg = f"{operation_title}{escape_markdown(url, 2)} 摘要生成成功！\n\n{escape_markdown(response.choices[0].message.content, 2)}"
+        msg = f'{operation_title}{escape_markdown(url, 2)} 摘要生成失败!\n\n{escape_markdown(str(e), 2)}'
+        if streamer is not None:
+            await streamer.edit(msg, force=True)
+        else:
             await update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN_V2)
-            return
-        except Exception as e:
-            logger.error(f"😿 文章->{url} 摘要第 {i + 1} 次生成失败! Error: {str(e)}")
-            continue
-    msg = f'{operation_title}{escape_markdown(url, 2)} 摘要生成失败，请稍后再试。'
-    await update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN_V2)
+        return
+    await reply_summary(update, url, summary, cached=cached, streamer=streamer)
+
+
+async def reply_summary(update: Update, url: str, summary: str, cached: bool = False,
+                        streamer: 'StreamingReply' = None) -> None:
+    header = f"{operation_title}{escape_markdown(url, 2)} 摘要生成成功！{escape_markdown('(cached)', 2) if cached else ''}\n\n"
+    pieces = split_markdown(summary, TELEGRAM_MESSAGE_LIMIT - len(header))
+    if streamer is not None:
+        await streamer.edit(header + pieces[0], force=True)
+    else:
+        await update.message.reply_text(header + pieces[0], parse_mode=ParseMode.MARKDOWN_V2)
+    for piece in pieces[1:]:
+        await update.message.reply_text(piece, parse_mode=ParseMode.MARKDOWN_V2)
+
+
+async def url_stats(update: Update, context: CallbackContext) -> None:
+    """/summarize 和 /backup 流程中各组件的运行状态"""
+    sections = {'summary cache': await summary_cache.stats(), 'jobs': url_jobs.stats()}
+    if configInstance.url_job_backend == 'stream':
+        sections['stream'] = await url_stream.stats()
+    sections['leader'] = {**leader.stats(), 'backup_pending': await backup_committer.pending()}
+    sections['backup dedupe'] = await backup_index.stats()
+    sections['backup stages'] = backup_stages.stats()
+    sections['page cache'] = await page_cache.stats()
+    sections['single flight'] = single_flight.stats()
+    sections['github'] = github_repo.stats()
+    sections['providers'] = summary_router.stats()
+    msg = '\n\n'.join(f'{name}:\n' + '\n'.join([f'{k}: {v}' for k, v in stats.items()])
+                       for name, stats in sections.items())
+    await update.message.reply_text(f"{operation_title}{escape_markdown(msg, 2)}", parse_mode=ParseMode.MARKDOWN_V2)
 
 
 async def save_url(update: Update, context: CallbackContext) -> None:
-    if len(context.args) == 0:
+    urls, options = parse_urls(update, context)
+    if len(urls) == 0:
         await update.message.reply_text(
-            f'{error_title}{escape_markdown("Please input a url.eg: /{COMMAND_BACKUP} https://www.google.com", 2)}',
+            f'{error_title}{escape_markdown(f"Please input a url.eg: /{COMMAND_BACKUP} https://www.google.com", 2)}',
             parse_mode=ParseMode.MARKDOWN_V2)
         return
-    url = context.args[0]
-
-    if not is_url(url):
-        msg = f'{error_title}{escape_markdown("Please input a valid url.", 2)}'
-        await update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN_V2)
-        return
 
     # mobile to use mobile user agent(only selenium)
     # selenium to use selenium to get html
     # wayback to use wayback to get html
     # default to use selenium and wayback
-    args = context.args[1:]
-    mobile = True if 'mobile' in args else False
-    use_selenium = True if 'selenium' in args else False
-    use_wayback = True if 'wayback' in args else False
+    mobile = True if 'mobile' in options else False
+    use_selenium = True if 'selenium' in options else False
+    use_wayback = True if 'wayback' in options else False
     if not use_wayback and not use_selenium:
         use_selenium = True
         use_wayback = True
 
-    url_html = None
-    title = None
+    if configInstance.url_job_backend == 'stream':
+        await publish_url_jobs(update, COMMAND_BACKUP, urls, options)
+        return
 
-    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=telegram.constants.ChatAction.TYPING)
+    if len(urls) > 1:
+        async def backup_job(url: str, status: Callable[[str], Awaitable[None]]):
+            result = await collect_backup(url, mobile, use_selenium, use_wayback, status)
+            if not result.has_files and not result.links and result.wayback != 'pending':
+                raise Exception('; '.join(result.errors))
+            return result
 
-    logger.info(f"Begin to upload {url} to Github.")
-    sg_url = ''
-    sp_url = ''
-    wb_url = ''
-    wg_url = ''
-    wp_url = ''
-    selenium_error = None
-    wayback_error = None
-    if use_selenium:
-        try:
-            url_html, title = get_url_info_by_selenium(url, mobile=mobile)
-            path = f"{configInstance.github_file_prefix}/{title}.html"
-            github_repo.create_or_update_file(path, url_html, f"Add {path}")
-            sg_url = f"https://github.com/{configInstance.github_username}/{configInstance.github_repo}/blob/master/{path}"
-            sp_url = f"https://{configInstance.github_username}.github.io/{configInstance.github_repo}/{path}"
-        except Exception as e:
-            selenium_error = str(e)
+        async def start_reply(progress: 'BatchProgress', results: dict):
+            # 抓取阶段结束后，由 BackupReply 接管进度消息，等待 GitHub 提交和 wayback 快照完成
+            failures = {url: text for url, (icon, text) in progress.states.items() if icon == '❌'}
+            reply = BackupReply.create(progress.streamer.message, progress.urls, results, failures, batch=True)
+            await reply.start(context.bot)
 
-    if use_wayback:
+        await run_batch(update, COMMAND_BACKUP, urls, backup_job, finish=start_reply)
+        return
+
+    url = urls[0]
+    message = await update.message.reply_text(
+        f"{operation_title}{escape_markdown(url, 2)} {escape_markdown('备份中...', 2)}", parse_mode=ParseMode.MARKDOWN_V2)
+
+    async def status(text: str):
+        pass
+
+    results = {}
+    failures = {}
+    try:
+        results[url] = await url_jobs.submit(lambda: collect_backup(url, mobile, use_selenium, use_wayback, status))
+    except Exception as e:
+        failures[url] = str(e)
+    reply = BackupReply.create(message, [url], results, failures, batch=False)
+    await reply.start(context.bot)
+
+
+class BatchProgress:
+    """批量任务的汇总进度，所有 url 的状态编辑到同一条消息中"""
+
+    def __init__(self, command: str, urls: List[str], streamer: StreamingReply):
+        self.command = command
+        self.urls = urls
+        self.streamer = streamer
+        # url -> (状态图标, 说明)
+        self.states = {url: ('🕓', '排队中') for url in urls}
+        # url -> 成功后附加的 MarkdownV2 内容，例如备份链接
+        self.details = {}
+        self._lock = asyncio.Lock()
+
+    def set(self, url: str, icon: str, text: str, detail: str = None):
+        self.states[url] = (icon, text)
+        if detail:
+            self.details[url] = detail
+        else:
+            self.details.pop(url, None)
+
+    def render(self, with_details: bool = True) -> str:
+        return render_progress(self.command, self.urls, self.states, self.details, with_details)
+
+    def render_fit(self) -> str:
+        """放不下所有附加内容时只展示状态"""
+        text = self.render()
+        if len(text) > TELEGRAM_MESSAGE_LIMIT:
+            text = self.render(with_details=False)
+        return text[:TELEGRAM_MESSAGE_LIMIT]
+
+    async def refresh(self, force: bool = False):
+        """中间状态按 streamer 的间隔节流，最终状态强制编辑"""
+        if not force and not self.streamer.can_edit():
+            return
+        async with self._lock:
+            try:
+                await self.streamer.edit(self.render_fit(), force=force)
+            except Exception as e:
+                if force:
+                    raise
+                logger.warning(f"Edit batch progress message failed: {e}")
+
+
+async def run_batch(update: Update, command: str, urls: List[str],
+                    job: Callable[[str, Callable[[str], Awaitable[None]]], Awaitable],
+                    finish: Callable[[BatchProgress, dict], Awaitable[None]] = None) -> None:
+    """把多个 url 提交到 url_jobs 队列，汇总进度编辑到同一条消息中
+
+    job(url, status) 成功时返回说明文字或结果，失败时抛出异常；
+    传入 finish 时由 finish(progress, {url: 结果}) 在所有任务结束后接管进度消息
+    """
+    dropped = urls[configInstance.url_batch_max_urls:]
+    urls = urls[:configInstance.url_batch_max_urls]
+    message = await update.message.reply_text(
+        f"{operation_title}{escape_markdown(f'/{command} {len(urls)} urls...', 2)}", parse_mode=ParseMode.MARKDOWN_V2)
+    progress = BatchProgress(command, urls, StreamingReply(message, configInstance.summary_stream_interval))
+    logger.info(f"Begin batch /{command} with {len(urls)} urls, {len(dropped)} dropped")
+
+    async def run(url: str):
+        async def status(text: str):
+            progress.set(url, '⏳', text)
+            await progress.refresh()
+
+        result = await job(url, status)
+        results[url] = result
+        if finish is None:
+            progress.set(url, '✅', result or '')
+        await progress.refresh()
+
+    results = {}
+    futures = []
+    for url in urls:
+        try:
+            futures.append(url_jobs.submit(lambda url=url: run(url)))
+        except JobQueueFullError as e:
+            progress.set(url, '❌', str(e))
+            futures.append(None)
+    for url, future in zip(urls, futures):
+        if future is None:
+            continue
         try:
-            wayback_json = snapshot_with_wayback_api(url)
-            wb_url = wayback_json['url']
-            wayback_html = wayback_json['text']
-            wayback_html = wayback_html.replace('href="//', 'href="https://')
-            w_path = f"{configInstance.github_file_prefix}/wayback/{transfer_now_time()}.html"
-            github_repo.create_or_update_file(w_path, wayback_html, f"Add {w_path}")
-            wg_url = f"https://github.com/{configInstance.github_username}/{configInstance.github_repo}/blob/master/{w_path}"
-            wp_url = f"https://{configInstance.github_username}.github.io/{configInstance.github_repo}/{w_path}"
+            await future
         except Exception as e:
-            wayback_error = str(e)
-
-    res_msg = f"""
-    {operation_title}{escape_markdown(url, 2)} 
-    备份结果：
-    *[{escape_markdown('selenium_github_url', 2)}]({escape_markdown(sg_url, 2)})*
-    *[{escape_markdown('selenium_page_url', 2)}]({escape_markdown(sp_url, 2)})*
-    *[{escape_markdown('wayback_url', 2)}]({escape_markdown(wb_url, 2)})*
-    *[{escape_markdown('wayback_github_url', 2)}]({escape_markdown(wg_url, 2)})*
-    *[{escape_markdown('wayback_page_url', 2)}]({escape_markdown(wp_url, 2)})*
-    {escape_markdown(selenium_error, 2) if selenium_error else ''}
-    {escape_markdown(wayback_error, 2) if wayback_error else ''}
-    """
-    await update.message.reply_text(res_msg, parse_mode=ParseMode.MARKDOWN_V2)
+            progress.set(url, '❌', str(e))
+    if finish is not None:
+        await finish(progress, results)
+    else:
+        await progress.refresh(force=True)
+        if len(progress.render()) > TELEGRAM_MESSAGE_LIMIT:
+            # 进度消息放不下所有附加内容，另外发送完整结果
+            lines = [f"{escape_markdown(url, 2)} {progress.details[url]}" for url in urls if url in progress.details]
+            await send_lines(update.get_bot(), update.effective_chat.id, lines)
+    if dropped:
+        msg = f'Only the first {len(urls)} urls are processed, ignored:\n' + '\n'.join(dropped)
+        await update.message.reply_text(f"{error_title}{escape_markdown(msg, 2)}", parse_mode=ParseMode.MARKDOWN_V2)
 
 
-def is_url(url):
-    return re.match(r'^https?:/{2}\w.+$', url)
+async def publish_url_jobs(update: Update, command: str, urls: List[str], options: List[str]) -> None:
+    """stream 模式下每个 url 回复一条占位消息，任务发布到 redis stream 由 worker 进程执行，
+    worker 发布的进度和结果由 on_url_job_event 编辑到占位消息中"""
+    dropped = urls[configInstance.url_batch_max_urls:]
+    urls = urls[:configInstance.url_batch_max_urls]
+    for url in urls:
+        message = await update.message.reply_text(
+            f"{operation_title}{escape_markdown(url, 2)} {escape_markdown('排队中...', 2)}",
+            parse_mode=ParseMode.MARKDOWN_V2)
+        job = {'id': uuid.uuid4().hex, 'command': command, 'url': url, 'options': options,
+               'chat_id': message.chat_id, 'message_id': message.message_id}
+        message_id = await url_stream.publish(job)
+        logger.info(f"Published /{command} job {job['id']} for {url} as {message_id}")
+    if dropped:
+        msg = f'Only the first {len(urls)} urls are processed, ignored:\n' + '\n'.join(dropped)
+        await update.message.reply_text(f"{error_title}{escape_markdown(msg, 2)}", parse_mode=ParseMode.MARKDOWN_V2)
 
 
-def transfer_now_time():
-    now = datetime.datetime.now()
-    return now.strftime("%Y%m%d%H%M%S%f")[:-3]
+def is_url(url):
+    return re.match(r'^https?:/{2}\w.+$', url)
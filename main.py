@@ -1,3 +1,4 @@
+import asyncio
 import re
 
 from apscheduler.schedulers.background import BackgroundScheduler
@@ -8,25 +9,79 @@ from telegram.ext import CommandHandler, CallbackQueryHandler, ApplicationBuilde
 from dotenv import load_dotenv
 
 from config.config import configInstance
+from db.redis_util import redis_async
 from handlers.bot_handler import start, log_update, error_handler, help_command
 from handlers.constants import *
 from handlers.cron_handler import cron_validate_openkey, cron_request_openkey, cron_sync_kv, cron_hack_openkey, \
     custom_scheduler, cron_info, cron_update
 from handlers.openkey_handler import *
-from handlers.redis_handler import start_redis, end_redis_mode, handleRedis
+from handlers.redis_handler import start_redis, end_redis_mode, handleRedis, next_scan_page, \
+    show_result_page
 from handlers.openkey_handler import handle_callback_input
-from handlers.url_handler import summarize_url_text, save_url
+from handlers.url_handler import summarize_url_text, save_url, url_stats
 from logger.logger_config import setup_logger
+from url.backup import on_backup_committed, start_wayback_tracking, stop_wayback_tracking, cancel_background_tasks
+from url.executor import url_executor
+from url.job_queue import url_jobs
+from url.leader import leader
+from url.selenium_pool import selenium_pool
+from url.snapshot_with_wayback import wayback_client
+from url.stream_jobs import on_url_job_event
+from url.stream_queue import url_stream
+from url.utils import ai_clients, backup_committer
+from webhook import run_webhook
 
 logger = setup_logger('main')
 
 TELEGRAM_BOT_TOKEN = configInstance.telegram_bot_token
 
 
+async def post_init(application) -> None:
+    # 后台合并提交备份文件，提交结束后编辑对应的回复消息
+    async def listener(job_ids, sha, error):
+        await on_backup_committed(application.bot, job_ids, sha, error)
+
+    # webhook 模式下可能同时运行多个 bot 副本，合并提交和等待 wayback 快照只能由一个副本执行，
+    # 否则会重复提交同一批文件、重复编辑消息，并且互相删除共用的 processing 列表
+    async def on_elected():
+        backup_committer.start(listener)
+        start_wayback_tracking(application.bot)
+
+    async def on_demoted():
+        await backup_committer.close()
+        await stop_wayback_tracking()
+
+    leader.start(on_elected, on_demoted)
+
+    # url 任务由 worker.py 进程执行时，读取 worker 发布的进度和结果并编辑对应的消息
+    if configInstance.url_job_backend == 'stream':
+        async def on_event(event):
+            await on_url_job_event(application.bot, event)
+
+        await url_stream.start_results(on_event)
+
+
+async def post_shutdown(application) -> None:
+    await url_stream.close()
+    await leader.close()
+    await cancel_background_tasks()
+    await wayback_client.close()
+    await backup_committer.close()
+    await url_jobs.close()
+    url_executor.shutdown()
+    selenium_pool.close()
+    await ai_clients.close()
+    await redis_async.close()
+    logger.info('-------------Bot stopped-------------')
+
+
 def main() -> None:
     application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN) \
         .base_url(configInstance.telegram_bot_api_base) \
+        .update_queue(asyncio.Queue(maxsize=configInstance.telegram_update_queue_size)) \
         .job_queue(JobQueue()) \
+        .post_init(post_init) \
+        .post_shutdown(post_shutdown) \
         .build()
 
     # log and error
@@ -43,7 +98,9 @@ def main() -> None:
             CallbackQueryHandler(start_redis, CALLBACK_START_REDIS),
         ],
         states={
-            REDIS_MODE: [MessageHandler(filters.TEXT & ~filters.COMMAND & custom_filter & ~filters.REPLY, handleRedis)],
+            REDIS_MODE: [MessageHandler(filters.TEXT & ~filters.COMMAND & custom_filter & ~filters.REPLY, handleRedis),
+                         CallbackQueryHandler(next_scan_page, pattern='^' + CALLBACK_REDIS_SCAN + ':'),
+                         CallbackQueryHandler(show_result_page, pattern='^' + CALLBACK_REDIS_PAGE + ':')],
         },
         fallbacks=[CommandHandler(COMMAND_CLOSEREDIS, end_redis_mode)],
         map_to_parent={
@@ -60,10 +117,11 @@ def main() -> None:
     application.add_handler(CallbackQueryHandler(openKey, pattern='^' + CALLBACK_OPENKEY + '$'))
 
     # summarize
+    # 耗时任务不阻塞后续 update 的处理，阻塞操作交给 url_executor 线程池执行
     application.add_handler(
-        CommandHandler(command=COMMAND_SUMMARIZE, callback=summarize_url_text, filters=custom_filter))
+        CommandHandler(command=COMMAND_SUMMARIZE, callback=summarize_url_text, filters=custom_filter, block=False))
     application.add_handler(
-        CommandHandler(command=COMMAND_BACKUP, callback=save_url, filters=custom_filter))
+        CommandHandler(command=COMMAND_BACKUP, callback=save_url, filters=custom_filter, block=False))
 
     application.add_handler(CallbackQueryHandler(openKey_listAllTokens, CALLBACK_OPENKEY_LISTTOKENS))
     application.add_handler(CallbackQueryHandler(openKey_random, CALLBACK_OPENKEY_RANDOM))
@@ -93,6 +151,7 @@ def main() -> None:
     application.add_handler(CommandHandler(filters=custom_filter, command=COMMAND_CRON_INFO, callback=cron_info))
     application.add_handler(CommandHandler(filters=custom_filter, command=COMMAND_CRON_UPDATE, callback=cron_update))
 
+    application.add_handler(CommandHandler(filters=custom_filter, command=COMMAND_STATS, callback=url_stats))
     application.add_handler(CommandHandler(filters=custom_filter, command=COMMAND_HELP, callback=help_command))
 
 
@@ -104,8 +163,12 @@ def main() -> None:
     custom_scheduler.add_job(cron_sync_kv, CronTrigger.from_crontab(configInstance.cron_sync_kv), args=[application], id=CRON_SYNC_KV)
     custom_scheduler.start()
 
-    logger.info('-------------Bot started-------------')
-    application.run_polling()
+    logger.info(f'-------------Bot started ({configInstance.telegram_update_mode})-------------')
+    if configInstance.telegram_update_mode == 'webhook':
+        # 与 run_polling 一样在默认事件循环中运行，update_queue 已经绑定到该循环
+        asyncio.get_event_loop().run_until_complete(run_webhook(application, post_init, post_shutdown))
+    else:
+        application.run_polling()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,225 @@
+import asyncio
+import json
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Callable, Awaitable, List
+
+from config.config import configInstance
+from logger.logger_config import setup_logger
+from url.utils import summarize_content, summarize_content_stream, summarize_content_by_zhipuai
+
+logger = setup_logger('ai_router')
+
+
+class ProviderStats:
+    """记录最近 window 次请求的耗时和成败，用于计算 p50 / p95 耗时和错误率
+
+    对冲落败被取消的请求只知道耗时的下限，作为截断样本记录：排序时计入，慢下来的首选 provider 才会被降级；
+    计算对冲等待时间的 p95 时不计入，避免 p95 被截断的耗时拉低
+    """
+
+    def __init__(self, window: int = 50):
+        # (耗时, 是否为截断样本)
+        self.latencies = deque(maxlen=window)
+        self.results = deque(maxlen=window)
+        # 对冲落败被取消的次数
+        self.cancelled = 0
+
+    def record(self, latency: float, ok: bool):
+        if ok:
+            self.latencies.append((latency, False))
+        self.results.append(ok)
+
+    def record_cancelled(self, latency: float):
+        self.cancelled += 1
+        self.latencies.append((latency, True))
+
+    def percentile(self, p: float, censored: bool = False):
+        """censored 为 True 时包括截断样本"""
+        values = sorted(latency for latency, is_censored in self.latencies if censored or not is_censored)
+        if not values:
+            return None
+        return values[min(len(values) - 1, int(len(values) * p))]
+
+    @property
+    def error_rate(self) -> float:
+        if not self.results:
+            return 0.0
+        return self.results.count(False) / len(self.results)
+
+    def score(self, default_latency: float) -> float:
+        """分数越低越优先：p50 耗时（包括截断样本）按错误率加权，没有数据时使用默认耗时"""
+        p50 = self.percentile(0.5, censored=True)
+        return (p50 if p50 is not None else default_latency) * (1 + 4 * self.error_rate)
+
+    def to_dict(self) -> dict:
+        p50 = self.percentile(0.5)
+        p95 = self.percentile(0.95)
+        return {'p50': f'{p50:.1f}s' if p50 is not None else '-',
+                'p95': f'{p95:.1f}s' if p95 is not None else '-',
+                'error_rate': f'{self.error_rate:.0%}', 'samples': len(self.results), 'cancelled': self.cancelled}
+
+
+class Provider(ABC):
+    def __init__(self, name: str, model: str):
+        self.name = name
+        self.model = model
+        self.stats = ProviderStats()
+
+    @abstractmethod
+    async def complete(self, prompt: str) -> str:
+        pass
+
+    async def stream(self, prompt: str, on_update: Callable[[str], Awaitable[None]]) -> str:
+        """不支持流式输出的 provider 生成完成后一次性回调"""
+        text = await self.complete(prompt)
+        await on_update(text)
+        return text
+
+
+class OpenAIProvider(Provider):
+    async def complete(self, prompt: str) -> str:
+        response = await summarize_content(prompt, model_name=self.model)
+        logger.info(f"[{self.name}] Cost: {str(response.usage)}")
+        return response.choices[0].message.content
+
+    async def stream(self, prompt: str, on_update: Callable[[str], Awaitable[None]]) -> str:
+        text = ''
+        async for delta in summarize_content_stream(prompt, model_name=self.model):
+            text += delta
+            await on_update(text)
+        return text
+
+
+class ZhipuAIProvider(Provider):
+    def __init__(self, name: str, model: str, api_key: str):
+        super().__init__(name, model)
+        self.api_key = api_key
+
+    async def complete(self, prompt: str) -> str:
+        response = await summarize_content_by_zhipuai(prompt, self.api_key, model_name=self.model)
+        if not response.get('success'):
+            raise Exception(f"[{self.name}] {response.get('code')}: {response.get('msg')}")
+        logger.info(f"[{self.name}] Cost: {response['data'].get('usage')}")
+        content = response['data']['choices'][0]['content']
+        # 智谱 v3 接口返回的内容是带引号的 json 字符串
+        if content.startswith('"'):
+            content = json.loads(content)
+        return content.strip()
+
+
+class SummaryRouter:
+    """根据最近的 p50 耗时和错误率选择最优的 provider
+
+    首选 provider 在 p95 耗时内没有返回（或者失败）时，向次选 provider 发起对冲请求，
+    先成功的结果胜出，另一个请求被取消
+    """
+
+    def __init__(self, providers: List[Provider], hedge_min_delay: float, hedge_max_delay: float):
+        self.providers = providers
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_delay = hedge_max_delay
+
+    def ranked(self) -> List[Provider]:
+        if not self.providers:
+            raise Exception('No AI provider configured, please set OPENAI_API_KEY or ZHIPUAI_KEY')
+        return sorted(self.providers, key=lambda p: p.stats.score(self.hedge_max_delay))
+
+    def hedge_delay(self, provider: Provider) -> float:
+        p95 = provider.stats.percentile(0.95)
+        if p95 is None:
+            return self.hedge_max_delay
+        return min(self.hedge_max_delay, max(self.hedge_min_delay, p95))
+
+    async def _call(self, provider: Provider, call: Callable[[], Awaitable]):
+        start = time.monotonic()
+        try:
+            result = await call()
+        except asyncio.CancelledError:
+            # 对冲落败被取消，耗时被截断，只作为耗时的下限参与排序
+            provider.stats.record_cancelled(time.monotonic() - start)
+            raise
+        except Exception as e:
+            provider.stats.record(time.monotonic() - start, False)
+            logger.warning(f"[{provider.name}] request failed: {e}")
+            raise
+        latency = time.monotonic() - start
+        provider.stats.record(latency, True)
+        logger.info(f"[{provider.name}] request done in {latency:.1f}s")
+        return result
+
+    async def complete(self, prompt: str) -> str:
+        ranked = self.ranked()
+        primary = ranked[0]
+        first = asyncio.ensure_future(self._call(primary, lambda: primary.complete(prompt)))
+        tasks = [first]
+        try:
+            if len(ranked) == 1:
+                return await first
+
+            delay = self.hedge_delay(primary)
+            done, _ = await asyncio.wait({first}, timeout=delay)
+            if done and first.exception() is None:
+                return first.result()
+
+            backup = ranked[1]
+            logger.info(f"[{primary.name}] {'failed' if done else f'slower than {delay:.1f}s'}, "
+                        f"hedge with [{backup.name}]")
+            second = asyncio.ensure_future(self._call(backup, lambda: backup.complete(prompt)))
+            tasks.append(second)
+            pending = {second} if done else {first, second}
+            error = first.exception() if done else None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # 取消落败的请求
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def stream(self, prompt: str, on_update: Callable[[str], Awaitable[None]]) -> str:
+        """流式输出无法对冲，按优先级依次尝试，已经有输出后失败则直接抛出"""
+        error = None
+        for provider in self.ranked():
+            started = False
+
+            async def update(text: str):
+                nonlocal started
+                started = True
+                await on_update(text)
+
+            try:
+                return await self._call(provider, lambda: provider.stream(prompt, update))
+            except Exception as e:
+                if started:
+                    raise
+                error = e
+        raise error
+
+    @property
+    def model_key(self) -> str:
+        """参与摘要的全部 provider 及模型，作为摘要缓存 key 的一部分，切换 provider 或模型后不会命中旧缓存"""
+        return ','.join(f'{p.name}:{p.model}' for p in self.providers)
+
+    def stats(self) -> dict:
+        return {f'{p.name}({p.model})': p.stats.to_dict() for p in self.providers}
+
+
+def build_providers() -> List[Provider]:
+    providers = []
+    if configInstance.openai_key:
+        providers.append(OpenAIProvider('openai', configInstance.openai_model))
+    if configInstance.zhipuai_key:
+        providers.append(ZhipuAIProvider('zhipuai', configInstance.zhipuai_model, configInstance.zhipuai_key))
+    return providers
+
+
+summary_router = SummaryRouter(build_providers(),
+                               hedge_min_delay=configInstance.ai_hedge_min_delay,
+                               hedge_max_delay=configInstance.ai_hedge_max_delay)
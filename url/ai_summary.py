@@ -0,0 +1,110 @@
+import asyncio
+import re
+from typing import List, Callable, Awaitable, Optional
+
+from config.config import configInstance
+from logger.logger_config import setup_logger
+from url.ai_router import summary_router
+from url.utils import retry_with_backoff
+
+logger = setup_logger('ai_summary')
+
+cjk_re = re.compile(r'[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]')
+sentence_re = re.compile(r'(?<=[。！？!?；;.])\s*')
+
+# 分段要点最多递归归纳的轮数，模型输出不收敛时避免无限调用
+MAX_REDUCE_ROUNDS = 3
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中日韩字符按 1 个 token 计算，其余字符按 4 个字符 1 个 token 计算"""
+    cjk = len(cjk_re.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def clean_text(text: str) -> str:
+    """去掉网页文本中的空行以及每行首尾的空白"""
+    lines = (line.strip() for line in text.splitlines())
+    return '\n'.join(line for line in lines if line)
+
+
+def split_into_chunks(text: str, max_tokens: int) -> List[str]:
+    """按段落把文本切分为不超过 max_tokens 的块，过长的段落再按句子、字符切分"""
+    pieces = []
+    for paragraph in text.split('\n'):
+        if estimate_tokens(paragraph) <= max_tokens:
+            pieces.append(paragraph)
+            continue
+        for sentence in sentence_re.split(paragraph):
+            while estimate_tokens(sentence) > max_tokens:
+                # 单个句子仍然过长，按字符数硬切
+                size = max(1, len(sentence) * max_tokens // estimate_tokens(sentence))
+                pieces.append(sentence[:size])
+                sentence = sentence[size:]
+            if sentence:
+                pieces.append(sentence)
+
+    chunks = []
+    current = []
+    current_tokens = 0
+    for piece in pieces:
+        tokens = estimate_tokens(piece) + 1
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append('\n'.join(current))
+            current = []
+            current_tokens = 0
+        current.append(piece)
+        current_tokens += tokens
+    if current:
+        chunks.append('\n'.join(current))
+    return chunks
+
+
+async def summarize_with_retry(prompt: str) -> str:
+    return await retry_with_backoff(summary_router.complete, prompt, name='summarize')
+
+
+async def stream_with_retry(prompt: str, on_update: Callable[[str], Awaitable[None]]) -> str:
+    """流式生成摘要，每收到一段输出就用已生成的全部文本回调 on_update，失败时从头重试"""
+    return await retry_with_backoff(summary_router.stream, prompt, on_update, name='summarize_stream')
+
+
+async def summarize_text(text: str, prompt: str,
+                         chunk_tokens: int = configInstance.summary_chunk_tokens,
+                         max_concurrency: int = configInstance.summary_max_concurrency,
+                         on_update: Optional[Callable[[str], Awaitable[None]]] = None,
+                         depth: int = 0) -> str:
+    """长文本摘要：切分为多个块并发生成分段要点（map），再合并要点生成最终摘要（reduce）
+
+    文本较短时只调用一次模型，与直接拼接 prompt 的效果一致；
+    传入 on_update 时最终摘要以流式生成，每收到一段输出都会回调；
+    要点递归归纳超过 MAX_REDUCE_ROUNDS 轮后仍然过长时，截断每段要点后直接生成最终摘要
+    """
+    text = clean_text(text)
+    chunks = split_into_chunks(text, chunk_tokens)
+    if len(chunks) <= 1:
+        return await _final_summary(prompt + "\n" + text, on_update)
+
+    logger.info(f"Text with {estimate_tokens(text)} tokens is split into {len(chunks)} chunks")
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def map_chunk(chunk: str) -> str:
+        async with semaphore:
+            return await summarize_with_retry(configInstance.summary_map_prompt + "\n" + chunk)
+
+    partials = await asyncio.gather(*[map_chunk(chunk) for chunk in chunks])
+    combined = '\n\n'.join(partials)
+    if estimate_tokens(combined) > chunk_tokens:
+        if depth + 1 < MAX_REDUCE_ROUNDS:
+            # 分段要点合并后仍然过长，继续递归归纳
+            return await summarize_text(combined, prompt, chunk_tokens, max_concurrency, on_update, depth + 1)
+        logger.warning(f"Partials still have {estimate_tokens(combined)} tokens after {depth + 1} rounds, truncate them")
+        budget = max(1, chunk_tokens // len(partials))
+        combined = '\n\n'.join(split_into_chunks(clean_text(partial), budget)[0] for partial in partials if partial)
+    return await _final_summary(prompt + "\n" + combined, on_update)
+
+
+async def _final_summary(prompt: str, on_update: Optional[Callable[[str], Awaitable[None]]]) -> str:
+    if on_update is None:
+        return await summarize_with_retry(prompt)
+    return await stream_with_retry(prompt, on_update)
@@ -0,0 +1,168 @@
+import hashlib
+import mimetypes
+import posixpath
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+from urllib.parse import urljoin, urlparse
+
+import lxml.html
+import requests
+from requests.adapters import HTTPAdapter
+
+from config.config import configInstance
+from logger.logger_config import setup_logger
+from url.fetcher import desktop_user_agent
+from url.html_pipeline import utf8_parser
+
+logger = setup_logger('archiver')
+
+# 文本中的空白只保留一个空格，这些标签内的文本原样保留
+preserve_space_tags = {'pre', 'textarea', 'script', 'style', 'code'}
+# 这些标签直接包含的纯空白文本可以删除
+container_tags = {'html', 'head', 'body', 'ul', 'ol', 'table', 'thead', 'tbody', 'tfoot', 'tr', 'select', 'dl'}
+whitespace_re = re.compile(r'\s+')
+css_url_re = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+
+asset_session = requests.Session()
+asset_session.headers.update({'User-Agent': desktop_user_agent})
+asset_session.mount('http://', HTTPAdapter(pool_connections=8, pool_maxsize=configInstance.archive_asset_workers))
+asset_session.mount('https://', HTTPAdapter(pool_connections=8, pool_maxsize=configInstance.archive_asset_workers))
+
+
+def fetch_asset(url: str) -> Tuple[bytes, str]:
+    """下载资源，超过 archive_asset_max_bytes 的资源不下载
+
+    :return: (内容, content type)
+    """
+    with asset_session.get(url, timeout=configInstance.archive_asset_timeout, stream=True) as response:
+        response.raise_for_status()
+        length = int(response.headers.get('Content-Length') or 0)
+        if length > configInstance.archive_asset_max_bytes:
+            raise Exception(f'asset too large ({length} bytes)')
+        content = bytearray()
+        for chunk in response.iter_content(64 * 1024):
+            content.extend(chunk)
+            if len(content) > configInstance.archive_asset_max_bytes:
+                raise Exception(f'asset too large (> {configInstance.archive_asset_max_bytes} bytes)')
+        return bytes(content), response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+
+
+def asset_extension(url: str, content_type: str) -> str:
+    ext = mimetypes.guess_extension(content_type) if content_type else None
+    if ext in ('.jpe', '.jpeg'):
+        ext = '.jpg'
+    if not ext:
+        ext = posixpath.splitext(urlparse(url).path)[1].lower()
+    if not ext or len(ext) > 6:
+        ext = '.bin'
+    return ext
+
+
+def absolutize_css(css: bytes, css_url: str) -> bytes:
+    """样式表中 url() 引用的资源不再单独归档，改为绝对地址，避免样式表移动位置后失效"""
+    text = css.decode('utf-8', errors='replace')
+
+    def replace(match):
+        ref = match.group(2).strip()
+        if ref.startswith('data:'):
+            return match.group(0)
+        return f'url("{urljoin(css_url, ref)}")'
+
+    return css_url_re.sub(replace, text).encode('utf-8')
+
+
+def archive_page(html: str, page_url: str, html_path: str, asset_dir: str) -> Tuple[str, Dict[str, bytes]]:
+    """把网页中的图片、样式表等资源下载下来，按内容 hash 存放在 asset_dir 下，网页中改为相对路径引用
+
+    - 资源路径为 {asset_dir}/{sha256 前两位}/{sha256}{ext}，不同文章中相同的资源共享同一个文件
+    - 使用有界线程池并发下载，下载失败的资源保留原始地址
+    - 文本中的连续空白合并为一个空格，删除容器标签之间的纯空白
+
+    :param html: process_page 处理后的 html
+    :param page_url: 网页地址，用于解析相对地址
+    :param html_path: html 在仓库中的路径，用于计算资源的相对路径
+    :return: (处理后的 html, 资源路径 -> 内容)
+    """
+    start = time.monotonic()
+    root = lxml.html.document_fromstring(html.encode('utf-8'), parser=utf8_parser)
+
+    # 资源地址 -> 引用它的 (元素, 属性)
+    references = {}
+    for el in root.iter('img', 'link'):
+        if el.tag == 'img':
+            # 原始图片地址优先，不经过 images.weserv.nl 代理
+            src = el.get('data-src') or el.get('src')
+            attr = 'src'
+        else:
+            rel = (el.get('rel') or '').lower().split()
+            if 'stylesheet' not in rel and 'icon' not in rel:
+                continue
+            src = el.get('href')
+            attr = 'href'
+        if not src or src.startswith('data:'):
+            continue
+        asset_url = urljoin(page_url, src.strip())
+        if urlparse(asset_url).scheme not in ('http', 'https'):
+            continue
+        references.setdefault(asset_url, []).append((el, attr))
+
+    def download(asset_url: str) -> Optional[Tuple[bytes, str]]:
+        try:
+            return fetch_asset(asset_url)
+        except Exception as e:
+            logger.warning(f'Fetch asset {asset_url} failed: {e}')
+            return None
+
+    assets = {}
+    with ThreadPoolExecutor(max_workers=configInstance.archive_asset_workers) as pool:
+        downloaded = list(pool.map(download, references.keys()))
+
+    html_dir = posixpath.dirname(html_path)
+    for (asset_url, refs), result in zip(references.items(), downloaded):
+        if result is None:
+            for el, attr in refs:
+                el.set(attr, asset_url)
+            continue
+        content, content_type = result
+        if content_type == 'text/css' or asset_url.lower().split('?')[0].endswith('.css'):
+            content = absolutize_css(content, asset_url)
+        digest = hashlib.sha256(content).hexdigest()
+        path = f'{asset_dir}/{digest[:2]}/{digest}{asset_extension(asset_url, content_type)}'
+        assets[path] = content
+        relative = posixpath.relpath(path, html_dir)
+        for el, attr in refs:
+            el.set(attr, relative)
+            # srcset、data-src 中的地址仍然指向原网站，去掉后统一使用归档的图片，避免懒加载脚本换回原地址
+            el.attrib.pop('srcset', None)
+            el.attrib.pop('data-src', None)
+
+    compact_whitespace(root)
+    doctype = '<!DOCTYPE html>'
+    output = lxml.html.tostring(root, encoding='unicode', method='html', doctype=doctype)
+    logger.info(f'Archive {page_url}: {len(assets)}/{len(references)} assets, '
+                f'{sum(len(c) for c in assets.values())} asset bytes, html {len(html)} -> {len(output)} chars, '
+                f'cost {(time.monotonic() - start) * 1000:.0f}ms')
+    return output, assets
+
+
+def compact_whitespace(root):
+    """合并文本中的连续空白，pre 等标签（包括其子孙元素）内的文本原样保留"""
+    stack = [(root, False)]
+    while stack:
+        el, preserve = stack.pop()
+        preserve = preserve or el.tag in preserve_space_tags
+        if not preserve and el.text:
+            el.text = _compact(el.text, el.tag)
+        for child in el:
+            if isinstance(child.tag, str):
+                stack.append((child, preserve))
+            if not preserve and child.tail:
+                child.tail = _compact(child.tail, el.tag)
+
+
+def _compact(text: str, container: Optional[str]) -> Optional[str]:
+    if container in container_tags and not text.strip():
+        return None
+    return whitespace_re.sub(' ', text)
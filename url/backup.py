@@ -0,0 +1,526 @@
+import asyncio
+import json
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import redis
+from telegram.helpers import escape_markdown
+
+from config.config import configInstance
+from db.redis_util import redis_async
+from handlers.constants import operation_title, COMMAND_BACKUP, REDIS_BACKUP_REPLY_PREFIX, REDIS_WAYBACK_PENDING
+from logger.logger_config import setup_logger
+from url.archiver import archive_page
+from url.executor import url_executor
+from url.job_queue import url_jobs
+from url.leader import leader
+from url.page_cache import page_cache
+from url.reply import TELEGRAM_MESSAGE_LIMIT, edit_message, send_lines, render_progress
+from url.single_flight import single_flight
+from url.snapshot_with_wayback import wayback_client
+from url.utils import backup_committer, backup_index, content_digest, normalize_url
+
+logger = setup_logger('backup')
+
+# 备份回复消息状态的保存时间（秒）
+REPLY_STATE_TTL = 60 * 60 * 24 * 7
+# 全部完成后回复消息状态的保存时间（秒）
+REPLY_FINISHED_TTL = 60 * 60
+
+
+def render_backup_result(url: str, result: 'BackupResult') -> str:
+    links = result.visible_links()
+    sg_url = links.get('selenium_github_url', '')
+    sp_url = links.get('selenium_page_url', '')
+    wb_url = links.get('wayback_url', '')
+    errors = '\n'.join(result.pending_steps() + result.errors)
+
+    res_msg = f"""
+    {operation_title}{escape_markdown(url, 2)} 
+    备份结果：
+    *[{escape_markdown('selenium_github_url', 2)}]({escape_markdown(sg_url, 2)})*
+    *[{escape_markdown('selenium_page_url', 2)}]({escape_markdown(sp_url, 2)})*
+    *[{escape_markdown('wayback_url', 2)}]({escape_markdown(wb_url, 2)})*
+    {escape_markdown(errors, 2)}
+    """
+    return res_msg
+
+
+class BackupResult:
+    def __init__(self):
+        # 链接名 -> 链接，按生成顺序排列
+        self.links = {}
+        self.errors = []
+        # 待写入 GitHub 的文件路径 -> 内容，只在抓取阶段使用，不保存到 redis
+        self.files = {}
+        # 文件路径 -> 内容摘要
+        self.digests = {}
+        # 网页文件路径 -> 链接名
+        self._names = {}
+        # 是否有文件需要写入 GitHub
+        self.has_files = False
+        # 写入 GitHub 后才生效的链接
+        self.pending_links = {}
+        # None 表示等待提交，True / False 表示提交成功 / 失败
+        self.committed = None
+        # wayback 快照状态：None（未使用）/ pending / done / failed，以及快照的 job id
+        self.wayback = None
+        self.wayback_job = None
+        # 阶段名 -> 耗时（秒）
+        self.timings = {}
+
+    def to_dict(self) -> dict:
+        return {'links': self.links, 'errors': self.errors, 'has_files': self.has_files,
+                'pending_links': self.pending_links, 'committed': self.committed,
+                'wayback': self.wayback, 'wayback_job': self.wayback_job, 'timings': self.timings}
+
+    @asynccontextmanager
+    async def stage(self, name: str):
+        """记录一个阶段的耗时，阶段失败时同样记录"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - start)
+
+    def record(self, name: str, seconds: float):
+        self.timings[name] = round(seconds, 3)
+        backup_stages.record(name, seconds)
+
+    def format_timings(self) -> str:
+        return ', '.join(f'{name} {seconds:.1f}s' for name, seconds in self.timings.items())
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'BackupResult':
+        result = cls()
+        for name, value in data.items():
+            setattr(result, name, value)
+        return result
+
+    def add_asset(self, path: str, content: bytes):
+        """记录网页引用的资源，资源按内容 hash 命名
+
+        网页中引用的是这个路径，只有完全相同的路径已经提交过时才跳过上传：
+        相同内容可能因为 Content-Type 不同而使用了不同的扩展名，不能使用其他路径的文件代替
+        """
+        self.files[path] = content
+        self.digests[path] = f'asset:{path}'
+        self.has_files = True
+
+    def add_file(self, name: str, path: str, content):
+        """记录待上传的文件，链接在提交后生效"""
+        self.files[path] = content
+        self.digests[path] = content_digest(content)
+        self.has_files = True
+        self._names[path] = name
+        github_url, page_url = github_links(path)
+        self.pending_links[f'{name}_github_url'] = github_url
+        self.pending_links[f'{name}_page_url'] = page_url
+
+    async def dedupe(self):
+        """一次查询所有文件的摘要，内容已经备份过的文件不再上传，直接使用已有文件的链接"""
+        existing = await backup_index.get_many(list(self.digests.values()))
+        for path, digest in list(self.digests.items()):
+            if existing.get(digest) is None:
+                continue
+            del self.files[path]
+            del self.digests[path]
+            name = self._names.pop(path, None)
+            if name is not None:
+                logger.info(f"{name} snapshot already backed up as {existing[digest]}, skip upload")
+                github_url, page_url = github_links(existing[digest])
+                self.links[f'{name}_github_url'] = github_url
+                self.links[f'{name}_page_url'] = page_url
+                self.pending_links.pop(f'{name}_github_url', None)
+                self.pending_links.pop(f'{name}_page_url', None)
+        self.has_files = bool(self.files)
+
+    def visible_links(self) -> dict:
+        """等待提交时展示预计的 GitHub 链接，提交失败时不展示"""
+        if self.committed is False:
+            return dict(self.links)
+        return {**self.links, **self.pending_links}
+
+    def pending_steps(self) -> List[str]:
+        steps = []
+        if self.has_files and self.committed is None:
+            steps.append('⏳ 等待提交 GitHub...')
+        if self.wayback == 'pending':
+            steps.append('⏳ wayback 快照中...')
+        return steps
+
+    @property
+    def ok(self) -> bool:
+        return len(self.visible_links()) > 0
+
+    def to_markdown(self) -> str:
+        """批量备份的进度消息中使用的简短链接"""
+        short_names = {'selenium_github_url': 'github', 'selenium_page_url': 'page', 'wayback_url': 'wayback'}
+        return ' '.join(f'[{escape_markdown(short_names.get(name, name), 2)}]({escape_markdown(link, 2)})'
+                        for name, link in self.visible_links().items())
+
+
+async def collect_backup(url: str, mobile: bool, use_selenium: bool, use_wayback: bool,
+                         status: Callable[[str], Awaitable[None]]) -> BackupResult:
+    """备份流程的抓取部分，selenium 和 wayback 两个分支互不依赖，并发执行
+
+    - selenium 分支：render（抓取网页）-> archive（归档资源，可选），待写入 GitHub 的文件记录在 result.files 中，
+      之后由 BackupReply 交给 backup_committer 提交（upload 阶段）
+    - wayback 分支：wayback_submit（提交快照请求），由 track_wayback 在后台等待完成（wayback 阶段）
+
+    每个阶段的耗时记录在 result.timings 中，整体耗时取决于较慢的分支
+    """
+    logger.info(f"Begin to upload {url} to Github.")
+    result = BackupResult()
+
+    async def selenium_branch():
+        try:
+            async with result.stage('render'):
+                await status('selenium 抓取中...')
+                async def render():
+                    async with url_jobs.fetch:
+                        return await url_executor.run(page_cache.render, url, mobile=mobile)
+
+                # 渲染结果写入 page_cache，其他副本等待结束后从缓存读取，不需要共享结果
+                page = await single_flight.do(f'render:{normalize_url(url)}:{mobile}', render, dumps=None)
+            url_html, title = page.html, page.title
+            path = f"{configInstance.github_file_prefix}/{title}.html"
+            if configInstance.backup_archive_assets:
+                async with result.stage('archive'):
+                    await status('归档网页资源...')
+                    url_html, assets = await url_executor.run(archive_page, url_html, url, path,
+                                                              f"{configInstance.github_file_prefix}/assets")
+                for asset_path, content in assets.items():
+                    result.add_asset(asset_path, content)
+            result.add_file('selenium', path, url_html)
+            await result.dedupe()
+        except Exception as e:
+            result.errors.append(f'selenium: {str(e)}')
+
+    async def wayback_branch():
+        try:
+            async with result.stage('wayback_submit'):
+                await status('提交 wayback 快照...')
+                result.wayback_job = await single_flight.do(f'wayback:{normalize_url(url)}',
+                                                            lambda: wayback_client.submit(url))
+            result.wayback = 'pending'
+        except Exception as e:
+            result.wayback = 'failed'
+            result.errors.append(f'wayback: {str(e)}')
+
+    branches = []
+    if use_selenium:
+        branches.append(selenium_branch())
+    if use_wayback:
+        branches.append(wayback_branch())
+    async with result.stage('collect'):
+        await asyncio.gather(*branches)
+    logger.info(f"Collected backup of {url}: {result.format_timings()}")
+    return result
+
+
+class StageStats:
+    """备份流程各阶段的耗时统计"""
+
+    def __init__(self):
+        # 阶段名 -> [次数, 总耗时, 最大耗时]
+        self._stages = {}
+
+    def record(self, name: str, seconds: float):
+        stage = self._stages.setdefault(name, [0, 0.0, 0.0])
+        stage[0] += 1
+        stage[1] += seconds
+        stage[2] = max(stage[2], seconds)
+
+    def stats(self) -> dict:
+        return {name: f'count {count}, avg {total / count:.2f}s, max {longest:.2f}s'
+                for name, (count, total, longest) in self._stages.items()}
+
+
+backup_stages = StageStats()
+
+
+def github_links(path: str) -> Tuple[str, str]:
+    """文件在 GitHub 仓库和 GitHub Pages 上的链接"""
+    return (f"https://github.com/{configInstance.github_username}/{configInstance.github_repo}/blob/master/{path}",
+            f"https://{configInstance.github_username}.github.io/{configInstance.github_repo}/{path}")
+
+
+class BackupReply:
+    """/backup 回复消息的状态
+
+    GitHub 提交和 wayback 快照都在后台完成，状态保存在 redis 中，
+    每有一项完成就重新渲染并编辑消息，bot 重启后也能继续更新
+    """
+
+    def __init__(self, reply_id: str, chat_id: int, message_id: int, urls: List[str],
+                 results: Dict[str, BackupResult], failures: Dict[str, str], batch: bool, created_at: float):
+        self.reply_id = reply_id
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.urls = urls
+        self.results = results
+        # 抓取阶段就失败的 url -> 错误信息
+        self.failures = failures
+        self.batch = batch
+        # 抓取完成的时间，用于计算后台阶段（upload / wayback）的耗时，bot 重启后仍然有效
+        self.created_at = created_at
+
+    @classmethod
+    def create(cls, message, urls: List[str], results: Dict[str, BackupResult], failures: Dict[str, str],
+               batch: bool) -> 'BackupReply':
+        return cls(uuid.uuid4().hex, message.chat_id, message.message_id, urls, results, failures, batch, time.time())
+
+    @classmethod
+    async def load(cls, reply_id: str) -> Optional['BackupReply']:
+        raw = await redis_async.get(REDIS_BACKUP_REPLY_PREFIX + reply_id)
+        if raw is None:
+            return None
+        return cls.from_dict(reply_id, json.loads(raw))
+
+    @classmethod
+    def from_dict(cls, reply_id: str, data: dict) -> 'BackupReply':
+        results = {url: BackupResult.from_dict(result) for url, result in data['results'].items()}
+        return cls(reply_id, data['chat_id'], data['message_id'], data['urls'], results, data['failures'],
+                   data['batch'], data['created_at'])
+
+    def to_dict(self) -> dict:
+        return {'chat_id': self.chat_id, 'message_id': self.message_id, 'urls': self.urls,
+                'results': {url: result.to_dict() for url, result in self.results.items()},
+                'failures': self.failures, 'batch': self.batch, 'created_at': self.created_at}
+
+    @property
+    def finished(self) -> bool:
+        return all(not result.pending_steps() for result in self.results.values())
+
+    def ttl(self) -> int:
+        if not self.finished:
+            return REPLY_STATE_TTL
+        # 全部完成后只短暂保留，供 stream 模式下稍后收到结果的 bot 读取最新状态
+        for url, result in self.results.items():
+            logger.info(f"Backup of {url} finished: {result.format_timings()}")
+        return REPLY_FINISHED_TTL
+
+    async def save(self):
+        await redis_async.setex(REDIS_BACKUP_REPLY_PREFIX + self.reply_id, json.dumps(self.to_dict()), self.ttl())
+
+    @classmethod
+    async def update(cls, reply_id: str, mutate: Callable[['BackupReply'], None]) -> Optional['BackupReply']:
+        """读取状态、调用 mutate 修改后保存，状态不存在时返回 None
+
+        GitHub 提交结果和 wayback 快照结果由不同的任务（可能在不同的副本中）更新同一条回复，
+        在 WATCH / MULTI 中保存，读取之后状态被其他更新修改时重新读取并重试，不会覆盖对方的修改
+        """
+        key = REDIS_BACKUP_REPLY_PREFIX + reply_id
+        async with redis_async.client.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(key)
+                    raw = await pipe.get(key)
+                    if raw is None:
+                        return None
+                    reply = cls.from_dict(reply_id, json.loads(raw))
+                    mutate(reply)
+                    pipe.multi()
+                    pipe.setex(key, reply.ttl(), json.dumps(reply.to_dict()))
+                    await pipe.execute()
+                    return reply
+                except redis.WatchError:
+                    logger.info(f"Backup reply {reply_id} changed while updating, retry")
+
+    def render(self, with_details: bool = True) -> str:
+        if not self.batch:
+            url = self.urls[0]
+            result = self.results.get(url)
+            if result is None:
+                result = BackupResult()
+                result.errors.append(self.failures.get(url, ''))
+            return render_backup_result(url, result)
+
+        states = {}
+        details = {}
+        for url in self.urls:
+            result = self.results.get(url)
+            if result is None:
+                states[url] = ('❌', self.failures.get(url, ''))
+                continue
+            details[url] = result.to_markdown()
+            steps = [step.strip('⏳. ') for step in result.pending_steps()]
+            if steps:
+                states[url] = ('📤', ', '.join(steps))
+            else:
+                states[url] = ('✅' if result.ok else '❌', '; '.join(result.errors))
+        return render_progress(COMMAND_BACKUP, self.urls, states, details, with_details)
+
+    def render_fit(self) -> str:
+        text = self.render()
+        if len(text) > TELEGRAM_MESSAGE_LIMIT:
+            text = self.render(with_details=False)
+        return text[:TELEGRAM_MESSAGE_LIMIT]
+
+    async def edit(self, bot):
+        await edit_message(bot, self.chat_id, self.message_id, self.render_fit())
+
+    async def start(self, bot):
+        """把文件加入 backup_committer 的提交队列，在后台等待 wayback 快照，然后编辑回复消息"""
+        await self.prepare()
+        await self.publish(bot)
+
+    async def prepare(self):
+        """保存状态并把文件加入提交队列，只依赖 redis，worker 进程中也可以调用"""
+        files = {}
+        digests = {}
+        for result in self.results.values():
+            files.update(result.files)
+            digests.update(result.digests)
+        await self.save()
+        if files:
+            await backup_committer.enqueue(self.reply_id, files, digests)
+            logger.info(f"Backup job {self.reply_id} queued with {len(files)} files")
+        for url, result in self.results.items():
+            if result.wayback == 'pending':
+                await redis_async.sadd(REDIS_WAYBACK_PENDING, json.dumps([self.reply_id, url, result.wayback_job]))
+
+    async def publish(self, bot):
+        """在后台等待 wayback 快照，然后编辑回复消息"""
+        # 只有 leader 等待 wayback 快照，其他副本提交的快照由 leader 定期从 REDIS_WAYBACK_PENDING 中接手
+        if leader.is_leader:
+            for url, result in self.results.items():
+                if result.wayback == 'pending':
+                    track(bot, self.reply_id, url, result.wayback_job)
+        start = time.monotonic()
+        await self.edit(bot)
+        backup_stages.record('reply', time.monotonic() - start)
+
+        if self.batch and len(self.render()) > TELEGRAM_MESSAGE_LIMIT:
+            # 进度消息放不下所有链接，另外发送完整结果
+            lines = [f"{escape_markdown(url, 2)} {result.to_markdown()}" for url, result in self.results.items()]
+            await send_lines(bot, self.chat_id, lines)
+
+
+async def on_backup_committed(bot, job_ids: List[str], sha: Optional[str], error: Optional[str]) -> None:
+    """backup_committer 提交结束后更新对应回复消息的状态"""
+    for job_id in job_ids:
+        def mark_committed(reply: BackupReply):
+            for result in reply.results.values():
+                if result.has_files and result.committed is None:
+                    result.committed = error is None
+                    result.timings['upload'] = round(time.time() - reply.created_at, 3)
+                    if error is not None:
+                        result.errors.append(f'github: {error}')
+
+        reply = await BackupReply.update(job_id, mark_committed)
+        if reply is None:
+            continue
+        for result in reply.results.values():
+            if 'upload' in result.timings:
+                backup_stages.record('upload', result.timings['upload'])
+        await reply.edit(bot)
+    logger.info(f"Backup jobs {job_ids} {'committed in ' + sha if error is None else 'failed: ' + error}")
+
+
+async def track_wayback(bot, reply_id: str, url: str, job_id: str) -> None:
+    """等待 wayback 快照完成后更新对应回复消息的状态"""
+    archived = None
+    error = None
+    try:
+        archived = await wayback_client.wait(job_id)
+    except asyncio.CancelledError:
+        # bot 停止，下次启动时由 resume_wayback_tracking 继续等待
+        raise
+    except Exception as e:
+        error = str(e)
+
+    def mark_archived(reply: BackupReply):
+        result = reply.results.get(url)
+        if result is None or result.wayback != 'pending':
+            return
+        result.timings['wayback'] = round(time.time() - reply.created_at, 3)
+        if archived is not None:
+            result.wayback = 'done'
+            result.links['wayback_url'] = archived
+        else:
+            result.wayback = 'failed'
+            result.errors.append(f'wayback: {error}')
+
+    reply = await BackupReply.update(reply_id, mark_archived)
+    # 状态保存之后才移出等待集合，中途退出时由新的 leader 重新等待
+    await redis_async.srem(REDIS_WAYBACK_PENDING, json.dumps([reply_id, url, job_id]))
+    if archived is not None:
+        logger.info(f"Wayback capture of {url} done: {archived}")
+    else:
+        logger.warning(f"Wayback capture of {url} failed: {error}")
+    if reply is None or url not in reply.results:
+        return
+    seconds = reply.results[url].timings.get('wayback')
+    if seconds is not None:
+        backup_stages.record('wayback', seconds)
+    await reply.edit(bot)
+
+
+async def resume_wayback_tracking(bot) -> None:
+    """继续等待 REDIS_WAYBACK_PENDING 中的 wayback 快照，包括重启前未完成的和其他副本、worker 提交的"""
+    for raw in await redis_async.smembers(REDIS_WAYBACK_PENDING):
+        reply_id, url, job_id = json.loads(raw)
+        track(bot, reply_id, url, job_id)
+
+
+# 正在等待的 wayback 快照 -> 等待任务，避免同一个快照被重复等待
+tracked_waybacks = {}
+# leader 定期接手 wayback 快照的任务
+wayback_follower = None
+
+
+def track(bot, reply_id: str, url: str, job_id: str) -> None:
+    key = (reply_id, url, job_id)
+    if key in tracked_waybacks:
+        return
+    tracked_waybacks[key] = spawn(track_wayback(bot, reply_id, url, job_id))
+    tracked_waybacks[key].add_done_callback(lambda _: tracked_waybacks.pop(key, None))
+
+
+async def follow_wayback_pending(bot) -> None:
+    while True:
+        try:
+            await resume_wayback_tracking(bot)
+        except Exception as e:
+            logger.error(f'Resume wayback tracking failed: {e}')
+        await asyncio.sleep(configInstance.wayback_poll_interval)
+
+
+def start_wayback_tracking(bot) -> None:
+    """成为 leader 时开始等待所有未完成的 wayback 快照"""
+    global wayback_follower
+    if wayback_follower is None:
+        wayback_follower = spawn(follow_wayback_pending(bot))
+
+
+async def stop_wayback_tracking() -> None:
+    """卸任 leader 时停止等待，快照仍留在 REDIS_WAYBACK_PENDING 中，由新的 leader 接手"""
+    global wayback_follower
+    tasks = list(tracked_waybacks.values())
+    if wayback_follower is not None:
+        tasks.append(wayback_follower)
+        wayback_follower = None
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# 后台任务的引用，避免任务还没结束就被回收
+background_tasks = set()
+
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.ensure_future(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def cancel_background_tasks():
+    for task in list(background_tasks):
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
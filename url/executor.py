@@ -0,0 +1,98 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config.config import configInstance
+from logger.logger_config import setup_logger
+
+logger = setup_logger('executor')
+
+
+class ExecutorBusyError(Exception):
+    pass
+
+
+class ExecutorTimeoutError(Exception):
+    pass
+
+
+class BlockingExecutor:
+    """在独立线程池中执行阻塞任务（selenium / wayback / GitHub 请求），避免阻塞 asyncio 事件循环
+
+    - max_workers: 同时执行的任务数
+    - queue_size: 除正在执行的任务外，最多排队等待的任务数，超出直接拒绝
+    - timeout: 单个任务的等待超时时间（秒），超时后调用方立即返回，线程中的任务执行完后释放名额
+    """
+
+    def __init__(self, max_workers: int, queue_size: int, timeout: float, name: str = 'url'):
+        self.max_workers = max_workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.name = name
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'{name}-executor')
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._stats = {'submitted': 0, 'rejected': 0, 'timeout': 0, 'failed': 0,
+                       'wait_total': 0.0, 'run_total': 0.0, 'wait_max': 0.0, 'run_max': 0.0}
+
+    async def run(self, func, *args, timeout: float = None, **kwargs):
+        task_name = getattr(func, '__name__', repr(func))
+        with self._lock:
+            if self._pending >= self.max_workers + self.queue_size:
+                self._stats['rejected'] += 1
+                raise ExecutorBusyError(f'Executor [{self.name}] is busy, '
+                                        f'{self._pending} tasks pending, please try again later.')
+            self._pending += 1
+            self._stats['submitted'] += 1
+
+        submit_at = time.monotonic()
+        timing = {'wait': None, 'run': None}
+
+        def call():
+            start = time.monotonic()
+            timing['wait'] = start - submit_at
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timing['run'] = time.monotonic() - start
+
+        def release(f):
+            with self._lock:
+                self._pending -= 1
+                wait = timing['wait'] if timing['wait'] is not None else time.monotonic() - submit_at
+                run = timing['run'] or 0.0
+                self._stats['wait_total'] += wait
+                self._stats['run_total'] += run
+                self._stats['wait_max'] = max(self._stats['wait_max'], wait)
+                self._stats['run_max'] = max(self._stats['run_max'], run)
+                if not f.cancelled() and f.exception() is not None:
+                    self._stats['failed'] += 1
+            logger.info(f"Task [{task_name}] finished, waited {wait * 1000:.0f}ms, ran {run * 1000:.0f}ms"
+                        f"{', cancelled before start' if f.cancelled() else ''}")
+
+        concurrent_future = self._pool.submit(call)
+        concurrent_future.add_done_callback(release)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(concurrent_future), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self._stats['timeout'] += 1
+            msg = f'Task [{task_name}] timed out after {timeout or self.timeout}s'
+            logger.warning(msg)
+            raise ExecutorTimeoutError(msg)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending'] = self._pending
+        return stats
+
+    def shutdown(self, wait: bool = False):
+        logger.info(f'Executor [{self.name}] shutdown, stats: {self.stats()}')
+        self._pool.shutdown(wait=wait)
+
+
+url_executor = BlockingExecutor(max_workers=configInstance.url_executor_workers,
+                                queue_size=configInstance.url_executor_queue_size,
+                                timeout=configInstance.url_executor_timeout)
@@ -0,0 +1,106 @@
+import time
+from collections import namedtuple, Counter
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config.config import configInstance
+from logger.logger_config import setup_logger
+from url.html_pipeline import process_page
+from url.page_cache import page_cache
+
+logger = setup_logger('fetcher')
+
+TIER_HTTP = 'http'
+TIER_SELENIUM = 'selenium'
+TIER_CACHE = 'cache'
+
+FetchResult = namedtuple('FetchResult', ['html', 'title', 'text', 'tier', 'elapsed'])
+
+desktop_user_agent = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36'
+mobile_user_agent = 'Mozilla/5.0 (iPhone; CPU iPhone OS 11_0 like Mac OS X) AppleWebKit/604.1.38 (KHTML, like Gecko) Version/11.0 Mobile/15A372 Safari/604.1'
+
+# 需要执行 js 才能拿到正文的提示语
+js_required_markers = ('enable javascript', 'javascript is disabled', 'javascript is required',
+                       '开启javascript', '启用javascript', '环境异常')
+# 正文文本长度占 html 长度的最低比例，低于该比例认为正文需要 js 渲染
+min_text_density = 0.02
+
+http_session = requests.Session()
+http_session.mount('http://', HTTPAdapter(pool_connections=8, pool_maxsize=configInstance.url_executor_workers))
+http_session.mount('https://', HTTPAdapter(pool_connections=8, pool_maxsize=configInstance.url_executor_workers))
+
+# 每一级抓取成功的次数
+fetch_stats = Counter()
+
+
+def fetch_by_http(url: str, mobile: bool = False):
+    headers = {'User-Agent': mobile_user_agent if mobile else desktop_user_agent}
+    response = http_session.get(url, headers=headers, timeout=configInstance.fetch_http_timeout)
+    response.raise_for_status()
+    content_type = response.headers.get('Content-Type', '')
+    if 'html' not in content_type:
+        raise Exception(f'Unsupported content type: {content_type}')
+    # requests 在没有声明编码时默认使用 ISO-8859-1，中文网页会乱码
+    if response.encoding is None or response.encoding.lower() == 'iso-8859-1':
+        response.encoding = response.apparent_encoding
+    return response.text
+
+
+def is_js_only_host(url: str) -> bool:
+    host = urlparse(url).hostname or ''
+    return any(host == h or host.endswith('.' + h) for h in configInstance.js_only_hosts)
+
+
+def check_content(source: str, text: str):
+    """判断 http 抓取到的正文是否足够
+
+    :return: None 表示正文足够，否则为需要升级到浏览器渲染的原因
+    """
+    length = len(text)
+    if length < configInstance.fetch_min_text_length:
+        return f'text too short ({length} chars)'
+    if source and length / len(source) < min_text_density:
+        return f'text density too low ({length}/{len(source)})'
+    lower_text = text[:2000].lower()
+    if length < 5000 and any(marker in lower_text for marker in js_required_markers):
+        return 'page asks for javascript'
+    return None
+
+
+def fetch_page(url: str, mobile: bool = False) -> FetchResult:
+    """分级抓取网页：先查找最近的 selenium 渲染结果，再用 http 请求，正文不足时再使用 selenium 渲染
+
+    :return: FetchResult，tier 为实际提供内容的抓取方式
+    """
+    start = time.monotonic()
+    page = page_cache.lookup(url, mobile)
+    if page is not None:
+        return _done(url, FetchResult(page.html, page.title, page.text, TIER_CACHE, time.monotonic() - start))
+    if is_js_only_host(url):
+        reason = 'known javascript-only host'
+    else:
+        try:
+            source = fetch_by_http(url, mobile=mobile)
+            page = process_page(source)
+            reason = check_content(source, ' '.join(page.text.split()))
+            if reason is None:
+                return _done(url, FetchResult(page.html, page.title, page.text, TIER_HTTP, time.monotonic() - start))
+        except Exception as e:
+            reason = f'http fetch failed: {e}'
+
+    logger.info(f'Escalate {url} to selenium, reason: {reason}')
+    page = page_cache.render(url, mobile=mobile)
+    return _done(url, FetchResult(page.html, page.title, page.text, TIER_SELENIUM, time.monotonic() - start))
+
+
+def _done(url: str, result: FetchResult) -> FetchResult:
+    fetch_stats[result.tier] += 1
+    logger.info(f'Fetch {url} served by [{result.tier}] in {result.elapsed * 1000:.0f}ms, '
+                f'{len(result.text)} chars, stats: {dict(fetch_stats)}')
+    return result
+
+
+if __name__ == '__main__':
+    print(fetch_page('https://blog.csdn.net/qq_30934923/article/details/119803947').tier)
@@ -0,0 +1,166 @@
+import time
+from typing import Callable, List, Optional
+
+import html2text
+import lxml.html
+from lxml import etree
+
+from logger.logger_config import setup_logger
+
+logger = setup_logger('html_pipeline')
+
+# 返回 True 表示删除该元素
+Rewriter = Callable[[etree.ElementBase], Optional[bool]]
+
+# 这些标签中的文本不属于正文
+skip_text_tags = {'script', 'style', 'noscript', 'template', 'head'}
+# 这些标签结束时在正文中换行
+block_tags = {'p', 'div', 'br', 'li', 'tr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'section', 'article',
+              'header', 'footer', 'blockquote', 'pre', 'ul', 'ol', 'table', 'hr', 'title'}
+
+utf8_parser = lxml.html.HTMLParser(encoding='utf-8', remove_comments=True)
+
+
+class PageContent:
+    """一次解析得到的备份 html、标题和正文，markdown 在需要时才生成"""
+
+    def __init__(self, html: str, title: Optional[str], text: str):
+        self.html = html
+        self.title = title
+        self.text = text
+        self._markdown = None
+
+    @property
+    def markdown(self) -> str:
+        if self._markdown is None:
+            converter = html2text.HTML2Text()
+            converter.hard_wrap = True
+            self._markdown = converter.handle(self.html)
+        return self._markdown
+
+
+# 下列处理其实都是针对微信公众号文章的，暂不清楚对其他网页是否有影响
+
+def drop_scripts(el) -> bool:
+    """删除 <script> 标签"""
+    return el.tag == 'script'
+
+
+def rewrite_lazy_images(el):
+    """<img> 有 data-src 属性时，将 src 设置为 data-src 的外链"""
+    if el.tag == 'img' and el.get('data-src'):
+        el.set('src', 'https://images.weserv.nl/?url=' + el.get('data-src'))
+
+
+def rewrite_link_protocols(el):
+    """<link> 的 href 不以 http: 或 https: 开头时，添加 https: 前缀"""
+    if el.tag == 'link' and el.get('href') is not None:
+        href = el.get('href')
+        if not href.startswith('https:') and not href.startswith('http:'):
+            el.set('href', 'https:' + href)
+
+
+default_rewriters = [drop_scripts, rewrite_lazy_images, rewrite_link_protocols]
+
+
+def process_page(source: str, rewriters: List[Rewriter] = None) -> PageContent:
+    """只解析一次网页：遍历时依次执行 rewriters 改写元素，同时提取标题和正文，最后序列化为备份 html"""
+    if rewriters is None:
+        rewriters = default_rewriters
+    root = lxml.html.document_fromstring(source.encode('utf-8'), parser=utf8_parser)
+
+    dropped = set()
+    # 当前位于多少层不属于正文的标签中
+    skip_depth = 0
+    title = None
+    texts = []
+    for event, el in etree.iterwalk(root, events=('start', 'end')):
+        if not isinstance(el.tag, str):
+            # 注释、处理指令等节点只保留其后的文本
+            if event == 'end' and el.tail and skip_depth == 0:
+                texts.append(el.tail)
+            continue
+        if event == 'start':
+            drop = False
+            for rewriter in rewriters:
+                if rewriter(el):
+                    drop = True
+                    break
+            if drop:
+                dropped.add(el)
+            if drop or el.tag in skip_text_tags:
+                skip_depth += 1
+            elif el.text and skip_depth == 0:
+                texts.append(el.text)
+            if el.tag == 'title' and title is None:
+                title = (el.text or '').strip()
+        else:
+            if el in dropped or el.tag in skip_text_tags:
+                skip_depth -= 1
+            elif el.tag in block_tags and skip_depth == 0:
+                texts.append('\n')
+            if el.tail and skip_depth == 0:
+                texts.append(el.tail)
+
+    for el in dropped:
+        el.drop_tree()
+
+    # 源码没有 doctype 时 libxml2 会补上 HTML 4.0 的 doctype，此时统一使用 html5 的
+    doctype = '<!DOCTYPE html>'
+    if source.lstrip()[:9].lower() == '<!doctype':
+        doctype = root.getroottree().docinfo.doctype or doctype
+    html = lxml.html.tostring(root, encoding='unicode', method='html', doctype=doctype)
+    return PageContent(html, title, ''.join(texts))
+
+
+def _legacy_process(source: str):
+    """旧的 BeautifulSoup 处理方式，仅用于 benchmark 对比"""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(source, 'html.parser')
+    for img in soup.find_all('img'):
+        if img.has_attr('data-src'):
+            img['src'] = 'https://images.weserv.nl/?url=' + img['data-src']
+    for link in soup.find_all('link'):
+        if link.has_attr('href') and not link['href'].startswith('https:') and not link['href'].startswith('http:'):
+            link['href'] = 'https:' + link['href']
+    for script in soup.find_all('script'):
+        script.decompose()
+    html = soup.prettify()
+    text = BeautifulSoup(html, 'html.parser').get_text()
+    return html, text
+
+
+def benchmark(paragraphs: int = 5000, repeat: int = 3):
+    """对比旧的 BeautifulSoup 多次遍历 + 重复解析与新的单次解析在大网页上的耗时和内存峰值"""
+    import tracemalloc
+
+    body = ''.join(
+        f'<section><h2>Part {i}</h2><p style="margin:0">段落 {i} 的内容，包含一些 <b>加粗</b> 和 <a href="/a/{i}">链接</a>。'
+        f'</p><img data-src="https://example.com/{i}.png"><script>var x{i} = {i};</script>'
+        f'<link rel="stylesheet" href="//example.com/{i}.css"></section>'
+        for i in range(paragraphs))
+    source = f'<!DOCTYPE html><html><head><title>Benchmark</title></head><body>{body}</body></html>'
+
+    def measure(func):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func(source)
+            cost = time.perf_counter() - start
+            best = cost if best is None else min(best, cost)
+        tracemalloc.start()
+        func(source)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return best, peak
+
+    legacy_time, legacy_peak = measure(_legacy_process)
+    new_time, new_peak = measure(process_page)
+    print(f'source size: {len(source) / 1024 / 1024:.1f}MB')
+    print(f'beautifulsoup: {legacy_time * 1000:.0f}ms, peak memory {legacy_peak / 1024 / 1024:.1f}MB')
+    print(f'lxml pipeline: {new_time * 1000:.0f}ms, peak memory {new_peak / 1024 / 1024:.1f}MB')
+    print(f'speedup: {legacy_time / new_time:.1f}x')
+
+
+if __name__ == '__main__':
+    benchmark()
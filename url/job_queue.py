@@ -0,0 +1,98 @@
+import asyncio
+from typing import Awaitable, Callable
+
+from config.config import configInstance
+from logger.logger_config import setup_logger
+
+logger = setup_logger('job_queue')
+
+
+class JobQueueFullError(Exception):
+    pass
+
+
+class UrlJobQueue:
+    """处理 url 的有界异步任务队列
+
+    - workers: 同时处理的任务数，每个任务对应一个 url
+    - queue_size: 最多排队等待的任务数，超出直接拒绝
+    - fetch / llm: 抓取网页、生成摘要两个阶段各自的并发上限，
+      任务在进入对应阶段时获取，避免某一阶段的慢请求占满其他阶段的名额
+
+    队列和信号量在第一次提交任务时创建，保证绑定到 bot 运行的事件循环
+    """
+
+    def __init__(self, workers: int, queue_size: int,
+                 fetch_concurrency: int, llm_concurrency: int):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.fetch_concurrency = fetch_concurrency
+        self.llm_concurrency = llm_concurrency
+        self._queue = None
+        self._tasks = []
+        self._fetch = None
+        self._llm = None
+
+    def _ensure_started(self):
+        if self._queue is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._fetch = asyncio.Semaphore(self.fetch_concurrency)
+        self._llm = asyncio.Semaphore(self.llm_concurrency)
+        self._tasks = [asyncio.ensure_future(self._worker(i)) for i in range(self.workers)]
+
+    @property
+    def fetch(self) -> asyncio.Semaphore:
+        self._ensure_started()
+        return self._fetch
+
+    @property
+    def llm(self) -> asyncio.Semaphore:
+        self._ensure_started()
+        return self._llm
+
+    def submit(self, job: Callable[[], Awaitable]) -> asyncio.Future:
+        """提交任务，返回任务结果的 future，队列已满时抛出 JobQueueFullError"""
+        self._ensure_started()
+        future = asyncio.get_event_loop().create_future()
+        try:
+            self._queue.put_nowait((job, future))
+        except asyncio.QueueFull:
+            raise JobQueueFullError(f'Job queue is full, {self._queue.qsize()} jobs waiting, please try again later.')
+        return future
+
+    async def _worker(self, index: int):
+        while True:
+            job, future = await self._queue.get()
+            try:
+                if not future.cancelled():
+                    result = await job()
+                    if not future.cancelled():
+                        future.set_result(result)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            finally:
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        if self._queue is None:
+            return {'waiting': 0}
+        return {'waiting': self._queue.qsize(),
+                'fetch_available': self._fetch._value,
+                'llm_available': self._llm._value}
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+url_jobs = UrlJobQueue(workers=configInstance.url_job_workers,
+                       queue_size=configInstance.url_job_queue_size,
+                       fetch_concurrency=configInstance.url_fetch_concurrency,
+                       llm_concurrency=configInstance.url_llm_concurrency)
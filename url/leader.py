@@ -0,0 +1,96 @@
+import asyncio
+import os
+import socket
+import uuid
+from typing import Awaitable, Callable, Optional
+
+import redis
+
+from config.config import configInstance
+from db.redis_util import redis_async
+from handlers.constants import REDIS_LEADER_LOCK
+from logger.logger_config import setup_logger
+from url.single_flight import RELEASE_LOCK_SCRIPT
+
+logger = setup_logger('leader')
+
+# 只有锁仍然属于自己时才续期，锁已经过期并被其他副本抢到时返回 0
+RENEW_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class LeaderElection:
+    """多个 bot 副本（webhook 模式）之间选出一个 leader，只有 leader 运行全局唯一的后台任务
+
+    - 通过 SET NX PX 抢锁，持有锁期间每 ttl/3 续期一次，续期失败（锁已过期或被抢走）时立即卸任
+    - 成为 leader 时调用 on_elected，卸任或退出时调用 on_demoted
+    - 没有抢到锁的副本每 ttl/3 重试一次，leader 退出时主动释放锁，其他副本很快接手；
+      leader 异常退出时最多 ttl 毫秒后由其他副本接手
+    """
+
+    def __init__(self, redis_util, key: str, ttl_ms: int, name: str):
+        self.redis = redis_util
+        self.key = key
+        self.ttl_ms = ttl_ms
+        self.name = name
+        self.token = f'{name}:{uuid.uuid4().hex}'
+        self.is_leader = False
+        self._on_elected = None
+        self._on_demoted = None
+        self._task = None
+
+    def start(self, on_elected: Callable[[], Awaitable], on_demoted: Optional[Callable[[], Awaitable]] = None):
+        self._on_elected = on_elected
+        self._on_demoted = on_demoted
+        self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        interval = self.ttl_ms / 3 / 1000
+        while True:
+            try:
+                if self.is_leader:
+                    renewed = await self.redis.client.eval(RENEW_LOCK_SCRIPT, 1, self.key, self.token, self.ttl_ms)
+                    if not renewed:
+                        logger.warning(f'{self.name} lost leadership')
+                        await self._demote()
+                elif await self.redis.client.set(self.key, self.token, nx=True, px=self.ttl_ms):
+                    logger.info(f'{self.name} elected as leader')
+                    self.is_leader = True
+                    await self._on_elected()
+            except redis.RedisError as e:
+                # 连不上 redis 时无法续期，锁可能已经被其他副本抢到，先卸任
+                logger.error(f'Leader election failed: {e}')
+                if self.is_leader:
+                    await self._demote()
+            await asyncio.sleep(interval)
+
+    async def _demote(self):
+        self.is_leader = False
+        if self._on_demoted is not None:
+            try:
+                await self._on_demoted()
+            except Exception as e:
+                logger.error(f'Stop leader tasks failed: {e}')
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.is_leader:
+            await self._demote()
+            try:
+                await self.redis.client.eval(RELEASE_LOCK_SCRIPT, 1, self.key, self.token)
+            except redis.RedisError as e:
+                logger.warning(f'Release leader lock failed: {e}')
+
+    def stats(self) -> dict:
+        return {'name': self.name, 'leader': self.is_leader}
+
+
+leader = LeaderElection(redis_async, REDIS_LEADER_LOCK, ttl_ms=configInstance.leader_lock_ttl * 1000,
+                        name=f'{socket.gethostname()}-{os.getpid()}')
@@ -0,0 +1,172 @@
+import base64
+import json
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+from typing import Optional
+
+from config.config import configInstance
+from db.redis_util import redis_conn, redis_async
+from handlers.constants import REDIS_PAGE_CACHE_PREFIX, REDIS_PAGE_CACHE_INDEX, REDIS_PAGE_CACHE_SIZES, \
+    REDIS_PAGE_CACHE_STATS, REDIS_PAGE_CACHE_BYTES
+from logger.logger_config import setup_logger
+from url.html_pipeline import PageContent
+from url.snapshot_with_selenium import get_page_by_selenium
+from url.utils import normalize_url, sha256_hex
+
+logger = setup_logger('page_cache')
+
+# 写入一条缓存并淘汰，在 redis 中原子执行，多个副本同时写入时总字节数不会算错
+# 总字节数由 KEYS[4] 维护，不存在时（第一次使用）由 sizes 中的记录计算
+# KEYS: 缓存 key, 索引, sizes, 总字节数  ARGV: 内容, ttl, 当前时间, 字节数, 字节预算
+SET_AND_EVICT_SCRIPT = """
+local ttl, now, size, max_bytes = tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5])
+if redis.call('exists', KEYS[4]) == 0 then
+    local total = 0
+    for _, value in ipairs(redis.call('hvals', KEYS[3])) do
+        total = total + tonumber(value)
+    end
+    redis.call('set', KEYS[4], total)
+end
+
+local function remove(key)
+    local old = redis.call('hget', KEYS[3], key)
+    if old then
+        redis.call('hdel', KEYS[3], key)
+        redis.call('decrby', KEYS[4], old)
+    end
+    redis.call('zrem', KEYS[2], key)
+end
+
+remove(KEYS[1])
+redis.call('setex', KEYS[1], ttl, ARGV[1])
+redis.call('zadd', KEYS[2], now, KEYS[1])
+redis.call('hset', KEYS[3], KEYS[1], size)
+redis.call('incrby', KEYS[4], size)
+
+for _, key in ipairs(redis.call('zrangebyscore', KEYS[2], '-inf', now - ttl)) do
+    remove(key)
+end
+local evicted = 0
+while tonumber(redis.call('get', KEYS[4])) > max_bytes do
+    local oldest = redis.call('zrange', KEYS[2], 0, 0)
+    if #oldest == 0 then
+        break
+    end
+    remove(oldest[1])
+    redis.call('del', oldest[1])
+    evicted = evicted + 1
+end
+return evicted
+"""
+
+
+class RenderedPageCache:
+    """selenium 渲染结果的短期缓存，/summarize 和 /backup 同一网页时只渲染一次
+
+    - key 由规范化后的 url 和是否手机模式决定，内容为 zlib 压缩后的 html、标题和正文
+    - 缓存有较短的过期时间，压缩后的总字节数超过 max_bytes 时淘汰最早写入的条目
+    - 同一进程内相同 key 的并发请求共用一次渲染
+    - 渲染在线程池中执行，读写缓存使用同步客户端；在事件循环中查询统计时使用 async_redis
+    """
+
+    def __init__(self, redis_util, async_redis, ttl: int, max_bytes: int):
+        self.redis = redis_util
+        self.async_redis = async_redis
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        # key -> 正在渲染的 Future
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(url: str, mobile: bool) -> str:
+        return REDIS_PAGE_CACHE_PREFIX + sha256_hex(normalize_url(url), 'mobile' if mobile else 'desktop')
+
+    @staticmethod
+    def _encode(page: PageContent) -> str:
+        raw = json.dumps({'html': page.html, 'title': page.title, 'text': page.text}).encode('utf-8')
+        # redis 连接使用 decode_responses，压缩后的内容需要转为文本保存
+        return base64.b64encode(zlib.compress(raw, 6)).decode('ascii')
+
+    @staticmethod
+    def _decode(value: str) -> PageContent:
+        data = json.loads(zlib.decompress(base64.b64decode(value)).decode('utf-8'))
+        return PageContent(data['html'], data['title'], data['text'])
+
+    def get(self, url: str, mobile: bool = False) -> Optional[PageContent]:
+        value = self.redis.get(self._key(url, mobile))
+        self.redis.client.hincrby(REDIS_PAGE_CACHE_STATS, 'hit' if value is not None else 'miss', 1)
+        return self._decode(value) if value is not None else None
+
+    def set(self, url: str, mobile: bool, page: PageContent):
+        key = self._key(url, mobile)
+        value = self._encode(page)
+        if len(value) > self.max_bytes:
+            logger.info(f'Rendered page of {url} too large to cache ({len(value)} bytes)')
+            return
+        # 一次往返完成写入、清理过期条目以及超出预算时淘汰最早写入的条目
+        evicted = self.redis.client.eval(SET_AND_EVICT_SCRIPT, 4, key, REDIS_PAGE_CACHE_INDEX,
+                                         REDIS_PAGE_CACHE_SIZES, REDIS_PAGE_CACHE_BYTES,
+                                         value, self.ttl, time.time(), len(value), self.max_bytes)
+        if evicted:
+            logger.info(f'Evicted {evicted} rendered pages to stay within {self.max_bytes} bytes')
+
+    def render(self, url: str, mobile: bool = False) -> PageContent:
+        """优先返回缓存的渲染结果，否则使用 selenium 渲染；相同 url 的并发请求等待同一次渲染"""
+        key = self._key(url, mobile)
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+        if not owner:
+            logger.info(f'Wait for in-flight render of {url}')
+            return future.result()
+
+        try:
+            page = self.lookup(url, mobile)
+            if page is None:
+                page = get_page_by_selenium(url, mobile=mobile)
+                self._store(url, mobile, page)
+            future.set_result(page)
+            return page
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def lookup(self, url: str, mobile: bool) -> Optional[PageContent]:
+        """查找缓存的渲染结果，缓存不可用时返回 None"""
+        try:
+            page = self.get(url, mobile)
+        except Exception as e:
+            logger.warning(f'Read page cache failed: {e}')
+            return None
+        if page is not None:
+            logger.info(f'Rendered page of {url} served from cache')
+        return page
+
+    def _store(self, url: str, mobile: bool, page: PageContent):
+        try:
+            self.set(url, mobile, page)
+        except Exception as e:
+            logger.warning(f'Write page cache failed: {e}')
+
+    async def stats(self) -> dict:
+        stats, size, total = await self.async_redis.execute(('hgetall', REDIS_PAGE_CACHE_STATS),
+                                                            ('hlen', REDIS_PAGE_CACHE_SIZES),
+                                                            ('get', REDIS_PAGE_CACHE_BYTES))
+        hit = int(stats.get('hit', 0))
+        miss = int(stats.get('miss', 0))
+        return {'hit': hit, 'miss': miss, 'hit_rate': f'{hit / (hit + miss):.2%}' if hit + miss else '-',
+                'size': size, 'bytes': int(total or 0),
+                'inflight': len(self._inflight)}
+
+
+page_cache = RenderedPageCache(redis_conn, redis_async, ttl=configInstance.page_cache_ttl,
+                               max_bytes=configInstance.page_cache_max_bytes)
@@ -0,0 +1,122 @@
+import asyncio
+import time
+from typing import Dict, List, Tuple
+
+from telegram.constants import ParseMode
+from telegram.error import RetryAfter, BadRequest
+from telegram.helpers import escape_markdown
+
+from handlers.constants import operation_title
+from logger.logger_config import setup_logger
+
+logger = setup_logger('reply')
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+def split_markdown(text: str, limit: int) -> List[str]:
+    """按行把纯文本切分并转义为 MarkdownV2，保证每段转义后的长度不超过 limit"""
+    lines = []
+    for line in text.split('\n'):
+        # 转义后长度最多翻倍，过长的行先按 limit // 2 个字符切开
+        size = max(1, limit // 2)
+        lines.extend(escape_markdown(line[i:i + size], 2) for i in range(0, max(len(line), 1), size))
+    pieces = []
+    current = None
+    for escaped in lines:
+        if current is not None and len(current) + 1 + len(escaped) > limit:
+            pieces.append(current)
+            current = None
+        current = escaped if current is None else f'{current}\n{escaped}'
+    pieces.append(current or '')
+    return pieces
+
+
+class StreamingReply:
+    """把流式生成的文本逐步编辑到同一条消息中
+
+    telegram 对同一条消息的编辑频率有限制，两次编辑之间至少间隔 interval 秒，
+    每次都对完整的纯文本重新转义，因此未生成完的文本也是合法的 MarkdownV2
+    """
+
+    def __init__(self, message, interval: float):
+        self.message = message
+        self.interval = interval
+        self._next_edit_at = 0
+        self._last_text = None
+
+    def can_edit(self) -> bool:
+        """距离上次编辑（或频率限制要求的等待时间）是否已经过去，中间状态的编辑在此之前应跳过"""
+        return time.monotonic() >= self._next_edit_at
+
+    async def update(self, header: str, text: str):
+        if not self.can_edit():
+            return
+        pieces = split_markdown(text + ' ▌', TELEGRAM_MESSAGE_LIMIT - len(header) - 2)
+        try:
+            await self.edit(header + pieces[0] + (escape_markdown('…', 2) if len(pieces) > 1 else ''))
+        except Exception as e:
+            # 中间状态的编辑失败不影响摘要生成
+            logger.warning(f"Edit streaming message failed: {e}")
+
+    async def edit(self, text: str, force: bool = False):
+        if text == self._last_text:
+            return
+        while True:
+            self._next_edit_at = time.monotonic() + self.interval
+            try:
+                await self.message.edit_text(text, parse_mode=ParseMode.MARKDOWN_V2)
+                self._last_text = text
+                return
+            except RetryAfter as e:
+                self._next_edit_at = time.monotonic() + e.retry_after
+                if not force:
+                    return
+                await asyncio.sleep(e.retry_after)
+            except BadRequest as e:
+                if 'not modified' in str(e):
+                    return
+                raise
+
+
+async def edit_message(bot, chat_id: int, message_id: int, text: str) -> None:
+    """编辑 MarkdownV2 消息，遇到频率限制时等待后重试一次，其他错误只记录日志"""
+    for _ in range(2):
+        try:
+            await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id,
+                                        parse_mode=ParseMode.MARKDOWN_V2)
+            return
+        except RetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+        except BadRequest as e:
+            if 'not modified' not in str(e):
+                logger.warning(f"Edit message {chat_id}/{message_id} failed: {e}")
+            return
+
+
+async def send_lines(bot, chat_id: int, lines: List[str]) -> None:
+    """把多行 MarkdownV2 文本按消息长度限制分成多条发送"""
+    piece = ''
+    for line in lines:
+        if piece and len(piece) + 1 + len(line) > TELEGRAM_MESSAGE_LIMIT:
+            await bot.send_message(chat_id, piece, parse_mode=ParseMode.MARKDOWN_V2)
+            piece = ''
+        piece = line if not piece else f'{piece}\n{line}'
+    if piece:
+        await bot.send_message(chat_id, piece, parse_mode=ParseMode.MARKDOWN_V2)
+
+
+def render_progress(command: str, urls: List[str], states: Dict[str, Tuple[str, str]], details: Dict[str, str],
+                    with_details: bool = True) -> str:
+    """批量任务的汇总进度：每个 url 一行，包括状态图标、说明以及附加的 MarkdownV2 内容"""
+    done = sum(1 for icon, _ in states.values() if icon in ('✅', '❌', '📤'))
+    lines = [f"{operation_title}{escape_markdown(f'/{command} {done}/{len(urls)}', 2)}"]
+    for url in urls:
+        icon, text = states[url]
+        line = f"{icon} {escape_markdown(url, 2)}"
+        if text:
+            line += ' ' + escape_markdown(text, 2)
+        if with_details and url in details:
+            line += ' ' + details[url]
+        lines.append(line)
+    return '\n'.join(lines)
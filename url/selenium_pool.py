@@ -0,0 +1,165 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from selenium import webdriver
+
+from config.config import configInstance
+from logger.logger_config import setup_logger
+
+logger = setup_logger('selenium_pool')
+
+mobile_emulation = {
+    "deviceMetrics": {"width": 414, "height": 896, "pixelRatio": 1.0},
+    "userAgent": "Mozilla/5.0 (iPhone; CPU iPhone OS 11_0 like Mac OS X) AppleWebKit/604.1.38 (KHTML, like Gecko) Version/11.0 Mobile/15A372 Safari/604.1"
+}
+
+
+class PooledDriver:
+    def __init__(self, driver, mobile: bool):
+        self.driver = driver
+        self.mobile = mobile
+        self.uses = 0
+        self.created_at = time.time()
+
+
+class SeleniumPool:
+    """复用 selenium grid 上的 session，避免每个 url 都新建/销毁浏览器
+
+    - 总 session 数不超过 max_sessions（与 selenium 的 SE_NODE_MAX_SESSIONS 保持一致）
+    - 桌面与手机模式的 session 分开缓存，某一类空闲而另一类不够用时回收空闲的 session
+    - 归还时清理 cookie、storage 并回到 about:blank，出错或使用次数达到 max_uses 后销毁重建
+    """
+
+    def __init__(self, server: str, max_sessions: int, max_uses: int, lease_timeout: float):
+        self.server = server
+        self.max_sessions = max_sessions
+        self.max_uses = max_uses
+        self.lease_timeout = lease_timeout
+        self._cond = threading.Condition()
+        self._idle = {False: [], True: []}
+        self._total = 0
+        self._closed = False
+
+    @contextmanager
+    def lease(self, mobile: bool = False):
+        pooled = self._acquire(mobile)
+        broken = False
+        try:
+            yield pooled.driver
+        except Exception:
+            broken = True
+            raise
+        finally:
+            self._release(pooled, broken)
+
+    def _acquire(self, mobile: bool) -> PooledDriver:
+        deadline = time.monotonic() + self.lease_timeout
+        pooled = None
+        victim = None
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise Exception('Selenium pool is closed')
+                if self._idle[mobile]:
+                    pooled = self._idle[mobile].pop()
+                    break
+                if self._total < self.max_sessions:
+                    self._total += 1
+                    break
+                if self._idle[not mobile]:
+                    # 名额被另一种模式的空闲 session 占用，回收后复用名额
+                    victim = self._idle[not mobile].pop()
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise Exception(f'No selenium session available in {self.lease_timeout}s, '
+                                    f'max sessions: {self.max_sessions}')
+                self._cond.wait(remaining)
+
+        if victim is not None:
+            self._quit(victim)
+        if pooled is not None and not self._is_healthy(pooled):
+            self._quit(pooled)
+            pooled = None
+        if pooled is None:
+            try:
+                pooled = PooledDriver(self._create_driver(mobile), mobile)
+            except Exception:
+                self._discard_slot()
+                raise
+        return pooled
+
+    def _release(self, pooled: PooledDriver, broken: bool):
+        pooled.uses += 1
+        recycle = broken or self._closed or pooled.uses >= self.max_uses
+        if not recycle:
+            try:
+                self._reset(pooled.driver)
+            except Exception as e:
+                logger.warning(f'Reset selenium session failed, recycle it: {e}')
+                recycle = True
+        if recycle:
+            self._quit(pooled)
+            self._discard_slot()
+            return
+        with self._cond:
+            self._idle[pooled.mobile].append(pooled)
+            self._cond.notify()
+
+    def _discard_slot(self):
+        with self._cond:
+            self._total -= 1
+            self._cond.notify()
+
+    def _create_driver(self, mobile: bool):
+        start = time.monotonic()
+        options = webdriver.ChromeOptions()
+        options.add_argument('--headless')
+        options.add_argument('--no-sandbox')
+        options.add_argument('--disable-gpu')
+        options.add_argument('--disable-dev-shm-usage')
+        if mobile:
+            options.add_experimental_option('mobileEmulation', mobile_emulation)
+        driver = webdriver.Remote(command_executor=self.server, options=options)
+        logger.info(f'Create selenium session {driver.session_id} (mobile: {mobile}) '
+                    f'cost {(time.monotonic() - start) * 1000:.0f}ms')
+        return driver
+
+    @staticmethod
+    def _reset(driver):
+        driver.delete_all_cookies()
+        driver.execute_script('try { window.localStorage.clear(); window.sessionStorage.clear(); } catch (e) {}')
+        driver.get('about:blank')
+
+    @staticmethod
+    def _is_healthy(pooled: PooledDriver) -> bool:
+        try:
+            return pooled.driver.execute_script('return 1') == 1
+        except Exception as e:
+            logger.warning(f'Selenium session {pooled.driver.session_id} is unhealthy: {e}')
+            return False
+
+    @staticmethod
+    def _quit(pooled: PooledDriver):
+        try:
+            pooled.driver.quit()
+        except Exception as e:
+            logger.warning(f'Quit selenium session {pooled.driver.session_id} failed: {e}')
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle = self._idle[False] + self._idle[True]
+            self._idle = {False: [], True: []}
+            self._total -= len(idle)
+            self._cond.notify_all()
+        for pooled in idle:
+            self._quit(pooled)
+        logger.info(f'Selenium pool closed, {len(idle)} idle sessions quit')
+
+
+selenium_pool = SeleniumPool(server=configInstance.selenium_server,
+                             max_sessions=configInstance.selenium_max_sessions,
+                             max_uses=configInstance.selenium_session_max_uses,
+                             lease_timeout=configInstance.selenium_lease_timeout)
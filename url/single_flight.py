@@ -0,0 +1,139 @@
+import asyncio
+import json
+import time
+import uuid
+from collections import Counter
+from typing import Awaitable, Callable, Optional
+
+from config.config import configInstance
+from db.redis_util import redis_async
+from handlers.constants import REDIS_SINGLEFLIGHT_LOCK_PREFIX, REDIS_SINGLEFLIGHT_RESULT_PREFIX
+from logger.logger_config import setup_logger
+
+logger = setup_logger('single_flight')
+
+# 只有锁仍然属于自己时才删除，避免锁过期后误删其他副本的锁
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class SingleFlight:
+    """进程内的请求合并：相同 key 的并发调用只执行一次，后来的调用等待并得到第一次调用的结果
+
+    第一次调用失败时，等待中的调用得到同样的异常
+    """
+
+    def __init__(self):
+        # key -> 第一次调用结果的 future
+        self._calls = {}
+        self._stats = Counter()
+
+    async def do(self, key: str, fn: Callable[[], Awaitable],
+                 dumps: Optional[Callable] = json.dumps, loads: Callable = json.loads):
+        """dumps / loads 只在 redis 版本中使用，这里保持相同的参数以便切换"""
+        future = self._calls.get(key)
+        if future is not None:
+            self._stats['shared'] += 1
+            logger.info(f'Join in-flight call {key}')
+            return await asyncio.shield(future)
+
+        future = asyncio.get_event_loop().create_future()
+        # 没有其他调用等待时，避免出现 exception was never retrieved 的警告
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._calls[key] = future
+        self._stats['executed'] += 1
+        try:
+            result = await fn()
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.set_exception(Exception(f'In-flight call {key} was cancelled'))
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            self._calls.pop(key, None)
+
+    def stats(self) -> dict:
+        return {'backend': 'local', 'inflight': len(self._calls), **self._stats}
+
+
+class RedisSingleFlight:
+    """多个 bot 副本之间的请求合并，基于 redis 锁
+
+    - 进程内先经过 SingleFlight 合并，每个副本同一个 key 只有一个调用参与竞争
+    - 抢到锁的副本执行调用，结果经 dumps 序列化后短暂保存在 redis 中，其他副本轮询得到结果
+    - dumps 为 None 表示结果不共享（例如已经写入了其他缓存），其他副本等锁释放后自己执行一次
+    - 持有锁的副本失败时不保存结果，等待的副本在锁释放后重新竞争；等待超过 wait_timeout 时直接执行
+    """
+
+    def __init__(self, redis_util, lock_ttl: int, result_ttl: int, wait_timeout: float, poll_interval: float):
+        self.redis = redis_util
+        self.lock_ttl = lock_ttl
+        self.result_ttl = result_ttl
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.local = SingleFlight()
+        self._stats = Counter()
+
+    async def do(self, key: str, fn: Callable[[], Awaitable],
+                 dumps: Optional[Callable] = json.dumps, loads: Callable = json.loads):
+        return await self.local.do(key, lambda: self._do(key, fn, dumps, loads))
+
+    async def _do(self, key: str, fn: Callable[[], Awaitable], dumps: Optional[Callable], loads: Callable):
+        client = self.redis.client
+        lock_key = REDIS_SINGLEFLIGHT_LOCK_PREFIX + key
+        result_key = REDIS_SINGLEFLIGHT_RESULT_PREFIX + key
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.wait_timeout
+        waited = False
+        while not await client.set(lock_key, token, nx=True, ex=self.lock_ttl):
+            if time.monotonic() > deadline:
+                logger.warning(f'Wait for {key} on another replica timed out, run it locally')
+                self._stats['timeout'] += 1
+                return await fn()
+            waited = True
+            await asyncio.sleep(self.poll_interval)
+            if dumps is not None:
+                raw = await client.get(result_key)
+                if raw is not None:
+                    self._stats['shared'] += 1
+                    logger.info(f'Got result of {key} from another replica')
+                    return loads(raw)
+        if waited and dumps is None:
+            self._stats['shared'] += 1
+
+        try:
+            if waited and dumps is not None:
+                # 持有锁的副本可能在上一次轮询之后保存了结果并释放了锁，抢到锁后先检查一次，避免重复执行
+                raw = await client.get(result_key)
+                if raw is not None:
+                    self._stats['shared'] += 1
+                    logger.info(f'Got result of {key} from another replica')
+                    return loads(raw)
+            else:
+                # 没有等待其他副本时清除上一次调用留下的结果，等待的副本只会拿到这一次的结果
+                await client.delete(result_key)
+            result = await fn()
+            if dumps is not None:
+                await client.setex(result_key, self.result_ttl, dumps(result))
+            return result
+        finally:
+            await client.eval(RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+
+    def stats(self) -> dict:
+        return {**self.local.stats(), 'backend': 'redis', **{f'replica_{k}': v for k, v in self._stats.items()}}
+
+
+if configInstance.singleflight_backend == 'redis':
+    single_flight = RedisSingleFlight(redis_async, lock_ttl=configInstance.singleflight_lock_ttl,
+                                      result_ttl=configInstance.singleflight_result_ttl,
+                                      wait_timeout=configInstance.singleflight_wait_timeout,
+                                      poll_interval=configInstance.singleflight_poll_interval)
+else:
+    single_flight = SingleFlight()
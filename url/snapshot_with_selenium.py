@@ -1,13 +1,13 @@
 import time
 from typing import Tuple
 
-import html2text
 import requests
 from bs4 import BeautifulSoup
-from selenium import webdriver
 
 from config.config import configInstance
 from logger.logger_config import setup_logger
+from url.html_pipeline import PageContent, process_page
+from url.selenium_pool import selenium_pool
 
 logger = setup_logger('snapshot')
 
@@ -19,99 +19,109 @@ def get_url_info_by_selenium(url: str, mobile: bool = False):
         :param url: 目标网页
         :param mobile: 是否使用手机模式
     """
-    # resp = send_get_request(url=url, params=params, timeout=timeout, **kwargs)
-    html_content = None
+    page = get_page_by_selenium(url, mobile=mobile)
+    return page.html, page.title
+
+
+def get_page_by_selenium(url: str, mobile: bool = False) -> PageContent:
+    """使用 selenium 渲染网页，只解析一次得到备份 html、标题、正文和 markdown"""
     title = None
-    driver = None
-    mobile_emulation = {
-        "deviceMetrics": {"width": 414, "height": 896, "pixelRatio": 1.0},
-        "userAgent": "Mozilla/5.0 (iPhone; CPU iPhone OS 11_0 like Mac OS X) AppleWebKit/604.1.38 (KHTML, like Gecko) Version/11.0 Mobile/15A372 Safari/604.1"
-    }
+    start = time.monotonic()
     try:
-        options = webdriver.ChromeOptions()
-        options.add_argument('--headless')
-        options.add_argument('--no-sandbox')
-        options.add_argument('--disable-gpu')
-        options.add_argument('--disable-dev-shm-usage')
-        if mobile:
-            options.add_experimental_option('mobileEmulation', mobile_emulation)
-        driver = webdriver.Remote(
-            command_executor=configInstance.selenium_server,
-            options=options)
-
-        # 访问网页
-        driver.get(url)
-
-        # 获取网页的高度
-        height = driver.execute_script("return document.body.scrollHeight")
-
-        # 从顶部开始，模拟浏览网页的过程
-        for i in range(0, height, 200):
-            # 使用JavaScript代码控制滚动条滚动
-            driver.execute_script(f"window.scrollTo(0, {i});")
-            # 暂停一段时间，模拟人类浏览网页的速度
-            time.sleep(0.2)
-
-        driver.implicitly_wait(5)
-
-        # 获取网页源代码
-        source = driver.page_source
-        title = driver.title
+        with selenium_pool.lease(mobile=mobile) as driver:
+            lease_at = time.monotonic()
+            # 访问网页
+            driver.get(url)
+            load_at = time.monotonic()
+
+            # 逐屏滚动触发懒加载，直到页面高度不再变化
+            steps, height = scroll_to_load(driver)
+            scroll_at = time.monotonic()
+
+            # 获取网页源代码
+            source = driver.page_source
+            title = driver.title
     except Exception as e:
         msg = f"selenium 发生异常 {str(e)}"
         logger.warning(msg)
         raise Exception(msg) from e
-    finally:
-        if driver is not None:
-            driver.quit()
+    logger.info(f"Selenium fetch {url} done, lease: {(lease_at - start) * 1000:.0f}ms, "
+                f"load: {(load_at - lease_at) * 1000:.0f}ms, "
+                f"scroll: {(scroll_at - load_at) * 1000:.0f}ms ({steps} steps, height {height}px), "
+                f"total: {(time.monotonic() - start) * 1000:.0f}ms")
+
+    page = process_page(source)
+    page.title = title or page.title
+    return page
+
+
+# 滚动一屏后等待页面安静下来：DOM 不再变化、没有新的资源请求、视口内的图片加载完成，
+# 或者达到单步最长等待时间，返回滚动后的页面高度和位置
+SCROLL_STEP_SCRIPT = """
+var idleMs = arguments[0], maxWaitMs = arguments[1], done = arguments[arguments.length - 1];
+var root = document.scrollingElement || document.documentElement;
+window.scrollBy(0, window.innerHeight);
+var start = Date.now(), last = Date.now();
+var observer = new MutationObserver(function () { last = Date.now(); });
+observer.observe(document.documentElement, {childList: true, subtree: true});
+var resources = performance.getEntriesByType('resource').length;
+var bump = function () { last = Date.now(); };
+Array.prototype.forEach.call(document.images, function (img) {
+    if (!img.complete) {
+        img.addEventListener('load', bump, {once: true});
+        img.addEventListener('error', bump, {once: true});
+    }
+});
+(function check() {
+    var now = Date.now();
+    var count = performance.getEntriesByType('resource').length;
+    if (count !== resources) {
+        resources = count;
+        last = now;
+    }
+    var pending = Array.prototype.some.call(document.images, function (img) {
+        var rect = img.getBoundingClientRect();
+        return !img.complete && rect.bottom > 0 && rect.top < window.innerHeight;
+    });
+    if ((!pending && now - last >= idleMs) || now - start >= maxWaitMs) {
+        observer.disconnect();
+        done({height: root.scrollHeight, bottom: window.scrollY + window.innerHeight});
+        return;
+    }
+    setTimeout(check, 50);
+})();
+"""
 
-    try:
-        new_soup = BeautifulSoup(source, 'html.parser')
-
-        # 下列处理其实都是针对微信公众号文章的，暂不清楚对其他网页是否有影响
-
-        # 找到所有的<img>标签，将图片的src属性设置为data-src属性的值，并生成外链
-        img_tags = new_soup.find_all('img')
-        for img in img_tags:
-            # 如果<img>标签有data-src属性
-            if img.has_attr('data-src'):
-                # 将src属性设置为data-src属性的值
-                img['src'] = 'https://images.weserv.nl/?url=' + img['data-src']
-
-        # 找到所有的<link>标签，如果href属性的值不是以https:开头，则添加https:前缀
-        link_tags = new_soup.find_all('link')
-        for link in link_tags:
-            # 如果<link>标签有href属性
-            if link.has_attr('href'):
-                # 如果href属性的值不以https:开头
-                if not link['href'].startswith('https:') and not link['href'].startswith('http:'):
-                    # 在href属性的值前面添加https:
-                    link['href'] = 'https:' + link['href']
-
-        # 找到所有的<script>标签，删除这些标签
-        script_tags = new_soup.find_all('script')
-        for script in script_tags:
-            # 删除<script>标签
-            script.decompose()
-
-        html_content = new_soup.prettify()
-    except Exception as e:
-        logger.warning(f"请求发生异常 {str(e)}")
 
-    return html_content, title
+def scroll_to_load(driver, time_budget: float = configInstance.scroll_time_budget,
+                   idle_ms: int = configInstance.scroll_idle_ms) -> Tuple[int, int]:
+    """逐屏滚动网页以触发懒加载，每一步等待页面安静后重新测量高度，总耗时不超过 time_budget 秒
+
+    :return: (滚动步数, 最终页面高度)
+    """
+    deadline = time.monotonic() + time_budget
+    max_wait_ms = idle_ms * 6
+    driver.set_script_timeout(max_wait_ms / 1000 + 5)
+    steps = 0
+    height = 0
+    while time.monotonic() < deadline:
+        state = driver.execute_async_script(SCROLL_STEP_SCRIPT, idle_ms, max_wait_ms)
+        steps += 1
+        height = int(state['height'])
+        # 已经到底并且页面高度不再增长
+        if state['bottom'] >= height - 2:
+            break
+    else:
+        logger.info(f"Scroll time budget {time_budget}s exhausted after {steps} steps")
+    return steps, height
 
 
 def get_text_by_selenium(url, mobile: bool = False) -> str:
-    html, _ = get_url_info_by_selenium(url, mobile=mobile)
-    soup = BeautifulSoup(html, 'html.parser')
-    return soup.get_text()
+    return get_page_by_selenium(url, mobile=mobile).text
 
 
 def get_markdown_by_selenium(url, mobile: bool = False) -> str:
-    html, _ = get_url_info_by_selenium(url, mobile=mobile)
-    converter = html2text.HTML2Text()
-    converter.hard_wrap = True
-    return converter.handle(html)
+    return get_page_by_selenium(url, mobile=mobile).markdown
 
 
 def get_title_with_request(url):
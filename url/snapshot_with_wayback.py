@@ -1,24 +1,163 @@
-import requests
+import asyncio
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
+import httpx
+
+from config.config import configInstance
 from logger.logger_config import setup_logger
+from url.utils import retry_with_backoff, is_retryable
 
 logger = setup_logger('wayback')
 
 
-def snapshot_with_wayback_api(url: str):
-    """使用wayback机制进行快照
+class WaybackError(Exception):
+    pass
+
+
+class WaybackClient:
+    """Save Page Now 2 客户端
 
-    Args:
-        url (str): 目标网页
+    提交快照请求后立即返回 job id，之后按指数退避轮询 /save/status/{job_id} 直到快照完成，
+    不再阻塞等待快照完成，也不再把快照内容下载回来。
+    配置了 access key 时使用账号的额度，否则以匿名方式提交。
     """
-    wayback_api_url = 'https://web.archive.org/save/'
-    response = requests.get(wayback_api_url + url)
-    logger.info(f"wayback response: {response.status_code}")
-    if response.status_code == 200:
-        return {'url': response.url, 'text': response.text}
-    else:
-        raise Exception(response.text)
+
+    def __init__(self, base_url: str, access_key: str, secret_key: str, timeout: float,
+                 poll_interval: float, max_poll_interval: float, poll_timeout: float, max_concurrency: int):
+        self.base_url = base_url.rstrip('/')
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.poll_timeout = poll_timeout
+        self.max_concurrency = max_concurrency
+        self._client = None
+        self._semaphore = None
+
+    def _http(self) -> httpx.AsyncClient:
+        if self._client is None:
+            headers = {'Accept': 'application/json'}
+            if self.access_key and self.secret_key:
+                headers['Authorization'] = f'LOW {self.access_key}:{self.secret_key}'
+            self._client = httpx.AsyncClient(base_url=self.base_url, headers=headers,
+                                             timeout=httpx.Timeout(self.timeout, connect=10))
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._client
+
+    async def _request(self, method: str, path: str, **kwargs) -> dict:
+        client = self._http()
+        async with self._semaphore:
+            response = await client.request(method, path, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    async def submit(self, url: str) -> str:
+        """提交快照请求，返回 job id"""
+        data = await retry_with_backoff(self._request, 'POST', '/save', data={'url': url}, name='wayback_submit')
+        if not data.get('job_id'):
+            raise WaybackError(data.get('message') or data.get('status_ext') or json.dumps(data))
+        logger.info(f"Wayback capture of {url} submitted, job id: {data['job_id']}")
+        return data['job_id']
+
+    async def status(self, job_id: str) -> dict:
+        return await self._request('GET', f'/save/status/{job_id}')
+
+    async def wait(self, job_id: str) -> str:
+        """轮询快照状态直到完成，返回快照地址；快照失败或超过 poll_timeout 时抛出 WaybackError"""
+        deadline = time.monotonic() + self.poll_timeout
+        interval = self.poll_interval
+        while True:
+            try:
+                data = await self.status(job_id)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                logger.warning(f'Query wayback job {job_id} failed, retry later: {e}')
+                data = {}
+            status = data.get('status')
+            if status == 'success':
+                return self.archived_url(data)
+            if status == 'error':
+                raise WaybackError(f"{data.get('status_ext')}: {data.get('message')}")
+            if time.monotonic() + interval > deadline:
+                raise WaybackError(f'Wayback job {job_id} not finished in {self.poll_timeout:.0f}s')
+            await asyncio.sleep(interval * random.uniform(0.8, 1.2))
+            interval = min(self.max_poll_interval, interval * 2)
+
+    def archived_url(self, data: dict) -> str:
+        return f"{self.base_url}/web/{data['timestamp']}/{data['original_url']}"
+
+    async def capture(self, url: str) -> str:
+        return await self.wait(await self.submit(url))
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+wayback_client = WaybackClient(base_url=configInstance.wayback_base_url,
+                               access_key=configInstance.wayback_access_key,
+                               secret_key=configInstance.wayback_secret_key,
+                               timeout=configInstance.wayback_timeout,
+                               poll_interval=configInstance.wayback_poll_interval,
+                               max_poll_interval=configInstance.wayback_max_poll_interval,
+                               poll_timeout=configInstance.wayback_poll_timeout,
+                               max_concurrency=configInstance.wayback_max_concurrency)
+
+
+def test_with_fake_server():
+    """在本地启动模拟的 Save Page Now 服务，验证提交和轮询流程"""
+    polls = {'count': 0}
+
+    class FakeHandler(BaseHTTPRequestHandler):
+        def _reply(self, data: dict):
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self._reply({'url': 'https://example.com/', 'job_id': 'spn2-test'})
+
+        def do_GET(self):
+            polls['count'] += 1
+            if polls['count'] < 3:
+                self._reply({'status': 'pending', 'job_id': 'spn2-test'})
+            else:
+                self._reply({'status': 'success', 'job_id': 'spn2-test', 'timestamp': '20231115064412',
+                             'original_url': 'https://example.com/'})
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = WaybackClient(base_url=f'http://127.0.0.1:{server.server_port}', access_key='', secret_key='',
+                           timeout=5, poll_interval=0.1, max_poll_interval=0.2, poll_timeout=5, max_concurrency=2)
+
+    async def run():
+        try:
+            return await client.capture('https://example.com/')
+        finally:
+            await client.close()
+
+    try:
+        archived = asyncio.run(run())
+    finally:
+        server.shutdown()
+    assert archived == f'http://127.0.0.1:{server.server_port}/web/20231115064412/https://example.com/', archived
+    assert polls['count'] == 3
+    print(f'wayback fake server test passed: {archived}')
 
 
 if __name__ == '__main__':
-    snapshot_with_wayback_api('https://blog.csdn.net/qq_30934923/article/details/119803947')
+    test_with_fake_server()
@@ -0,0 +1,66 @@
+import time
+
+from telegram.constants import ParseMode
+from telegram.helpers import escape_markdown
+
+from handlers.constants import error_title, operation_title, COMMAND_SUMMARIZE
+from url.backup import BackupReply, collect_backup
+from url.reply import TELEGRAM_MESSAGE_LIMIT, edit_message, split_markdown
+from url.stream_queue import url_stream
+from url.summary import summarize_one
+
+
+async def execute_url_job(job: dict) -> None:
+    """worker 进程执行 stream 中的任务，进度和结果发布到结果 stream，失败时抛出异常由 url_stream 重试"""
+    url = job['url']
+    options = job['options']
+    target = {'chat_id': job['chat_id'], 'message_id': job['message_id'], 'url': url}
+
+    async def status(text: str):
+        await url_stream.report({'type': 'status', 'text': text, **target})
+
+    if job['command'] == COMMAND_SUMMARIZE:
+        summary, cached = await summarize_one(url, 'force' in options, status)
+        await url_stream.report({'type': 'summary', 'summary': summary, 'cached': cached, **target})
+        return
+
+    use_selenium = 'selenium' in options
+    use_wayback = 'wayback' in options
+    if not use_wayback and not use_selenium:
+        use_selenium = use_wayback = True
+    result = await collect_backup(url, 'mobile' in options, use_selenium, use_wayback, status)
+    if not result.has_files and not result.links and result.wayback != 'pending':
+        raise Exception('; '.join(result.errors))
+    # 回复消息的状态先保存到 redis，bot 收到结果前提交完成也不会丢失
+    reply = BackupReply(job['id'], job['chat_id'], job['message_id'], [url], {url: result}, {}, False, time.time())
+    await reply.prepare()
+    await url_stream.report({'type': 'backup', 'reply_id': reply.reply_id, 'reply': reply.to_dict(), **target})
+
+
+async def on_url_job_dead(job: dict, error: str) -> None:
+    await url_stream.report({'type': 'failed', 'error': error, 'chat_id': job['chat_id'],
+                             'message_id': job['message_id'], 'url': job['url']})
+
+
+async def on_url_job_event(bot, event: dict) -> None:
+    """bot 进程处理 worker 发布的进度和结果，编辑对应的占位消息"""
+    chat_id = event['chat_id']
+    message_id = event['message_id']
+    url = event['url']
+    if event['type'] == 'status':
+        await edit_message(bot, chat_id, message_id,
+                           f"{operation_title}{escape_markdown(url, 2)} {escape_markdown(event['text'], 2)}")
+    elif event['type'] == 'summary':
+        header = f"{operation_title}{escape_markdown(url, 2)} 摘要生成成功！" \
+                 f"{escape_markdown('(cached)', 2) if event['cached'] else ''}\n\n"
+        pieces = split_markdown(event['summary'], TELEGRAM_MESSAGE_LIMIT - len(header))
+        await edit_message(bot, chat_id, message_id, header + pieces[0])
+        for piece in pieces[1:]:
+            await bot.send_message(chat_id, piece, parse_mode=ParseMode.MARKDOWN_V2)
+    elif event['type'] == 'backup':
+        # redis 中的状态可能已经被提交结果更新过，已经过期时使用 worker 发布时的状态
+        reply = await BackupReply.load(event['reply_id']) or BackupReply.from_dict(event['reply_id'], event['reply'])
+        await reply.publish(bot)
+    elif event['type'] == 'failed':
+        await edit_message(bot, chat_id, message_id,
+                           f"{error_title}{escape_markdown(url, 2)}\n\n{escape_markdown(event['error'], 2)}")
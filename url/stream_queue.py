@@ -0,0 +1,226 @@
+import asyncio
+import json
+import os
+import socket
+import time
+from typing import Awaitable, Callable
+
+import redis
+
+from config.config import configInstance
+from db.redis_util import redis_async
+from handlers.constants import REDIS_URL_JOB_STREAM, REDIS_URL_JOB_GROUP, REDIS_URL_JOB_DEAD, \
+    REDIS_URL_JOB_RESULTS, REDIS_URL_JOB_RESULT_GROUP
+from logger.logger_config import setup_logger
+
+logger = setup_logger('stream_queue')
+
+# 阻塞读取 stream 的最长等待时间（毫秒）
+READ_BLOCK_MS = 5000
+# 结果超过该时间（毫秒）未被确认时，认为读取它的 bot 进程已经退出，由其他进程接手
+RESULT_RECLAIM_IDLE_MS = 60000
+
+
+class UrlJobStream:
+    """基于 redis stream 的持久化 url 任务队列，任务由可以独立扩容的 worker.py 进程执行
+
+    - bot 把任务发布到 REDIS_URL_JOB_STREAM，worker 通过消费者组 REDIS_URL_JOB_GROUP 领取，执行完成后 XACK
+    - 执行失败时重新发布并记录次数，超过 max_attempts 后移入死信 stream REDIS_URL_JOB_DEAD
+    - worker 退出时未确认的任务在 visibility_timeout 后由其他 worker 通过 XAUTOCLAIM 领取，
+      执行中的任务定期刷新空闲时间，避免耗时任务被重复领取
+    - worker 把进度和结果发布到 REDIS_URL_JOB_RESULTS，bot 通过消费者组读取后编辑对应的消息
+    """
+
+    def __init__(self, redis_util, maxlen: int, visibility_timeout: int, max_attempts: int,
+                 concurrency: int, consumer: str):
+        self.redis = redis_util
+        self.maxlen = maxlen
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.concurrency = concurrency
+        self.consumer = consumer
+        self._tasks = []
+        # message id -> 执行中的任务
+        self._inflight = {}
+
+    async def _ensure_group(self, stream: str, group: str):
+        try:
+            await self.redis.client.xgroup_create(stream, group, id='0', mkstream=True)
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    async def publish(self, job: dict) -> str:
+        """bot 发布任务，返回 message id"""
+        return await self.redis.client.xadd(REDIS_URL_JOB_STREAM, {'job': json.dumps(job), 'attempt': 1},
+                                      maxlen=self.maxlen, approximate=True)
+
+    async def report(self, event: dict):
+        """worker 发布任务进度和结果"""
+        await self.redis.client.xadd(REDIS_URL_JOB_RESULTS, {'event': json.dumps(event)},
+                               maxlen=self.maxlen, approximate=True)
+
+    async def start_worker(self, handler: Callable[[dict], Awaitable], on_dead: Callable[[dict, str], Awaitable]):
+        await self._ensure_group(REDIS_URL_JOB_STREAM, REDIS_URL_JOB_GROUP)
+        self._tasks.append(asyncio.ensure_future(self._work(handler, on_dead)))
+        self._tasks.append(asyncio.ensure_future(self._heartbeat()))
+        logger.info(f'Worker {self.consumer} started, concurrency: {self.concurrency}')
+
+    async def start_results(self, handler: Callable[[dict], Awaitable]):
+        await self._ensure_group(REDIS_URL_JOB_RESULTS, REDIS_URL_JOB_RESULT_GROUP)
+        self._tasks.append(asyncio.ensure_future(self._consume_results(handler)))
+
+    async def _work(self, handler, on_dead):
+        next_reclaim_at = 0
+        while True:
+            free = self.concurrency - len(self._inflight)
+            if free <= 0:
+                await asyncio.wait(list(self._inflight.values()), return_when=asyncio.FIRST_COMPLETED)
+                continue
+            try:
+                messages = []
+                if time.monotonic() >= next_reclaim_at:
+                    messages = await self._reclaim(free, on_dead)
+                    next_reclaim_at = time.monotonic() + self.visibility_timeout / 2
+                if not messages:
+                    # 阻塞读取期间独占一个连接池中的连接，只挂起当前协程
+                    response = await self.redis.client.xreadgroup(REDIS_URL_JOB_GROUP, self.consumer,
+                                                                  {REDIS_URL_JOB_STREAM: '>'}, count=free,
+                                                                  block=READ_BLOCK_MS)
+                    messages = response[0][1] if response else []
+            except redis.RedisError as e:
+                logger.error(f'Read url job stream failed: {e}')
+                await asyncio.sleep(READ_BLOCK_MS / 1000)
+                continue
+            for message_id, fields in messages:
+                task = asyncio.ensure_future(self._handle(message_id, fields, handler, on_dead))
+                self._inflight[message_id] = task
+                task.add_done_callback(lambda t, message_id=message_id: self._inflight.pop(message_id, None))
+
+    async def _reclaim(self, count: int, on_dead) -> list:
+        """领取其他 worker 超时未确认的任务，已经被领取过太多次的任务（例如每次都让 worker 崩溃）移入死信"""
+        client = self.redis.client
+        _, messages, *_ = await client.xautoclaim(REDIS_URL_JOB_STREAM, REDIS_URL_JOB_GROUP, self.consumer,
+                                                  min_idle_time=self.visibility_timeout * 1000, start_id='0-0', count=count)
+        reclaimed = []
+        for message_id, fields in messages:
+            if not fields:
+                # 条目已经被 XTRIM 删除
+                await client.xack(REDIS_URL_JOB_STREAM, REDIS_URL_JOB_GROUP, message_id)
+                continue
+            pending = await client.xpending_range(REDIS_URL_JOB_STREAM, REDIS_URL_JOB_GROUP, message_id, message_id, 1)
+            delivered = pending[0]['times_delivered'] if pending else 1
+            logger.warning(f'Reclaimed url job {message_id}, delivered {delivered} times')
+            if delivered > self.max_attempts:
+                await self._dead(message_id, fields, f'delivered {delivered} times without ack', on_dead)
+                continue
+            reclaimed.append((message_id, fields))
+        return reclaimed
+
+    async def _handle(self, message_id: str, fields: dict, handler, on_dead):
+        client = self.redis.client
+        job = json.loads(fields['job'])
+        attempt = int(fields.get('attempt', 1))
+        start = time.monotonic()
+        try:
+            await handler(job)
+            logger.info(f'Url job {message_id} done in {time.monotonic() - start:.1f}s, attempt {attempt}')
+        except asyncio.CancelledError:
+            # worker 退出，不确认，由其他 worker 重新领取
+            raise
+        except Exception as e:
+            if attempt < self.max_attempts:
+                delay = min(60, 5 * 2 ** (attempt - 1))
+                logger.warning(f'Url job {message_id} failed (attempt {attempt}/{self.max_attempts}), '
+                               f'retry in {delay}s: {e}')
+                await asyncio.sleep(delay)
+                await client.xadd(REDIS_URL_JOB_STREAM, {'job': fields['job'], 'attempt': attempt + 1,
+                                                         'error': str(e)},
+                                  maxlen=self.maxlen, approximate=True)
+            else:
+                await self._dead(message_id, fields, str(e), on_dead)
+        await client.xack(REDIS_URL_JOB_STREAM, REDIS_URL_JOB_GROUP, message_id)
+
+    async def _dead(self, message_id: str, fields: dict, error: str, on_dead):
+        """移入死信 stream 并调用 on_dead，让 bot 把占位消息更新为失败"""
+        logger.error(f'Url job {message_id} moved to dead letter stream: {error}')
+        async with self.redis.pipeline() as pipe:
+            pipe.xadd(REDIS_URL_JOB_DEAD, {**fields, 'error': error, 'source_id': message_id},
+                      maxlen=self.maxlen, approximate=True)
+            pipe.xack(REDIS_URL_JOB_STREAM, REDIS_URL_JOB_GROUP, message_id)
+            await pipe.execute()
+        try:
+            await on_dead(json.loads(fields['job']), error)
+        except Exception as notify_error:
+            logger.error(f'Notify dead url job {message_id} failed: {notify_error}')
+
+    async def _heartbeat(self):
+        """刷新执行中任务的空闲时间，避免耗时超过 visibility_timeout 的任务被其他 worker 领取"""
+        while True:
+            await asyncio.sleep(self.visibility_timeout / 3)
+            if not self._inflight:
+                continue
+            try:
+                await self.redis.client.xclaim(REDIS_URL_JOB_STREAM, REDIS_URL_JOB_GROUP, self.consumer, 0,
+                                               list(self._inflight.keys()), justid=True)
+            except redis.RedisError as e:
+                logger.warning(f'Refresh in-flight url jobs failed: {e}')
+
+    async def _consume_results(self, handler):
+        """每个 bot 进程使用自己的消费者名称读取结果，已退出的进程未确认的结果由其他进程通过 XAUTOCLAIM 接手"""
+        # 先处理上次没有确认的结果，再读取新的结果
+        last_id = '0'
+        next_reclaim_at = 0
+        while True:
+            try:
+                messages = []
+                if last_id == '>' and time.monotonic() >= next_reclaim_at:
+                    _, messages, *_ = await self.redis.client.xautoclaim(
+                        REDIS_URL_JOB_RESULTS, REDIS_URL_JOB_RESULT_GROUP, self.consumer,
+                        min_idle_time=RESULT_RECLAIM_IDLE_MS, start_id='0-0', count=50)
+                    next_reclaim_at = time.monotonic() + RESULT_RECLAIM_IDLE_MS / 1000
+                if not messages:
+                    response = await self.redis.client.xreadgroup(REDIS_URL_JOB_RESULT_GROUP, self.consumer,
+                                                                  {REDIS_URL_JOB_RESULTS: last_id}, count=50,
+                                                                  block=READ_BLOCK_MS if last_id == '>' else None)
+                    messages = response[0][1] if response else []
+                    if last_id == '0' and not messages:
+                        last_id = '>'
+                        continue
+            except redis.RedisError as e:
+                logger.error(f'Read url job results failed: {e}')
+                await asyncio.sleep(READ_BLOCK_MS / 1000)
+                continue
+            for message_id, fields in messages:
+                if fields:
+                    try:
+                        await handler(json.loads(fields['event']))
+                    except Exception as e:
+                        logger.error(f'Handle url job result {message_id} failed: {e}')
+                await self.redis.client.xack(REDIS_URL_JOB_RESULTS, REDIS_URL_JOB_RESULT_GROUP, message_id)
+
+    async def stats(self) -> dict:
+        client = self.redis.client
+        stats = {'inflight': len(self._inflight)}
+        for name, stream, group in (('jobs', REDIS_URL_JOB_STREAM, REDIS_URL_JOB_GROUP),
+                                    ('results', REDIS_URL_JOB_RESULTS, REDIS_URL_JOB_RESULT_GROUP)):
+            try:
+                stats[f'{name}_pending'] = (await client.xpending(stream, group))['pending']
+                stats[f'{name}_length'] = await client.xlen(stream)
+            except redis.ResponseError:
+                stats[f'{name}_length'] = 0
+        stats['dead'] = await client.xlen(REDIS_URL_JOB_DEAD)
+        return stats
+
+    async def close(self):
+        for task in self._tasks + list(self._inflight.values()):
+            task.cancel()
+        await asyncio.gather(*self._tasks, *self._inflight.values(), return_exceptions=True)
+        self._tasks = []
+
+
+url_stream = UrlJobStream(redis_async, maxlen=configInstance.url_job_stream_maxlen,
+                          visibility_timeout=configInstance.url_job_visibility_timeout,
+                          max_attempts=configInstance.url_job_max_attempts,
+                          concurrency=configInstance.worker_concurrency,
+                          consumer=configInstance.worker_name or f'{socket.gethostname()}-{os.getpid()}')
@@ -0,0 +1,70 @@
+from typing import Awaitable, Callable, Optional, Tuple
+
+from config.config import configInstance
+from logger.logger_config import setup_logger
+from url.ai_router import summary_router
+from url.ai_summary import summarize_text
+from url.executor import url_executor
+from url.fetcher import fetch_page
+from url.job_queue import url_jobs
+from url.single_flight import single_flight
+from url.utils import normalize_url, summary_cache
+
+logger = setup_logger('summary')
+
+
+async def summarize_one(url: str, force: bool, status: Callable[[str], Awaitable[None]],
+                        on_update: Optional[Callable[[str], Awaitable[None]]] = None) -> Tuple[str, bool]:
+    """抓取网页并生成摘要，抓取和生成摘要分别受 url_jobs 中对应阶段的并发限制
+
+    相同 url 的并发请求只抓取、生成一次，后来的请求直接得到第一次请求的摘要（不再流式输出）
+
+    :return: (摘要, 是否命中缓存)，失败时抛出异常
+    """
+    model = summary_router.model_key
+    prompt_prefix = configInstance.ai_prompt
+
+    logger.info(f"Begin to summarize {url}")
+    if not force:
+        cached = await summary_cache.get_by_url(url, model, prompt_prefix)
+        if cached is not None:
+            logger.info(f"🐱 文章->{url} 命中摘要缓存")
+            return cached, True
+
+    summary, cached = await single_flight.do(f'summarize:{normalize_url(url)}:{model}:{force}',
+                                             lambda: generate_summary(url, force, status, on_update))
+    return summary, cached
+
+
+async def generate_summary(url: str, force: bool, status: Callable[[str], Awaitable[None]],
+                           on_update: Optional[Callable[[str], Awaitable[None]]]) -> Tuple[str, bool]:
+    model = summary_router.model_key
+    prompt_prefix = configInstance.ai_prompt
+
+    await status('正在抓取网页...')
+    try:
+        async with url_jobs.fetch:
+            page = await url_executor.run(fetch_page, url)
+    except Exception as e:
+        logger.error(f"😿 文章->{url} 抓取失败! Error: {str(e)}")
+        raise Exception(f'Save snapshot failed, error: {str(e)}') from e
+    if page.text is None or page.text == '':
+        logger.error(f"😿 文章->{url} {page.tier} 抓取失败! 返回结果为 None 或 空字符串")
+        raise Exception('Failed to get the content of the url.')
+
+    if not force:
+        cached = await summary_cache.get(url, page.text, model, prompt_prefix)
+        if cached is not None:
+            logger.info(f"🐱 文章->{url} 命中摘要缓存")
+            return cached, True
+
+    await status('摘要生成中...')
+    try:
+        async with url_jobs.llm:
+            summary = await summarize_text(page.text, prompt_prefix, on_update=on_update)
+    except Exception as e:
+        logger.error(f"😿 文章->{url} 摘要生成失败! Error: {str(e)}")
+        raise Exception('摘要生成失败，请稍后再试。') from e
+    logger.info(f"🐱 文章->{url} 摘要生成成功!")
+    await summary_cache.set(url, page.text, model, prompt_prefix, summary)
+    return summary, False
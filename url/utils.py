@@ -1,19 +1,45 @@
+import asyncio
 import base64
+import hashlib
 import json
+import random
 import re
+import threading
+import time
+from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
 
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
 import zhipuai as zhipuai
 import openai
+from zhipuai.utils import jwt_token
 
 from config.config import configInstance
+from db.redis_util import redis_async
+from handlers.constants import REDIS_SUMMARY_CACHE_PREFIX, REDIS_SUMMARY_CACHE_URL_PREFIX, \
+    REDIS_SUMMARY_CACHE_INDEX, REDIS_SUMMARY_CACHE_STATS, REDIS_BACKUP_QUEUE, REDIS_BACKUP_PROCESSING, \
+    REDIS_BACKUP_ATTEMPTS, REDIS_BACKUP_DIGEST_INDEX, REDIS_BACKUP_DIGEST_STATS, REDIS_BACKUP_PATH_INDEX
 from logger.logger_config import setup_logger
+from url.executor import url_executor
 
 logger = setup_logger('utils')
 
 
 class GitHubRepo:
-    def __init__(self, token, repo, base_url="https://api.github.com", branch="master"):
+    """GitHub API 客户端
+
+    - 使用带连接池的 requests.Session 复用连接
+    - GET 请求缓存 ETag，重复请求带上 If-None-Match，返回 304 时直接使用缓存（304 不计入 rate limit）
+    - 本地维护 path -> sha 索引，由 GET / PUT 响应和提交的 blob 更新，重复写入同一文件时无需先查询 sha
+    - 根据响应头 X-RateLimit-* 控制请求节奏，剩余次数不多时把请求均匀分布到重置时间之前
+    """
+
+    def __init__(self, token, repo, base_url="https://api.github.com", branch="master",
+                 pool_size=configInstance.github_blob_workers, cache_size=configInstance.github_etag_cache_size,
+                 cache_bytes=configInstance.github_etag_cache_bytes):
         self.token = token
         self.repo = repo
         self.headers = {
@@ -22,107 +48,484 @@ class GitHubRepo:
         }
         self.url = f'{base_url}/repos/{self.repo}'
         self.branch = branch
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.cache_size = cache_size
+        self.cache_bytes = cache_bytes
+        self._lock = threading.Lock()
+        # url -> (etag, json, 响应体字节数)
+        self._etags = OrderedDict()
+        self._etag_bytes = 0
+        # 文件路径 -> blob sha
+        self._shas = OrderedDict()
+        self._rate_remaining = None
+        self._rate_reset = None
+        self._stats = Counter()
 
     def make_github_request(self, method, endpoint, data=None, params=None, is_json=True):
         url = f"{self.url}{endpoint}"
-        headers = self.headers
+        headers = {}
         if is_json and data:
             data = json.dumps(data)
-        response = requests.request(method, url, headers=headers, data=data, params=params)
+        cache_key = url + ('?' + urlencode(sorted(params.items())) if params else '')
+        cached = None
+        if method == 'GET':
+            with self._lock:
+                cached = self._etags.get(cache_key)
+            if cached is not None:
+                headers['If-None-Match'] = cached[0]
+
+        self._pace()
+        response = self.session.request(method, url, headers=headers, data=data, params=params,
+                                        timeout=configInstance.github_timeout)
+        self._update_rate_limit(response)
+        self._stats[method] += 1
+
+        if response.status_code == 304 and cached is not None:
+            self._stats['not_modified'] += 1
+            with self._lock:
+                self._etags.move_to_end(cache_key)
+            return cached[1]
         if response.ok:
-            return response.json()
+            result = response.json()
+            etag = response.headers.get('ETag')
+            size = len(response.content)
+            # 只缓存 ref、commit、tree 等较小的响应，带 base64 内容的大文件不缓存
+            if method == 'GET' and etag and size <= self.cache_bytes // 8:
+                with self._lock:
+                    old = self._etags.pop(cache_key, None)
+                    if old is not None:
+                        self._etag_bytes -= old[2]
+                    self._etags[cache_key] = (etag, result, size)
+                    self._etag_bytes += size
+                    while len(self._etags) > self.cache_size or self._etag_bytes > self.cache_bytes:
+                        _, evicted = self._etags.popitem(last=False)
+                        self._etag_bytes -= evicted[2]
+            return result
         else:
             response.raise_for_status()
 
+    def _update_rate_limit(self, response):
+        remaining = response.headers.get('X-RateLimit-Remaining')
+        reset = response.headers.get('X-RateLimit-Reset')
+        if remaining is None or reset is None:
+            return
+        with self._lock:
+            self._rate_remaining = int(remaining)
+            self._rate_reset = int(reset)
+
+    def _pace(self):
+        """剩余次数低于 github_rate_limit_reserve 时，按 剩余时间 / 剩余次数 的间隔发起请求，用完后等待到重置时间"""
+        with self._lock:
+            remaining = self._rate_remaining
+            reset = self._rate_reset
+        if remaining is None or remaining >= configInstance.github_rate_limit_reserve:
+            return
+        wait = reset - time.time()
+        if wait <= 0:
+            return
+        if remaining > 0:
+            wait = wait / remaining
+        if wait > configInstance.github_rate_limit_max_wait:
+            raise Exception(f'GitHub rate limit exceeded, {remaining} requests left, '
+                            f'reset in {reset - time.time():.0f}s')
+        logger.warning(f'GitHub rate limit {remaining} left, wait {wait:.1f}s')
+        time.sleep(wait)
+
+    def _remember_sha(self, path, sha):
+        with self._lock:
+            if sha is None:
+                self._shas.pop(path, None)
+                return
+            self._shas[path] = sha
+            self._shas.move_to_end(path)
+            while len(self._shas) > self.cache_size:
+                self._shas.popitem(last=False)
+
+    def stats(self) -> dict:
+        stats = dict(self._stats)
+        stats['rate_remaining'] = self._rate_remaining
+        stats['cached_etags'] = len(self._etags)
+        stats['cached_etag_bytes'] = self._etag_bytes
+        stats['known_shas'] = len(self._shas)
+        return stats
+
     def get_branch_info(self):
         return self.make_github_request('GET', f'/branches/{self.branch}')
 
+    def get_file_info(self, path):
+        """获取文件信息并记录 sha，文件不存在时返回 None"""
+        try:
+            file_info = self.make_github_request('GET', f'/contents/{path}', params={'ref': self.branch})
+        except requests.HTTPError as e:
+            if e.response.status_code != 404:
+                raise  # 如果不是404错误，重新抛出异常
+            self._remember_sha(path, None)
+            return None
+        self._remember_sha(path, file_info.get('sha'))
+        return file_info
+
     def get_contents(self, path):
         try:
-            file_info = self.make_github_request('GET', f'/contents/{path}?ref={self.branch}')
+            file_info = self.get_file_info(path)
+            if file_info is None:
+                return None
             content = base64.b64decode(file_info["content"]).decode("utf-8")
             return content
         except requests.HTTPError:
             return None
 
     def create_or_update_file(self, path, content, message):
-        branch_info = self.get_branch_info()
         encoded_content = base64.b64encode(content.encode("utf-8")).decode("utf-8")
         data = {
             "message": message,
             "content": encoded_content,
             "branch": self.branch
         }
+        with self._lock:
+            sha = self._shas.get(path)
+        known = sha is not None
+        if not known:
+            file_info = self.get_file_info(path)
+            if file_info is not None:
+                sha = file_info['sha']
+        if sha is not None:
+            data['sha'] = sha  # 文件存在，添加sha进行更新
+
         try:
-            file_info = self.make_github_request('GET', f'/contents/{path}?ref={self.branch}')
-            if 'sha' in file_info:
-                data['sha'] = file_info['sha']  # 文件存在，添加sha进行更新
+            response = self.make_github_request('PUT', f'/contents/{path}', data)
         except requests.HTTPError as e:
-            if e.response.status_code != 404:
-                raise  # 如果不是404错误，重新抛出异常
-
-        response = self.make_github_request('PUT', f'/contents/{path}', data)
+            # 本地记录的 sha 已过期（文件被其他地方修改），重新查询后再写入一次
+            if not known or e.response.status_code not in (409, 422):
+                raise
+            self._remember_sha(path, None)
+            return self.create_or_update_file(path, content, message)
+        self._remember_sha(path, response['content']['sha'])
         return response
 
     def delete_file(self, path, message):
-        branch_info = self.get_branch_info()
-        file_info = self.make_github_request('GET', f'/contents/{path}?ref={self.branch}')
+        with self._lock:
+            sha = self._shas.get(path)
+        if sha is None:
+            sha = self.make_github_request('GET', f'/contents/{path}', params={'ref': self.branch})["sha"]
         data = {
             "message": message,
-            "sha": file_info["sha"],
+            "sha": sha,
             "branch": self.branch
         }
-        if 'commit' in branch_info:
-            data['branch'] = branch_info['commit']['sha']
         response = self.make_github_request('DELETE', f'/contents/{path}', data)
+        self._remember_sha(path, None)
         return response
 
-    def add_files_to_repo(self, files):
+    def create_blob(self, content):
+        """上传文件内容，返回 blob 的 sha；bytes 使用 base64 编码上传"""
+        if isinstance(content, bytes):
+            data = {'content': base64.b64encode(content).decode('utf-8'), 'encoding': 'base64'}
+        else:
+            data = {'content': content, 'encoding': 'utf-8'}
+        return self.make_github_request('POST', '/git/blobs', data)['sha']
+
+    def add_files_to_repo(self, files, message='Add multiple files',
+                          retries=configInstance.github_commit_retries):
         """
         添加多个文件到GitHub仓库的一个commit中。
-        :param files: 一个字典，包含文件路径和内容。
+        :param files: 一个字典，包含文件路径和内容（str 或 bytes）。
+        :param message: commit message
+        :param retries: 分支在提交期间被其他提交更新导致更新引用失败时的重试次数
+        :return: 新 commit 的 sha
         """
         try:
-            # 1. 获取最新的commit SHA
-            commit_data = self.make_github_request('GET', f'/git/ref/heads/{self.branch}')
-            commit_sha = commit_data['object']['sha']
-
-            # 2. 获取最新commit的树的SHA
-            commit = self.make_github_request('GET', f'/git/commits/{commit_sha}')
-            tree_sha = commit['tree']['sha']
-
-            # 3. 为新的文件创建blob
-            blobs = []
-            for file_path, content in files.items():
-                blob_data = self.make_github_request('POST', '/git/blobs', {'content': content, 'encoding': 'utf-8'})
-                blobs.append({'path': file_path, 'mode': '100644', 'type': 'blob', 'sha': blob_data['sha']})
-
-            # 4. 创建一个新的树
-            new_tree = self.make_github_request('POST', '/git/trees', {'base_tree': tree_sha, 'tree': blobs})
-
-            # 5. 创建一个新的commit
-            new_commit = self.make_github_request('POST', '/git/commits', {
-                'parents': [commit_sha],
-                'tree': new_tree['sha'],
-                'message': 'Add multiple files'
-            })
-
-            # 6. 更新引用
-            self.make_github_request('PATCH', f'/git/refs/heads/{self.branch}', {'sha': new_commit['sha']})
-
-            print('Files added successfully.')
+            # 0. 内容与仓库中已知的文件相同时不再提交，例如同一网页被连续备份两次
+            with self._lock:
+                known = {path: self._shas.get(path) for path in files}
+            unchanged = [path for path, content in files.items() if known[path] == git_blob_sha(content)]
+            if unchanged:
+                logger.info(f'Skip {len(unchanged)} unchanged files: {unchanged}')
+                files = {path: content for path, content in files.items() if path not in unchanged}
+            if not files:
+                return self.make_github_request('GET', f'/git/ref/heads/{self.branch}')['object']['sha']
+
+            # 1. 并发为新的文件创建blob，blob 与分支无关，重试时可以复用
+            with ThreadPoolExecutor(max_workers=configInstance.github_blob_workers) as pool:
+                shas = list(pool.map(self.create_blob, files.values()))
+            blobs = [{'path': file_path, 'mode': '100644', 'type': 'blob', 'sha': sha}
+                     for file_path, sha in zip(files.keys(), shas)]
+
+            for attempt in range(retries + 1):
+                # 2. 获取最新的commit SHA
+                commit_data = self.make_github_request('GET', f'/git/ref/heads/{self.branch}')
+                commit_sha = commit_data['object']['sha']
+
+                # 3. 获取最新commit的树的SHA
+                commit = self.make_github_request('GET', f'/git/commits/{commit_sha}')
+                tree_sha = commit['tree']['sha']
+
+                # 4. 创建一个新的树
+                new_tree = self.make_github_request('POST', '/git/trees', {'base_tree': tree_sha, 'tree': blobs})
+
+                # 5. 创建一个新的commit
+                new_commit = self.make_github_request('POST', '/git/commits', {
+                    'parents': [commit_sha],
+                    'tree': new_tree['sha'],
+                    'message': message
+                })
+
+                # 6. 更新引用，分支已被其他提交更新时不是 fast forward，基于最新的 commit 重新提交
+                try:
+                    self.make_github_request('PATCH', f'/git/refs/heads/{self.branch}',
+                                             {'sha': new_commit['sha'], 'force': False})
+                except requests.HTTPError as e:
+                    if e.response.status_code not in (409, 422) or attempt == retries:
+                        raise
+                    logger.warning(f'Update ref conflicted, retry {attempt + 1}/{retries}: {e}')
+                    time.sleep(random.uniform(0.5, 1.5) * (attempt + 1))
+                    continue
+
+                for blob in blobs:
+                    self._remember_sha(blob['path'], blob['sha'])
+                logger.info(f'{len(files)} files added in commit {new_commit["sha"]}.')
+                return new_commit['sha']
 
         except Exception as e:
-            msg = f'An error occurred when add files to repo params: {files}, error: {e}'
+            msg = f'An error occurred when add files to repo params: {list(files.keys())}, error: {e}'
             logger.error(msg)
             raise Exception(msg)
 
 
+def git_blob_sha(content) -> str:
+    """按 git 的方式计算文件内容的 blob sha，与 GitHub 返回的 sha 一致"""
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.sha1(b'blob %d\0' % len(content) + content).hexdigest()
+
+
 github_repo = GitHubRepo(token=configInstance.github_token,
                          repo=f"{configInstance.github_username}/{configInstance.github_repo}",
                          base_url=configInstance.github_api_base)
 
 
+# wayback 快照中每次都会变化的内容：资源链接中的时间戳、注入的 wombat 初始化脚本以及末尾的归档信息注释
+wayback_timestamp_re = re.compile(r'/web/\d{14}(?:[a-z]{2}_)?/')
+wayback_wombat_re = re.compile(r'__wm\.wombat\([^)]*\)')
+wayback_comment_re = re.compile(r'<!--\s*FILE ARCHIVED ON.*?-->', re.S)
+whitespace_re = re.compile(r'\s+')
+
+
+def content_digest(content) -> str:
+    """备份内容去重使用的摘要：文本先去掉 wayback 快照中每次都会变化的内容并合并空白，bytes 直接计算"""
+    if isinstance(content, bytes):
+        return hashlib.sha256(content).hexdigest()
+    content = wayback_timestamp_re.sub('/web/', content)
+    content = wayback_wombat_re.sub('', content)
+    content = wayback_comment_re.sub('', content)
+    content = whitespace_re.sub(' ', content).strip()
+    return sha256_hex(content)
+
+
+# 写入一批路径：路径原来的内容摘要仍然指向该路径时删除，再记录新的 摘要 <-> 路径；摘要为空表示内容未知，只删除旧记录
+# KEYS: 摘要索引, 路径索引  ARGV: path1, digest1, path2, digest2, ...
+REMEMBER_PATHS_SCRIPT = """
+for i = 1, #ARGV, 2 do
+    local path, digest = ARGV[i], ARGV[i + 1]
+    local old = redis.call('hget', KEYS[2], path)
+    if old and old ~= digest and redis.call('hget', KEYS[1], old) == path then
+        redis.call('hdel', KEYS[1], old)
+    end
+    if digest == '' then
+        redis.call('hdel', KEYS[2], path)
+    else
+        redis.call('hset', KEYS[2], path, digest)
+        redis.call('hset', KEYS[1], digest, path)
+    end
+end
+return #ARGV / 2
+"""
+
+
+class BackupIndex:
+    """已提交到 GitHub 的备份内容索引，相同内容不再重复上传
+
+    - 摘要索引（内容摘要 -> 仓库中的路径）用于查找，路径索引（路径 -> 当前内容的摘要）用于校验：
+      同一路径之后被写入了其他内容（例如网页更新或者标题相同的另一个网页）时，旧摘要不再命中
+    """
+
+    def __init__(self, redis_util, digest_key: str = REDIS_BACKUP_DIGEST_INDEX,
+                 path_key: str = REDIS_BACKUP_PATH_INDEX, stats_key: str = REDIS_BACKUP_DIGEST_STATS):
+        self.redis = redis_util
+        self.digest_key = digest_key
+        self.path_key = path_key
+        self.stats_key = stats_key
+
+    async def get_many(self, digests: list) -> dict:
+        """查询多个摘要，返回 摘要 -> 已有路径（未备份过的为 None）；只有路径当前的内容仍是该摘要时才算命中"""
+        if not digests:
+            return {}
+        paths = await self.redis.client.hmget(self.digest_key, digests)
+        found = dict(zip(digests, paths))
+        candidates = [(digest, path) for digest, path in found.items() if path]
+        if candidates:
+            current = await self.redis.client.hmget(self.path_key, [path for _, path in candidates])
+            for (digest, path), current_digest in zip(candidates, current):
+                if current_digest != digest:
+                    found[digest] = None
+        hit = sum(1 for path in found.values() if path)
+        await self.redis.execute(('hincrby', self.stats_key, 'hit', hit),
+                                 ('hincrby', self.stats_key, 'miss', len(found) - hit))
+        return found
+
+    async def remember(self, written: dict):
+        """记录一次提交写入的 路径 -> 摘要（内容未知时为 None），只在提交成功后调用"""
+        if written:
+            args = [value for path, digest in written.items() for value in (path, digest or '')]
+            await self.redis.client.eval(REMEMBER_PATHS_SCRIPT, 2, self.digest_key, self.path_key, *args)
+
+    async def stats(self) -> dict:
+        stats, size = await self.redis.execute(('hgetall', self.stats_key), ('hlen', self.digest_key))
+        stats['size'] = size
+        return stats
+
+
+backup_index = BackupIndex(redis_async)
+
+
+class BackupCommitter:
+    """备份文件的合并提交器（write-behind）
+
+    备份文件先写入 redis 列表，后台任务每隔 interval 秒或者积累 max_files 个文件时，
+    把它们合并为一个 commit 通过 add_files_to_repo 提交，避免每次备份各自提交、争抢分支引用。
+    队列中每个条目是一个 job 的全部文件，提交中的条目会先移动到 processing 列表，提交结束后才删除，
+    重启后未完成的 job 会继续提交。提交结束后以 (job 列表, commit sha, 错误) 回调 listener。
+    """
+
+    def __init__(self, repo: GitHubRepo, redis_util, index: BackupIndex,
+                 interval: float, max_files: int, retries: int):
+        self.repo = repo
+        self.redis = redis_util
+        self.index = index
+        self.interval = interval
+        self.max_files = max_files
+        self.retries = retries
+        self._listener = None
+        self._wakeup = None
+        self._task = None
+        # 上次提交后新加入的文件数，只用于判断是否提前提交
+        self._queued_files = 0
+
+    def start(self, listener=None):
+        """在事件循环中启动后台提交任务"""
+        self._listener = listener
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+        # 重启前未完成的 job 在第一次循环中立即提交
+        self._wakeup.set()
+
+    async def enqueue(self, job_id: str, files: dict, digests: dict = None) -> None:
+        """把 job 的文件（路径 -> str 或 bytes 内容）作为一个条目加入待提交队列，同一 job 的文件总是在同一个 commit 中
+
+        :param digests: 路径 -> 内容摘要，提交成功后写入去重索引
+        """
+        digests = digests or {}
+        entries = []
+        for path, content in files.items():
+            if isinstance(content, bytes):
+                entry = {'path': path, 'encoding': 'base64', 'content': base64.b64encode(content).decode('utf-8')}
+            else:
+                entry = {'path': path, 'encoding': 'utf-8', 'content': content}
+            entry['digest'] = digests.get(path)
+            entries.append(entry)
+        if not entries:
+            return
+        await self.redis.client.rpush(REDIS_BACKUP_QUEUE, json.dumps({'job': job_id, 'files': entries}))
+        self._queued_files += len(entries)
+        if self._queued_files >= self.max_files and self._wakeup is not None:
+            self._wakeup.set()
+
+    async def pending(self) -> int:
+        """等待提交的 job 数"""
+        return sum(await self.redis.execute(('llen', REDIS_BACKUP_QUEUE), ('llen', REDIS_BACKUP_PROCESSING)))
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f'Flush backup queue failed: {e}')
+            if self._queued_files >= self.max_files:
+                self._wakeup.set()
+
+    async def flush(self):
+        """提交一批文件，上次没有提交成功（包括重启前）的 job 优先"""
+        client = self.redis.client
+        jobs = [json.loads(raw) for raw in await client.lrange(REDIS_BACKUP_PROCESSING, 0, -1)]
+        count = sum(len(job['files']) for job in jobs)
+        while count < self.max_files:
+            raw = await client.lmove(REDIS_BACKUP_QUEUE, REDIS_BACKUP_PROCESSING, 'LEFT', 'RIGHT')
+            if raw is None:
+                break
+            job = json.loads(raw)
+            jobs.append(job)
+            count += len(job['files'])
+            self._queued_files = max(0, self._queued_files - len(job['files']))
+        if not jobs:
+            return
+
+        files = {}
+        digests = {}
+        for job in jobs:
+            for entry in job['files']:
+                content = entry['content']
+                if entry['encoding'] == 'base64':
+                    content = base64.b64decode(content)
+                # 同一路径多次写入时以最后一次为准
+                files[entry['path']] = content
+                digests[entry['path']] = entry.get('digest')
+        job_ids = [job['job'] for job in jobs]
+
+        sha = None
+        error = None
+        try:
+            sha = await url_executor.run(self.repo.add_files_to_repo, files,
+                                         f'Backup {len(files)} files from {len(job_ids)} requests')
+        except Exception as e:
+            attempts = await client.incr(REDIS_BACKUP_ATTEMPTS)
+            if attempts < self.retries:
+                logger.warning(f'Commit {len(files)} backup files failed ({attempts}/{self.retries}), '
+                               f'retry in next flush: {e}')
+                return
+            error = str(e)
+            logger.error(f'Commit {len(files)} backup files failed {attempts} times, give up: {e}')
+        await client.delete(REDIS_BACKUP_PROCESSING, REDIS_BACKUP_ATTEMPTS)
+        if error is None:
+            await self.index.remember(digests)
+
+        if self._listener is not None:
+            try:
+                await self._listener(job_ids, sha, error)
+            except Exception as e:
+                logger.error(f'Notify backup commit listener failed: {e}')
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            logger.info(f'Backup committer stopped, {await self.pending()} jobs left in queue')
+
+
+backup_committer = BackupCommitter(github_repo, redis_async, backup_index,
+                                   interval=configInstance.backup_flush_interval,
+                                   max_files=configInstance.backup_flush_max_files,
+                                   retries=configInstance.backup_flush_retries)
+
+
 def sanitize_string(input_str):
     illegal_re = r'[~^:*?[\]\\/|<>".%]'
     control_re = r'[\x00-\x1f\x7f]'
@@ -137,21 +540,212 @@ def sanitize_string(input_str):
     return input_str
 
 
-def summarize_content_by_zhipuai(prompt: str, api_key: str, model_name="chatglm_turbo", **kwargs):
-    zhipuai.api_key = api_key
-    response = zhipuai.model_api.invoke(model=model_name,
-                                        prompt=[{"role": "user", "content": prompt}],
-                                        temperature=0.95,
-                                        top_p=0.7,
-                                        return_type="text",
-                                        **kwargs)
-    return response
+# 不影响网页内容的跟踪参数
+tracking_params = {'spm', 'from', 'scene', 'share_token', 'sharer_sharetime', 'sharer_shareid', 'clicktime',
+                   'enterid', 'chksm'}
+
+
+def normalize_url(url: str) -> str:
+    """统一 url 的写法：host 小写，去掉锚点和 utm_ 等跟踪参数，参数按名称排序"""
+    parsed = urlparse(url.strip())
+    query = [(k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True)
+             if not k.startswith('utm_') and k not in tracking_params]
+    path = parsed.path.rstrip('/') or '/'
+    return urlunparse((parsed.scheme.lower(), parsed.netloc.lower(), path, parsed.params,
+                       urlencode(sorted(query)), ''))
+
+
+def sha256_hex(*parts) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\x00')
+    return digest.hexdigest()
+
+
+class SummaryCache:
+    """基于 redis 的摘要缓存
+
+    key 由规范化后的 url、正文内容 hash、模型名称以及 prompt 共同决定，任一变化都不会命中旧缓存；
+    同时记录 url -> 最近一次的缓存 key，重复请求无需重新抓取网页即可直接返回。
+    缓存有过期时间，总条数超过 max_size 时淘汰最久未被访问的条目。
+    """
+
+    def __init__(self, redis_util, ttl: int, max_size: int):
+        self.redis = redis_util
+        self.ttl = ttl
+        self.max_size = max_size
+
+    @staticmethod
+    def _url_key(url: str, model: str, prompt: str) -> str:
+        return REDIS_SUMMARY_CACHE_URL_PREFIX + sha256_hex(normalize_url(url), model, prompt)
+
+    @staticmethod
+    def _content_key(url: str, text: str, model: str, prompt: str) -> str:
+        return REDIS_SUMMARY_CACHE_PREFIX + sha256_hex(normalize_url(url), sha256_hex(text), model, prompt)
+
+    async def get_by_url(self, url: str, model: str, prompt: str):
+        """不抓取网页，直接根据 url 查找最近一次的摘要，未命中时不计入 miss"""
+        key = await self.redis.get(self._url_key(url, model, prompt))
+        summary = await self.redis.get(key) if key else None
+        if summary is not None:
+            await self.redis.execute(('zadd', REDIS_SUMMARY_CACHE_INDEX, {key: time.time()}),
+                                     ('hincrby', REDIS_SUMMARY_CACHE_STATS, 'hit', 1))
+        return summary
+
+    async def get(self, url: str, text: str, model: str, prompt: str):
+        key = self._content_key(url, text, model, prompt)
+        summary = await self.redis.get(key)
+        commands = [('hincrby', REDIS_SUMMARY_CACHE_STATS, 'hit' if summary is not None else 'miss', 1)]
+        if summary is not None:
+            commands += [('zadd', REDIS_SUMMARY_CACHE_INDEX, {key: time.time()}),
+                         ('setex', self._url_key(url, model, prompt), self.ttl, key)]
+        await self.redis.execute(*commands)
+        return summary
+
+    async def set(self, url: str, text: str, model: str, prompt: str, summary: str):
+        key = self._content_key(url, text, model, prompt)
+        async with self.redis.pipeline() as pipe:
+            pipe.setex(key, self.ttl, summary)
+            pipe.setex(self._url_key(url, model, prompt), self.ttl, key)
+            pipe.zadd(REDIS_SUMMARY_CACHE_INDEX, {key: time.time()})
+            # 清理索引中已经过期的条目
+            pipe.zremrangebyscore(REDIS_SUMMARY_CACHE_INDEX, '-inf', time.time() - self.ttl)
+            pipe.zcard(REDIS_SUMMARY_CACHE_INDEX)
+            size = (await pipe.execute())[-1]
+        if size > self.max_size:
+            evicted = await self.redis.client.zpopmin(REDIS_SUMMARY_CACHE_INDEX, size - self.max_size)
+            if evicted:
+                await self.redis.delete(*[k for k, _ in evicted])
+
+    async def stats(self) -> dict:
+        stats, size = await self.redis.execute(('hgetall', REDIS_SUMMARY_CACHE_STATS),
+                                               ('zcard', REDIS_SUMMARY_CACHE_INDEX))
+        hit = int(stats.get('hit', 0))
+        miss = int(stats.get('miss', 0))
+        return {'hit': hit, 'miss': miss, 'hit_rate': f'{hit / (hit + miss):.2%}' if hit + miss else '-',
+                'size': size}
+
+
+summary_cache = SummaryCache(redis_async, ttl=configInstance.summary_cache_ttl,
+                             max_size=configInstance.summary_cache_max_size)
+
+
+class AIClientRegistry:
+    """AI 服务的客户端注册表，每个 provider + base url 只创建一个长连接的异步客户端
+
+    所有请求共用连接池，保留 HTTP keep-alive 和 TLS 会话，连接数和超时时间可配置
+    """
+
+    def __init__(self, max_connections: int, timeout: float):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._clients = {}
+
+    def _http_client(self) -> httpx.AsyncClient:
+        limits = httpx.Limits(max_connections=self.max_connections,
+                              max_keepalive_connections=self.max_connections)
+        return httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(self.timeout, connect=10))
+
+    def openai(self, api_key: str, base_url: str) -> openai.AsyncOpenAI:
+        key = ('openai', base_url, api_key)
+        if key not in self._clients:
+            # 重试由 retry_with_backoff 统一处理
+            self._clients[key] = openai.AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0,
+                                                    timeout=self.timeout, http_client=self._http_client())
+        return self._clients[key]
+
+    def zhipuai(self, base_url: str) -> httpx.AsyncClient:
+        key = ('zhipuai', base_url)
+        if key not in self._clients:
+            self._clients[key] = self._http_client()
+        return self._clients[key]
+
+    async def close(self):
+        clients = list(self._clients.values())
+        self._clients.clear()
+        for client in clients:
+            if isinstance(client, httpx.AsyncClient):
+                await client.aclose()
+            else:
+                await client.close()
+
+
+ai_clients = AIClientRegistry(max_connections=configInstance.ai_max_connections, timeout=configInstance.ai_timeout)
+
+
+def is_retryable(e: Exception) -> bool:
+    """4xx 错误（超时、冲突、限流除外）重试也不会成功"""
+    status_code = None
+    if isinstance(e, openai.APIStatusError):
+        status_code = e.status_code
+    elif isinstance(e, httpx.HTTPStatusError):
+        status_code = e.response.status_code
+    return status_code is None or status_code >= 500 or status_code in (408, 409, 429)
+
+
+async def retry_with_backoff(func, *args, retries: int = configInstance.ai_retry_times,
+                             base_delay: float = configInstance.ai_retry_base_delay, max_delay: float = 30,
+                             name: str = None, **kwargs):
+    """失败后按指数退避（带随机抖动）重试异步函数，最多执行 retries 次"""
+    name = name or getattr(func, '__name__', repr(func))
+    for i in range(retries):
+        try:
+            return await func(*args, **kwargs)
+        except Exception as e:
+            if i == retries - 1 or not is_retryable(e):
+                logger.error(f"[{name}] 第 {i + 1} 次执行失败，不再重试! Error: {str(e)}")
+                raise
+            delay = min(max_delay, base_delay * 2 ** i) * random.uniform(0.5, 1)
+            logger.warning(f"[{name}] 第 {i + 1} 次执行失败，{delay:.1f}s 后重试! Error: {str(e)}")
+            await asyncio.sleep(delay)
+
+
+async def summarize_content_by_zhipuai(prompt: str, api_key: str, model_name="chatglm_turbo", **kwargs):
+    client = ai_clients.zhipuai(zhipuai.model_api_url)
+    params = dict(prompt=[{"role": "user", "content": prompt}], temperature=0.95, top_p=0.7,
+                  return_type="text", **kwargs)
+    # 不修改全局的 zhipuai.api_key，每次请求使用各自的 token
+    headers = {"Authorization": jwt_token.generate_token(api_key)}
+    response = await client.post(f"{zhipuai.model_api_url}/{model_name}/invoke", json=params, headers=headers)
+    response.raise_for_status()
+    return response.json()
+
+
+async def summarize_content(prompt: str, model_name="gpt-4-1106-preview", **kwargs):
+    client = ai_clients.openai(configInstance.openai_key, configInstance.openai_api_base)
+    res = await client.chat.completions.create(model=model_name, messages=[{"role": "user", "content": prompt}])
+    return res
 
 
-def summarize_content(prompt: str, model_name="gpt-4-1106-preview", **kwargs):
-    client = openai.OpenAI(api_key=configInstance.openai_key, base_url=configInstance.openai_api_base)
-    res = client.chat.completions.create(model=model_name, messages=[{"role": "user", "content": prompt}])
-    return res
+async def summarize_content_stream(prompt: str, model_name="gpt-4-1106-preview", **kwargs):
+    """流式生成摘要，逐段返回模型输出的文本"""
+    client = ai_clients.openai(configInstance.openai_key, configInstance.openai_api_base)
+    stream = await client.chat.completions.create(model=model_name, messages=[{"role": "user", "content": prompt}],
+                                                  stream=True)
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+def test_backup_index_overwrite():
+    """同一路径在两次提交中写入不同内容后，旧内容的摘要不再命中（需要本地 redis）"""
+    index = BackupIndex(redis_async, 'test_backup_digest_index', 'test_backup_path_index', 'test_backup_digest_stats')
+
+    async def run():
+        try:
+            await index.remember({'backup/title.html': 'digest-v1'})
+            assert (await index.get_many(['digest-v1'])) == {'digest-v1': 'backup/title.html'}
+            # 第二次提交覆盖了同一路径
+            await index.remember({'backup/title.html': 'digest-v2', 'backup/other.html': None})
+            found = await index.get_many(['digest-v1', 'digest-v2'])
+            assert found == {'digest-v1': None, 'digest-v2': 'backup/title.html'}, found
+            print('backup index overwrite test passed')
+        finally:
+            await redis_async.delete(index.digest_key, index.path_key, index.stats_key)
+            await redis_async.close()
+
+    asyncio.run(run())
 
 
 def test_add_files_to_repo():
@@ -170,10 +764,11 @@ def test_create_or_update_file():
 
 def test_summarize_content_by_openai():
     prompt = "what is ojbk in Chinese"
-    res = summarize_content_by_openai(prompt)
+    res = asyncio.run(summarize_content(prompt))
     print(res)
 
 if __name__ == '__main__':
+    test_backup_index_overwrite()
     test_summarize_content_by_openai()
     test_create_or_update_file()
     test_add_files_to_repo()
@@ -0,0 +1,174 @@
+import asyncio
+import hmac
+import json
+from http import HTTPStatus
+from urllib.parse import urlparse
+
+from telegram import Update
+from telegram.ext import Application
+
+from config.config import configInstance
+from logger.logger_config import setup_logger
+
+logger = setup_logger('webhook')
+
+# 单个 update 的最大字节数，超出直接拒绝
+MAX_BODY_BYTES = 1024 * 1024
+# update_queue 已满时让 telegram 稍后重试的秒数
+RETRY_AFTER_SECONDS = 5
+
+
+class WebhookApp:
+    """接收 telegram webhook 的 ASGI 应用
+
+    - 校验 X-Telegram-Bot-Api-Secret-Token，不匹配时返回 403
+    - update 放入有界的 application.update_queue 后立即返回 200，由 application 在后台处理；
+      队列已满时返回 503，telegram 会稍后重新推送
+    - 不依赖 web 框架，可以单独用 uvicorn 运行，也可以挂载到 telegram_http 的 FastAPI 应用中：
+      app.mount('/telegram', WebhookApp(application, secret_token, '/'))
+    - 多个副本部署在负载均衡之后时，每个副本处理自己收到的 update；备份的合并提交和 wayback 快照的等待
+      通过 redis 中的 leader 锁（url/leader.py）只在其中一个副本运行
+    """
+
+    def __init__(self, application: Application, secret_token: str, path: str):
+        self.application = application
+        self.secret_token = secret_token
+        self.path = path
+        self.stats = {'accepted': 0, 'rejected': 0, 'forbidden': 0, 'invalid': 0}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            # 生命周期由 run_webhook 管理
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            return
+
+        if scope['method'] == 'GET' and scope['path'] == '/healthz':
+            queue = self.application.update_queue
+            await self._respond(send, HTTPStatus.OK, {'queue': queue.qsize(), 'maxsize': queue.maxsize, **self.stats})
+            return
+        if scope['path'] != self.path:
+            await self._respond(send, HTTPStatus.NOT_FOUND)
+            return
+        if scope['method'] != 'POST':
+            await self._respond(send, HTTPStatus.METHOD_NOT_ALLOWED)
+            return
+
+        headers = dict(scope['headers'])
+        # 按字节比较，请求头中有非 ASCII 字符时 compare_digest 比较 str 会抛出 TypeError
+        token = headers.get(b'x-telegram-bot-api-secret-token', b'')
+        if not hmac.compare_digest(token, self.secret_token.encode()):
+            self.stats['forbidden'] += 1
+            logger.warning(f"Webhook request with invalid secret token from {scope.get('client')}")
+            await self._respond(send, HTTPStatus.FORBIDDEN)
+            return
+
+        body = bytearray()
+        while True:
+            message = await receive()
+            body.extend(message.get('body', b''))
+            if len(body) > MAX_BODY_BYTES:
+                self.stats['invalid'] += 1
+                await self._respond(send, HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+                return
+            if not message.get('more_body'):
+                break
+
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except Exception as e:
+            self.stats['invalid'] += 1
+            logger.warning(f'Invalid webhook update: {e}')
+            await self._respond(send, HTTPStatus.BAD_REQUEST)
+            return
+
+        try:
+            self.application.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.stats['rejected'] += 1
+            logger.warning(f'Update queue is full, reject update {update.update_id}')
+            await self._respond(send, HTTPStatus.SERVICE_UNAVAILABLE,
+                                headers=[(b'retry-after', str(RETRY_AFTER_SECONDS).encode())])
+            return
+        self.stats['accepted'] += 1
+        await self._respond(send, HTTPStatus.OK)
+
+    @staticmethod
+    async def _respond(send, status: HTTPStatus, data: dict = None, headers: list = None):
+        body = json.dumps(data if data is not None else {'status': status.phrase}).encode('utf-8')
+        await send({'type': 'http.response.start', 'status': status.value,
+                    'headers': [(b'content-type', b'application/json'),
+                                (b'content-length', str(len(body)).encode())] + (headers or [])})
+        await send({'type': 'http.response.body', 'body': body})
+
+
+async def run_webhook(application: Application, post_init, post_shutdown) -> None:
+    """以 webhook 模式运行 bot：手动管理 application 的生命周期，用 uvicorn 运行 WebhookApp"""
+    import uvicorn
+
+    if not configInstance.telegram_webhook_secret:
+        raise ValueError('TELEGRAM_WEBHOOK_SECRET is required in webhook mode')
+    path = urlparse(configInstance.telegram_webhook_url).path or '/'
+    webhook_app = WebhookApp(application, configInstance.telegram_webhook_secret, path)
+    server = uvicorn.Server(uvicorn.Config(webhook_app, host=configInstance.telegram_webhook_listen,
+                                           port=configInstance.telegram_webhook_port, log_level='warning'))
+
+    await application.initialize()
+    await post_init(application)
+    await application.start()
+    try:
+        # 多个副本启动时重复设置相同的 webhook 没有影响
+        await application.bot.set_webhook(configInstance.telegram_webhook_url,
+                                          secret_token=configInstance.telegram_webhook_secret,
+                                          max_connections=configInstance.telegram_webhook_max_connections,
+                                          allowed_updates=Update.ALL_TYPES)
+        logger.info(f'Webhook set to {configInstance.telegram_webhook_url}, listening on '
+                    f'{configInstance.telegram_webhook_listen}:{configInstance.telegram_webhook_port}{path}')
+        await server.serve()
+    finally:
+        await application.stop()
+        await application.shutdown()
+        await post_shutdown(application)
+
+
+def test_with_synthetic_updates():
+    """向 WebhookApp 发送模拟的 update，验证 secret token 校验、入队以及队列已满时的拒绝"""
+    import httpx
+    from telegram.ext import ApplicationBuilder
+
+    async def run():
+        application = ApplicationBuilder().token('123:TEST').update_queue(asyncio.Queue(maxsize=2)).build()
+        app = WebhookApp(application, 'secret', '/webhook')
+        update = {'update_id': 1, 'message': {'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'},
+                                               'from': {'id': 1, 'is_bot': False, 'first_name': 'test'},
+                                               'text': '/help'}}
+        headers = {'X-Telegram-Bot-Api-Secret-Token': 'secret'}
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://test') as client:
+            response = await client.post('/webhook', json=update, headers={'X-Telegram-Bot-Api-Secret-Token': 'x'})
+            assert response.status_code == 403, response.status_code
+            response = await client.post('/webhook', json=update,
+                                         headers={'X-Telegram-Bot-Api-Secret-Token': b'secr\xe9t'})
+            assert response.status_code == 403, response.status_code
+            response = await client.post('/webhook', content=b'not json', headers=headers)
+            assert response.status_code == 400, response.status_code
+            for i in range(3):
+                response = await client.post('/webhook', json={**update, 'update_id': i + 1}, headers=headers)
+                assert response.status_code == (200 if i < 2 else 503), (i, response.status_code)
+            response = await client.get('/healthz')
+            print(response.json())
+        queued = application.update_queue.get_nowait()
+        assert isinstance(queued, Update) and queued.message.text == '/help'
+        assert app.stats == {'accepted': 2, 'rejected': 1, 'forbidden': 2, 'invalid': 1}, app.stats
+        print('webhook synthetic update test passed')
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    test_with_synthetic_updates()
@@ -0,0 +1,50 @@
+import asyncio
+import signal
+
+from config.config import configInstance
+from db.redis_util import redis_async
+from logger.logger_config import setup_logger
+from url.executor import url_executor
+from url.job_queue import url_jobs
+from url.selenium_pool import selenium_pool
+from url.snapshot_with_wayback import wayback_client
+from url.stream_jobs import execute_url_job, on_url_job_dead
+from url.stream_queue import url_stream
+from url.utils import ai_clients
+
+logger = setup_logger('worker')
+
+
+async def run() -> None:
+    """从 redis stream 领取 /summarize 和 /backup 任务并执行，可以在多个容器中同时运行
+
+    bot 需要设置 URL_JOB_BACKEND=stream，GitHub 提交和 wayback 快照的等待仍由 bot 进程完成
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await url_stream.start_worker(execute_url_job, on_url_job_dead)
+    logger.info(f'-------------Worker {url_stream.consumer} started-------------')
+    await stop.wait()
+
+    # 执行中的任务不确认，由其他 worker 在 visibility timeout 后重新领取
+    await url_stream.close()
+    await url_jobs.close()
+    await wayback_client.close()
+    await ai_clients.close()
+    await redis_async.close()
+    url_executor.shutdown()
+    selenium_pool.close()
+    logger.info(f'-------------Worker {url_stream.consumer} stopped-------------')
+
+
+def main() -> None:
+    if configInstance.url_job_backend != 'stream':
+        logger.warning('URL_JOB_BACKEND is not "stream", the bot will not publish jobs to this worker')
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()